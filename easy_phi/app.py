@@ -3,9 +3,13 @@
 """
 This file contains Web Application
 """
+import array
+import collections
+import hashlib
+import logging
 import os
 import json
-import time
+import re
 import pip
 
 import tornado.ioloop
@@ -13,12 +17,14 @@ import tornado.httpserver
 import tornado.web
 import tornado.websocket
 import tornado.gen
+import tornado.iostream
 import tornado.log
 
 from tornado.options import options, define
 from tornado.options import parse_config_file, parse_command_line
 
-from easy_phi import hwconf, auth, utils, scpi2widgets, hislip
+from easy_phi import hwconf, auth, utils, scpi2widgets, hislip, events
+from easy_phi import timeseries, recorder, raw_socket, mod_conf_patch
 
 # whenever you change version, please update setup.py as well
 from easy_phi import __version__, __project__
@@ -26,6 +32,16 @@ from easy_phi import __version__, __project__
 
 WEBSOCKETS = set()
 
+# (SHA1 digest, response body) of responses depending only on
+# utils.generation, see APIHandler.write_cached()
+_response_cache = utils.GenerationCache()
+# module configuration: script creating its UI, see module_ui_script()
+_ui_scripts = utils.GenerationCache()
+
+# binary blocks are not representable in JSON responses
+BINARY_RESPONSE_ERROR = "Command returned binary data, use /api/v1/send_scpi " \
+                        "to get it"
+
 
 # configuration defaults
 define("conf_path", default="/etc/easy_phi.conf")
@@ -55,6 +71,37 @@ define("hislip_port", default=4880)
 define("raw_socket", 'disable')
 define("raw_socket_port", default=5025)
 
+# WebSocket updates waiting for slow client, and what to do if there are
+# more: 'drop_oldest' updates, keep only 'latest_per_slot' update of every
+# type, or 'disconnect' the client
+define("websocket_queue_size", default=1000)
+define("websocket_queue_policy", default='drop_oldest')
+# origins of pages allowed to open WebSocket besides this server itself,
+# e.g. ['https://lab.example.com']
+define("websocket_origins", default=[])
+
+
+def get_api_token(handler):
+    """ Look for API token in request
+    API token is looked in following order:
+        - session cookie (to support access from web interface)
+        - HTTP Basic auth password, if username is api_token
+        - GET request variable api_token
+    :param handler: tornado.web.RequestHandler instance
+    :return: API token, empty string if not found
+    """
+    api_token = handler.get_cookie(options.session_cookie_name)
+
+    if api_token is None:
+        user, pwd = auth.parse_http_basic_auth(handler.request)
+        if user == 'api_token':
+            api_token = pwd
+
+    if api_token is None:
+        api_token = handler.get_argument('api_token', '')
+
+    return api_token
+
 
 class APIHandler(tornado.web.RequestHandler):
     """ Tornado handlers subclass to format response to xml/json/plain """
@@ -62,23 +109,11 @@ class APIHandler(tornado.web.RequestHandler):
     # default value of api_token is empty string
     # this is done to make it optional with dummy auth backend
     api_token = None
+    _encoder = None
 
     def prepare(self):
-        """ Look for API token in request
-        API token is looked in following order:
-            - session cookie (to support access from web interface)
-            - HTTP Basic auth password, if username is api_token
-            - GET request variable api_token
-        """
-        api_token = self.get_cookie(options.session_cookie_name)
-
-        if api_token is None:
-            user, pwd = auth.parse_http_basic_auth(self.request)
-            if user == 'api_token':
-                api_token = pwd
-
-        if api_token is None:
-            api_token = self.get_argument('api_token', '')
+        """ Look for API token in request, see get_api_token() """
+        api_token = get_api_token(self)
 
         if not auth.validate_api_token(api_token):
             self.set_status(401)
@@ -96,21 +131,58 @@ class APIHandler(tornado.web.RequestHandler):
         # abstract method
         pass
 
-    def write(self, chunk):
-        fmt = self.get_argument('format', options.default_format)
-        if fmt not in ('json', 'plain'):
-            fmt = options.default_format
-
-        chunk, ctype = utils.format_conversion(chunk, fmt, options.debug)
-
-        if fmt == 'json':
-            callback = self.get_argument('callback', '')
-            if callback:  # JSONP support, for cross-domain static JS API
-                chunk = '{callback}({chunk});'.format(
-                    callback=callback, chunk=chunk)
-        self.set_header('Content-Type', ctype)
+    @property
+    def encoder(self):
+        """ Response encoder, chosen once per request by format and callback
+        arguments or Accept header, see utils.get_encoder() """
+        if self._encoder is None:
+            fmt = self.get_argument('format', '')
+            if not fmt:
+                self.add_header('Vary', 'Accept')
+                fmt = utils.accepted_format(
+                    self.request.headers.get('Accept', ''))
+            if fmt not in utils.response_formats:
+                fmt = options.default_format
+            self._encoder = utils.get_encoder(
+                fmt, options.debug, self.get_argument('callback', ''))
+        return self._encoder
 
-        super(APIHandler, self).write(chunk)
+    def write(self, chunk):
+        encoder = self.encoder
+        self.set_header('Content-Type', encoder.content_type)
+        super(APIHandler, self).write(encoder.encode(chunk))
+
+    def write_cached(self, key, build):
+        """ Write response which only changes with utils.generation, e.g. list
+        of modules. Encoded response is cached until generation changes and
+        has strong ETag, so polling clients get 304 Not Modified without body
+        JSONP callback is supplied by client, so it is not a part of the key:
+        cached JSON is wrapped into callback call per request
+        :param key: tuple of request parameters response depends on, e.g. slot
+               build: function returning response chunk
+        """
+        encoder = self.encoder
+        callback = getattr(encoder, 'callback', None)
+        if callback is not None:
+            encoder = encoder.encoder
+
+        def build_response():
+            body = encoder.encode(build())
+            return hashlib.sha1(body).hexdigest(), body
+
+        digest, body = _response_cache.get(
+            (type(self), key, encoder.content_type), build_response)
+        if callback is not None:
+            body = self.encoder.wrap(body)
+            digest = hashlib.sha1(digest + callback).hexdigest()
+
+        etag = '"{0}"'.format(digest)
+        self.set_header('Content-Type', encoder.content_type)
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        tornado.web.RequestHandler.write(self, body)
 
     def get(self):
         """ It is totally possible to use SUPPORTED_METHODS to return HTTP 405
@@ -134,6 +206,45 @@ class APIHandler(tornado.web.RequestHandler):
         self.write({'errror': "This method does not accept DELETE requests"})
 
 
+def validate_slot(slot, allow_broadcast=False):
+    """ Check if slot number is valid and there is a module in this slot
+    :param slot: slot number, integer or string
+           allow_broadcast: boolean, whether slot 0 (broadcast) is acceptable
+    :return: tuple (slot, error message). Slot is converted to integer,
+            error message is empty string if slot is valid
+    """
+    if slot == '':
+        return None, 'Missing slot number. Add ?slot=N to URL'
+    try:
+        slot = int(slot)
+    except (TypeError, ValueError):
+        return None, 'Slot number must be an integer'
+
+    max_slot = len(hwconf.modules) - 1
+    min_slot = 0 if allow_broadcast else 1
+    if not min_slot <= slot <= max_slot:  # invalid slot number
+        return slot, 'Invalid slot number. Number in range ' + \
+            '{0}..{1} expected'.format(min_slot, max_slot)
+    elif hwconf.modules[slot] is None:
+        return slot, 'Selected slot is empty'
+    return slot, ''
+
+
+def check_user_lock(slot, api_token):
+    """ Check if module in the slot is not locked by another user
+    :param slot: valid slot number
+           api_token: api token of the user trying to use the module
+    :return: error message, empty string if module can be used
+    """
+    used_by = getattr(hwconf.modules[slot], 'used_by', None)
+    # auth.user_by_token(None) returns None, in case selection isn't used
+    # This check is not applicable to broadcast module (slot 0)
+    if slot and used_by != auth.user_by_token(api_token):
+        return "Module is used by {0}. If you need this module, you " \
+               "need force unlock it first.".format(used_by)
+    return ''
+
+
 class ModuleHandler(APIHandler):
     """ APIHandler subclass to handle slot number validation
     It is intended for handlers working with modules """
@@ -144,24 +255,8 @@ class ModuleHandler(APIHandler):
     def prepare(self):
         super(ModuleHandler, self).prepare()
 
-        err = ''
-        slot = self.get_argument('slot', '')
-        if slot == '':
-            err = 'Missing slot number. Add ?slot=N to URL'
-        else:
-            try:
-                self.slot = int(slot)
-            except ValueError:
-                err = 'Slot number must be an integer'
-            else:
-                max_slot = len(hwconf.modules) - 1
-                min_slot = 0 if self.allow_broadcast else 1
-                if not min_slot <= self.slot <= max_slot:  # invalid slot number
-                    err = 'Invalid slot number. Number in range ' + \
-                          '{0}..{1} expected'.format(min_slot, max_slot)
-                elif hwconf.modules[self.slot] is None:
-                    err = 'Selected slot is empty'
-
+        self.slot, err = validate_slot(self.get_argument('slot', ''),
+                                       self.allow_broadcast)
         if err:
             self.set_status(400)
             self.finish({'error': err})
@@ -173,13 +268,15 @@ class ModuleHandler(APIHandler):
 class PlatformInfoHandler(APIHandler):
     """ Return basic info about the system """
     def get(self):
-        self.write({
+        self.write_cached((), lambda: {
             'hw_version': options.hw_version,
             'slots': len(options.ports),
             'supported_api_versions': [1],
             'sw_version': __version__,
             'vendor': options.vendor,
-            'welcome_message': options.welcome_message
+            'welcome_message': options.welcome_message,
+            # modules being initialized, they will appear in modules list soon
+            'modules_probing': hwconf.probing(),
         })
 
 
@@ -201,7 +298,8 @@ class ModuleInfoHandler(ModuleHandler):
 class ModulesListHandler(APIHandler):
     """ Return list of module names"""
     def get(self):
-        self.write([module and module.name for module in hwconf.modules])
+        self.write_cached((), lambda: [module and module.name
+                                       for module in hwconf.modules])
 
 
 class ListSCPICommandsHandler(ModuleHandler):
@@ -209,7 +307,8 @@ class ListSCPICommandsHandler(ModuleHandler):
     allow_broadcast = True
 
     def get(self):
-        self.write(self.module.get_configuration())
+        mod_conf_patch.refresh()
+        self.write_cached((self.slot,), self.module.get_configuration)
 
 
 class SelectModuleHandler(ModuleHandler):
@@ -237,8 +336,7 @@ class SelectModuleHandler(ModuleHandler):
         setattr(self.module, 'used_by', used_by)
 
         # Send update to all clients via WS
-        for websocket in WEBSOCKETS:
-            websocket.update_lock(self.slot, used_by)
+        lock_callback(self.slot, used_by)
 
         self.finish("OK")
 
@@ -251,8 +349,7 @@ class SelectModuleHandler(ModuleHandler):
             return
         setattr(self.module, 'used_by', None)
 
-        for websocket in WEBSOCKETS:
-            websocket.update_lock(self.slot, None)
+        lock_callback(self.slot, None)
 
         self.finish("OK")
 
@@ -270,17 +367,15 @@ class SCPICommandHandler(ModuleHandler):
 
     @tornado.gen.coroutine
     def post(self):
-        """Transfer SCPI command to a module and return the response"""
+        """Transfer SCPI command to a module and return the response
+        Broadcast (slot 0) accepts optional slot_map=1 parameter to return
+        responses of all modules, see hwal.BroadcastModule.scpi()
+        """
         # Check user lock status
-        used_by = getattr(self.module, 'used_by', None)
-        # auth.user_by_token(None) returns None, in case selection isn't used
-        # This check is not applicable to broadcast module (slot 0)
-        if self.slot and used_by != auth.user_by_token(self.api_token):
+        err = check_user_lock(self.slot, self.api_token)
+        if err:
             self.set_status(409)  # Conflict
-            self.finish({
-                'error': "Module is used by {0}. If you need this module, you "
-                         "need force unlock it first.".format(used_by)
-            })
+            self.finish({'error': err})
             return
 
         scpi_command = self.request.body
@@ -289,14 +384,222 @@ class SCPICommandHandler(ModuleHandler):
             self.finish({'error': 'SCPI command expected in POST body'})
             return
 
-        result = yield tornado.gen.maybe_future(self.module.scpi(scpi_command))
+        if self.slot == 0 and self.get_argument('slot_map', ''):
+            # broadcast: responses of all modules and write skew
+            result = yield self.module.scpi(scpi_command, slot_map=True)
+        else:
+            result = yield tornado.gen.maybe_future(
+                self.module.scpi(scpi_command))
+
+        if isinstance(result, memoryview):
+            self.write_block(result)
+            return
 
+        if self.encoder.native_numbers:
+            result = utils.native_numbers(result)
         self.finish(result)
 
+    def write_block(self, block):
+        """ Return binary block payload as is, or as NumPy .npy array if
+        dtype parameter is specified, e.g. dtype=<f4 """
+        dtype = self.get_argument('dtype', '')
+        if not dtype:
+            self.set_header('Content-Type', 'application/octet-stream')
+            # APIHandler.write() would format it, call original write()
+            tornado.web.RequestHandler.write(self, block.tobytes())
+            self.finish()
+            return
+
+        match = re.match(r'[<>|]?[biuf]([1-8])$', dtype)
+        if match is None or len(block) % int(match.group(1)):
+            self.set_status(400)
+            self.finish({'error': 'dtype should be array-protocol type '
+                                  'string matching data size, e.g. <f4'})
+            return
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.set_header('Content-Disposition',
+                        'attachment; filename="slot{0}.npy"'.format(self.slot))
+        tornado.web.RequestHandler.write(
+            self, utils.npy_header(dtype, len(block) // int(match.group(1))))
+        tornado.web.RequestHandler.write(self, block.tobytes())
+        self.finish()
+
+
+class TimeSeriesHandler(ModuleHandler):
+    """API function to return numeric data recently generated by a module"""
+    allow_broadcast = False
+
+    def get(self):
+        """ Return samples received in time range, decimated to specified
+        number of points, see timeseries.decimate()
+        :param: slot: integer, slot number 1...N
+                start, end: optional unix timestamps of time range
+                points: max number of points, default is 1000
+        :return: {'t': [...], 'min': [...], 'max': [...], 'mean': [...]}
+        """
+        start = self.get_argument('start', None)
+        end = self.get_argument('end', None)
+        try:
+            start = None if start is None else float(start)
+            end = None if end is None else float(end)
+            points = int(self.get_argument('points', 1000))
+        except ValueError:
+            points = 0
+        if points < 1:
+            self.set_status(400)
+            self.finish({'error': 'start and end are expected to be unix '
+                                  'timestamps, points - positive integer'})
+            return
+
+        buf = timeseries.buffers.get(self.slot)
+        if buf is None:
+            timestamps = values = array.array('d')
+        else:
+            timestamps, values = buf.range(start, end)
+        self.write(timeseries.decimate(timestamps, values, points))
+
+
+class RecordHandler(ModuleHandler):
+    """API function to record data generated by a module to disk"""
+    allow_broadcast = False
+
+    def get(self):
+        """ Return name of active recording of the module, None otherwise """
+        active = recorder.recorders.get(self.slot)
+        self.write(active and active.name)
+
+    def post(self):
+        """ Start recording, return recording name """
+        err = check_user_lock(self.slot, self.api_token)
+        if err:
+            self.set_status(409)  # Conflict
+            self.finish({'error': err})
+            return
+        self.write({'name': recorder.start(self.slot)})
+
+    def delete(self):
+        """ Stop recording, return recording name """
+        err = check_user_lock(self.slot, self.api_token)
+        if err:
+            self.set_status(409)  # Conflict
+            self.finish({'error': err})
+            return
+        name = recorder.stop(self.slot)
+        if name is None:
+            self.set_status(400)
+            self.finish({'error': 'Module is not recorded at the moment'})
+            return
+        self.write({'name': name})
+
+
+class RecordingsListHandler(APIHandler):
+    """ Return list of recordings, see recorder.list_recordings() """
+    def get(self):
+        self.write(recorder.list_recordings())
+
+
+class RecordingExportHandler(APIHandler):
+    """API function to download a recording as CSV or NumPy .npy file
+    Recording is streamed in chunks, so it can be downloaded while it is
+    still being recorded
+    """
+    content_types = {
+        'csv': 'text/csv',
+        'npy': 'application/octet-stream',
+    }
+
+    @tornado.gen.coroutine
+    def get(self):
+        name = self.get_argument('name', '')
+        fmt = self.get_argument('format', 'csv')
+        if fmt not in self.content_types or not recorder.exists(name):
+            self.set_status(404)
+            self.finish({'error': 'Recording name (see /api/v1/recordings) '
+                                  'and format (csv or npy) expected'})
+            return
+
+        self.set_header('Content-Type', self.content_types[fmt])
+        self.set_header('Content-Disposition',
+                        'attachment; filename="{0}.{1}"'.format(name, fmt))
+        for chunk in recorder.export(name, fmt):
+            # APIHandler.write() would format it, call original write()
+            tornado.web.RequestHandler.write(self, chunk)
+            try:
+                yield self.flush()
+            except tornado.iostream.StreamClosedError:
+                return
+
+
+class SCPIBatchHandler(APIHandler):
+    """API function to send multiple SCPI commands to multiple modules
+    Commands for different slots are executed concurrently, commands for the
+    same slot are executed in the order of appearance.
+    """
+
+    @tornado.gen.coroutine
+    def post(self):
+        """ Execute batch of commands passed in POST body as JSON list:
+        [{"slot": 1, "command": "*IDN?"}, {"slot": 2, "command": "*RST"}]
+        :return: list of results in the same order, {"slot": 1, "result": ...}
+                or {"slot": 1, "error": ...} if command was not executed
+        """
+        try:
+            batch = json.loads(self.request.body)
+        except ValueError:
+            batch = None
+        if not isinstance(batch, list) or not all(
+                isinstance(entry, dict) and 'slot' in entry and
+                isinstance(entry.get('command'), basestring) and
+                entry['command'].strip() for entry in batch):
+            self.set_status(400)
+            self.finish({'error': 'List of {"slot": N, "command": "..."} '
+                                  'expected in POST body'})
+            return
+
+        results = [None] * len(batch)
+        slot_commands = {}  # slot: indexes of batch entries for this slot
+        for index, entry in enumerate(batch):
+            slot, err = validate_slot(entry['slot'], allow_broadcast=True)
+            err = err or check_user_lock(slot, self.api_token)
+            if err:
+                results[index] = {'slot': entry['slot'], 'error': err}
+            else:
+                slot_commands.setdefault(slot, []).append(index)
+
+        @tornado.gen.coroutine
+        def execute(slot, indexes):
+            module = hwconf.modules[slot]
+            for index in indexes:
+                try:
+                    result = yield tornado.gen.maybe_future(
+                        module.scpi(batch[index]['command']))
+                except tornado.iostream.StreamClosedError:
+                    results[index] = {'slot': slot,
+                                      'error': 'Module was disconnected'}
+                except Exception:
+                    logging.exception("SCPI command %r failed",
+                                      batch[index]['command'])
+                    results[index] = {'slot': slot,
+                                      'error': 'SCPI command failed'}
+                else:
+                    if isinstance(result, memoryview):
+                        results[index] = {'slot': slot,
+                                          'error': BINARY_RESPONSE_ERROR}
+                    else:
+                        if self.encoder.native_numbers:
+                            result = utils.native_numbers(result)
+                        results[index] = {'slot': slot, 'result': result}
+
+        yield [execute(slot, indexes)
+               for slot, indexes in slot_commands.items()]
+
+        self.finish(results)
+
 
 class ModuleUIHandler(ModuleHandler):
     """API function to return small JS script to create module UI"""
     allow_broadcast = True
+    encoder = utils.RawEncoder('application/javascript')
 
     def write(self, chunk):
         """This handler needs slot parameter but does not need formatting
@@ -312,75 +615,227 @@ class ModuleUIHandler(ModuleHandler):
                          "of the DOM element to include module UI"})
             return
 
-        supported_commands = self.module.get_configuration()
-        widgets = scpi2widgets.scpi2widgets(supported_commands)
-
-        self.set_header('Content-type', 'application/javascript')
-
-        temp_id = int(time.time()*100000)
-        # time.time() has precision of 1/100000 of a second. Yet it is not a
-        # real precision, here we only care to have different IDs
-        # having them separated by a millisecond sometimes is not enough, since
-        # in local network two requests can arrive in less than one millisecond
-        # if some day 1/100000 would not be sufficient, think of using UUIDs
-        for widget in widgets:
-            temp_id += 1
-            self.write("""$("{container}").append("<section id='{temp_id}' """
-                       """class='widget'></section>");\n""".format(
-                           container=container, temp_id=temp_id))
-            # this wrapping into anonymous function is to not mess with global
-            # variables. To isolate syntax errors, in future it is wrapped into
-            # eval() statement.
-            self.write(
-                "(function(slot, container, scpi){{\n"
-                "\teval({widget});\n"
-                "}})({slot}, $('#{container_id}'), function(scpi, callback){{\n"
-                "    ep.scpi({slot}, scpi, callback);\n}});\n".format(
-                    widget=json.dumps(widget),
-                    slot=self.slot,
-                    container_id=temp_id
-                )
-            )
+        mod_conf_patch.refresh()
+        scpi2widgets.refresh()
+        # container is supplied by client, so only script body is cached,
+        # see module_ui_script(). Tornado sets ETag of the response
+        self.set_header('Content-Type', self.encoder.content_type)
+        self.write(module_ui_script(self.slot, self.module, container))
+
+
+class ModulesUIHandler(ModuleUIHandler):
+    """API function to return script creating UI of all modules at once"""
+
+    def prepare(self):
+        """ Slot parameter is not used """
+        APIHandler.prepare(self)
+
+    def get(self):
+        """
+        :param: container: jQuery selector of DOM element to include module
+                UI, {slot} is replaced by slot number.
+                Default: #module_control_panel_{slot}
+        """
+        container = self.get_argument('container',
+                                      '#module_control_panel_{slot}')
+        mod_conf_patch.refresh()
+        scpi2widgets.refresh()
+        self.set_header('Content-Type', self.encoder.content_type)
+        self.write("".join(
+            module_ui_script(slot, module,
+                             container.replace('{slot}', str(slot)))
+            for slot, module in enumerate(hwconf.modules)
+            if module is not None))
+
+
+def _ui_script_body(widgets):
+    """ Script creating widgets, without slot and container, which are
+    passed in parentheses appended to it """
+    chunks = ["(function(slot, container){\n"
+              "function scpi(command, callback) {\n"
+              "    ep.scpi(slot, command, callback);\n}\n"]
+    for widget in widgets:
+        # this wrapping into anonymous function is to not mess with global
+        # variables. To isolate syntax errors, in future it is wrapped into
+        # eval() statement. Every widget gets its own section
+        chunks.append(
+            "(function(slot, container, scpi){{\n"
+            "\teval({widget});\n"
+            "}})(slot, $(\"<section class='widget'></section>\")"
+            ".appendTo(container), scpi);\n".format(widget=json.dumps(widget)))
+    chunks.append("})")
+    return "".join(chunks)
+
+
+def module_ui_script(slot, module, container):
+    """ Build script creating UI of the module. Widgets depend only on module
+    configuration, so scripts are cached per configuration and shared by
+    modules of the same kind
+    :param slot: slot number
+           module: hwal module instance
+           container: jQuery selector of DOM element to include UI
+    :return: JavaScript string
+    """
+    configuration = tuple(module.get_configuration())
+    body = _ui_scripts.get(configuration, lambda: _ui_script_body(
+        scpi2widgets.scpi2widgets(configuration)))
+    return "{0}({1}, {2});\n".format(body, slot, json.dumps(container))
+
+
+class WebSocketsListHandler(APIHandler):
+    """ Return list of WebSocket clients and their send queue statistics """
+    def get(self):
+        self.write([{
+            'remote_ip': websocket.request.remote_ip,
+            'slots': None if websocket.slots is None
+            else sorted(websocket.slots),
+            'msg_types': None if websocket.msg_types is None
+            else sorted(websocket.msg_types),
+            'queued': len(websocket.queue),
+            'dropped': websocket.dropped,
+        } for websocket in WEBSOCKETS])
+
+
+class EventsHandler(APIHandler):
+    """Server-Sent Events stream of MODULE_UPDATE, LOCK_UPDATE and DATA_UPDATE
+    messages, same as sent through WebSocket.
+    Every event has an id, so reconnecting client (e.g. browser EventSource)
+    receives events it missed, starting from Last-Event-ID header or
+    last_event_id parameter. If these events are not available anymore,
+    RESYNC event is sent, meaning client has to refetch platform state.
+    """
+    closed = False
+
+    def write(self, chunk):
+        """Events are formatted by events.format_event(), so
+        tornado.web.RequestHandler.write() is restored here
+        """
+        return super(APIHandler, self).write(chunk)
+
+    def on_connection_close(self):
+        self.closed = True
+
+    @tornado.gen.coroutine
+    def get(self):
+        last_id = self.request.headers.get(
+            'Last-Event-ID', self.get_argument('last_event_id', ''))
+        if last_id:
+            # None if server was restarted since, so client gets RESYNC
+            last_id = events.log.parse_id(last_id)
+        else:  # new client, send only new events
+            last_id = events.log.last_id
+
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        # nginx buffers responses by default, which delays events
+        self.set_header('X-Accel-Buffering', 'no')
+
+        while not self.closed:
+            new_events = events.log.since(last_id)
+            if new_events is None:
+                last_id = events.log.last_id
+                self.write(events.format_event(
+                    events.log.format_id(last_id), 'RESYNC', '{}'))
+            elif new_events:
+                for event_id, msg_type, data in new_events:
+                    self.write(events.format_event(
+                        events.log.format_id(event_id), msg_type, data))
+                last_id = new_events[-1][0]
+            else:  # comment line, to keep connection alive
+                self.write(":\n\n")
+            try:
+                yield self.flush()
+            except tornado.iostream.StreamClosedError:
+                return
+            # events published while flushing are sent without waiting
+            if events.log.last_id == last_id:
+                yield events.log.wait()
 
 
 class WebSocketHandler(tornado.websocket.WebSocketHandler):
     """API function that opens/closes WebSocket connection and
     provides interface to send data through the WebSocket"""
 
-    def update_module(self, slot, added):
-        """Send hardware configuration update to the client.
-        It means module has been added or removed
-        :param  slot: int, slot number where configuration change occurred
-                added: boolean, True if module was added, False if removed
+    # slots and message types client is subscribed to, None means all
+    slots = None
+    msg_types = None
+    # (message, JSON encoded message) waiting for previous frame to be sent
+    queue = None
+    # number of messages dropped because of queue overflow
+    dropped = 0
+    _writing = False
+    # valid API token of the client, None if client is not authenticated.
+    # Not authenticated clients receive updates, but can't send commands
+    api_token = None
+
+    def subscribed(self, message):
+        """Check if message should be sent to the client
+        :param message: dictionary with 'msg_type' and 'slot' keys
+        :return: boolean
         """
-        message = {
-            'msg_type': 'MODULE_UPDATE',
-            'slot': slot,
-            'module_name': added and hwconf.modules[slot].name,
-            'added': added
-        }
-        self.write_message(message)
-
-    def update_lock(self, slot, used_by):
-        """Send lock status update to the client"""
-        message = {
-            'msg_type': 'LOCK_UPDATE',
-            'slot': slot,
-            'used_by': used_by
-        }
-        self.write_message(message)
-
-    def send_data(self, slot, data):
-        """Send data generated by a module to clients"""
-        message = {
-            'msg_type': 'DATA_UPDATE',
-            'slot': slot,
-            'data': data
-        }
-        self.write_message(message)
+        return (self.slots is None or message['slot'] in self.slots) and \
+            (self.msg_types is None or message['msg_type'] in self.msg_types)
+
+    def send(self, messages, frame):
+        """Send updates to the client
+        If client did not receive previous frame yet, messages are queued and
+        sent later in one frame. Queue size is limited by
+        options.websocket_queue_size
+        :param messages: list of tuples (message, JSON encoded message)
+               frame: the same messages, encoded as one frame
+        """
+        if not self._writing and not self.queue:
+            self._write_frame(frame)
+            return
+        self.queue.extend(messages)
+        if len(self.queue) > options.websocket_queue_size:
+            self._handle_overflow()
+
+    def _write_frame(self, frame):
+        try:
+            future = self.write_message(frame)
+        except tornado.websocket.WebSocketClosedError:
+            return
+        if future is None:  # connection was aborted
+            return
+        self._writing = True
+        future.add_done_callback(self._on_frame_written)
+
+    def _on_frame_written(self, future):
+        self._writing = False
+        if future.exception() is not None:  # connection closed
+            return
+        if self.queue:
+            frame = encode_frame([data for _, data in self.queue])
+            self.queue.clear()
+            self._write_frame(frame)
+
+    def _handle_overflow(self):
+        policy = options.websocket_queue_policy
+        if policy == 'disconnect':
+            self.dropped += len(self.queue)
+            self.queue.clear()
+            self.close()
+            return
+        if policy == 'latest_per_slot':
+            # position of the latest message of every type for every slot
+            latest = {}
+            for index, (message, _) in enumerate(self.queue):
+                latest[(message['msg_type'], message['slot'])] = index
+            queue = list(self.queue)
+            self.dropped += len(queue) - len(latest)
+            self.queue = collections.deque(
+                queue[index] for index in sorted(latest.values()))
+        while len(self.queue) > options.websocket_queue_size:
+            self.queue.popleft()
+            self.dropped += 1
 
     def open(self):
         """Open WebSocket connection"""
+        self.queue = collections.deque()
+        api_token = get_api_token(self)
+        if auth.validate_api_token(api_token):
+            self.api_token = api_token
         WEBSOCKETS.add(self)
 
     def on_close(self, **kwargs):
@@ -388,24 +843,181 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
         WEBSOCKETS.remove(self)
 
     def on_message(self, message):
-        """Echo received messages for test purpose """
-        self.write_message('Echo:' + message)
+        """Handle JSON encoded client request. Subscription request limits
+        updates sent to the client to selected slots and message types:
+            {"subscribe": {"slots": [1, 2], "msg_types": ["DATA_UPDATE"]}}
+        Missing or null slots (msg_types) means all slots (message types).
+        Messages which are not JSON objects are echoed for test purpose
+        """
+        try:
+            request = json.loads(message)
+        except ValueError:
+            request = None
+        if not isinstance(request, dict):
+            self.write_message('Echo:' + message)
+            return
+
+        if 'subscribe' in request:
+            subscription = request['subscribe'] or {}
+            if not isinstance(subscription, dict):
+                self.write_message({'error': 'Invalid subscription'})
+                return
+            slots = subscription.get('slots')
+            msg_types = subscription.get('msg_types')
+            # lists of JSON scalars, i.e. hashable values, or null
+            for value in (slots, msg_types):
+                if value is not None and (not isinstance(value, list) or any(
+                        isinstance(item, (list, dict)) for item in value)):
+                    self.write_message({'error': 'Invalid subscription'})
+                    return
+            self.slots = None if slots is None else frozenset(slots)
+            self.msg_types = None if msg_types is None else frozenset(msg_types)
+            self.write_message({
+                'msg_type': 'SUBSCRIBED',
+                'slots': slots,
+                'msg_types': msg_types
+            })
+        elif 'command' in request:
+            self.scpi(request)
+        else:
+            self.write_message({'error': 'Unknown request'})
+
+    @tornado.gen.coroutine
+    def scpi(self, request):
+        """Transfer SCPI command to a module and send back the response
+        Requests are not waiting for each other, so client can send many
+        commands at once and match responses by request id.
+        :param request: {"id": 1, "slot": 1, "command": "*IDN?"}
+        :return: None, {"id": 1, "result": ...} or {"id": 1, "error": ...}
+                is sent to client
+        """
+        response = {'id': request.get('id')}
+        command = request['command']
+        if self.api_token is None:
+            response['error'] = "api_token is missing or invalid"
+        elif not isinstance(command, basestring) or not command.strip():
+            response['error'] = 'SCPI command expected'
+        else:
+            slot, err = validate_slot(request.get('slot', ''),
+                                      allow_broadcast=True)
+            err = err or check_user_lock(slot, self.api_token)
+            if err:
+                response['error'] = err
+            else:
+                try:
+                    response['result'] = yield tornado.gen.maybe_future(
+                        hwconf.modules[slot].scpi(command))
+                except tornado.iostream.StreamClosedError:
+                    response['error'] = 'Module was disconnected'
+                except Exception:
+                    logging.exception("SCPI command %r failed", command)
+                    response['error'] = 'SCPI command failed'
+                if isinstance(response.get('result'), memoryview):
+                    del response['result']
+                    response['error'] = BINARY_RESPONSE_ERROR
+        try:
+            self.write_message(response)
+        except tornado.websocket.WebSocketClosedError:
+            pass  # client has gone while command was executed
 
     def check_origin(self, origin):
-        """Override to allow requests from other hosts"""
-        return True
+        """Allow connections from pages of this server and of origins listed
+        in websocket_origins option. API token is taken from session cookie,
+        so any other site could send commands on behalf of logged in user.
+        Clients other than browsers do not send Origin and are not checked
+        """
+        if origin in options.websocket_origins:
+            return True
+        return super(WebSocketHandler, self).check_origin(origin)
+
+
+def module_update_message(slot, added):
+    """ Message about module added to or removed from the slot """
+    return {
+        'msg_type': 'MODULE_UPDATE',
+        'slot': slot,
+        'module_name': added and hwconf.modules[slot].name,
+        'added': added
+    }
+
+
+def lock_update_message(slot, used_by):
+    """ Message about module user lock change """
+    return {
+        'msg_type': 'LOCK_UPDATE',
+        'slot': slot,
+        'used_by': used_by
+    }
+
+
+def data_update_message(slot, data):
+    """ Message with data generated by a module """
+    return {
+        'msg_type': 'DATA_UPDATE',
+        'slot': slot,
+        'data': data
+    }
+
+
+# (message, JSON encoded message) broadcasted in current IOLoop iteration
+_pending_messages = []
+
+
+def broadcast(message):
+    """ Send message to event stream clients and subscribed websockets
+    Message is JSON encoded only once, regardless of number of clients.
+    Messages broadcasted in the same IOLoop iteration are sent to a websocket
+    in one frame, as JSON array
+    :param message: dictionary with 'msg_type' and 'slot' keys
+    """
+    _, _, data = events.log.publish(message)
+    _pending_messages.append((message, data))
+    if len(_pending_messages) == 1:
+        tornado.ioloop.IOLoop.current().add_callback(_send_pending_messages)
+
+
+def _send_pending_messages():
+    messages = _pending_messages[:]
+    del _pending_messages[:]
+    # clients with the same subscriptions receive the same frame
+    frames = {}  # tuple of message indexes: frame
+    for websocket in list(WEBSOCKETS):
+        selected = tuple(index for index, (message, _) in enumerate(messages)
+                         if websocket.subscribed(message))
+        if not selected:
+            continue
+        if selected not in frames:
+            frames[selected] = encode_frame(
+                [messages[index][1] for index in selected])
+        websocket.send([messages[index] for index in selected],
+                       frames[selected])
+
+
+def encode_frame(encoded_messages):
+    """ Combine JSON encoded messages into one WebSocket frame
+    :param encoded_messages: non empty list of JSON strings
+    :return: the only message, or JSON array of messages
+    """
+    if len(encoded_messages) == 1:
+        return encoded_messages[0]
+    return "[" + ",".join(encoded_messages) + "]"
 
 
 def hwconf_callback(slot, added):
-    """ Send update to all websockets on hardware configuration change """
-    for websocket in WEBSOCKETS:
-        websocket.update_module(slot, added)
+    """ Send update to all clients on hardware configuration change """
+    broadcast(module_update_message(slot, added))
+
+
+def lock_callback(slot, used_by):
+    """ Send update to all clients on module user lock change """
+    broadcast(lock_update_message(slot, used_by))
 
 
 def data_callback(slot, data):
-    """ Send update to all websockets on data received from some equipment """
-    for websocket in WEBSOCKETS:
-        websocket.send_data(slot, data)
+    """ Send update to all clients on data received from some equipment """
+    if isinstance(data, memoryview):
+        return  # binary block is not representable in JSON message
+    broadcast(data_update_message(slot, data))
 
 
 class BaseWebHandler(tornado.web.RequestHandler):
@@ -554,7 +1166,19 @@ def get_application():
         (r"/api/v1/lock_module", SelectModuleHandler, None,
             'api_select_module'),
         (r"/api/v1/send_scpi", SCPICommandHandler, None, 'api_send_scpi'),
+        (r"/api/v1/send_scpi_batch", SCPIBatchHandler, None,
+            'api_send_scpi_batch'),
         (r"/api/v1/module_ui_controls", ModuleUIHandler, None, 'api_widgets'),
+        (r"/api/v1/modules_ui", ModulesUIHandler, None, 'api_widgets_bundle'),
+        (r"/api/v1/events", EventsHandler, None, 'api_events'),
+        (r"/api/v1/timeseries", TimeSeriesHandler, None, 'api_timeseries'),
+        (r"/api/v1/record", RecordHandler, None, 'api_record'),
+        (r"/api/v1/recordings", RecordingsListHandler, None,
+            'api_recordings'),
+        (r"/api/v1/recording_export", RecordingExportHandler, None,
+            'api_recording_export'),
+        (r"/api/v1/websockets", WebSocketsListHandler, None,
+            'api_websockets'),
         (r"/admin", AdminConsoleHandler, None, 'admin'),
         (r"/admin/upgrade", SystemUpgradeHandler, None, 'upgrade'),
         (r"/logout", auth.LogoutHandler, None, 'logout'),
@@ -596,6 +1220,10 @@ def main():
 
     hwconf.hwconf_change_callbacks.append(hwconf_callback)
     hwconf.data_callbacks.append(data_callback)
+    hwconf.hwconf_change_callbacks.append(timeseries.hwconf_callback)
+    hwconf.data_callbacks.append(timeseries.data_callback)
+    hwconf.hwconf_change_callbacks.append(recorder.hwconf_callback)
+    hwconf.data_callbacks.append(recorder.data_callback)
     # it should start after options already parsed, as hwconf depends on certain
     # options like ports configurations, timeouts etc
     hwconf.start()
@@ -620,6 +1248,10 @@ def main():
         hislip_server = hislip.HiSLIPServer()
         hislip_server.listen(options.hislip_port)
 
+    # Raw sockets SCPI
+    if options.raw_socket == 'enable':
+        raw_socket.listen()
+
     tornado.ioloop.IOLoop.current().start()
 
 if __name__ == '__main__':
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This module keeps log of platform events (module added/removed, module lock
+changed, data generated by a module), so clients reconnecting after network
+failure can catch up without refetching whole platform state.
+"""
+
+import collections
+import datetime
+import itertools
+import json
+import time
+
+import tornado.locks
+from tornado.options import define, options
+
+# number of most recent events kept for reconnecting clients
+define('events_log_size', default=1000)
+# seconds between keep alive messages in idle event streams. Some proxies
+# close connections without traffic
+define('events_keepalive', default=15.0)
+
+
+class EventLog(object):
+    """ Bounded log of events with monotonically increasing ids
+    Events are serialized once on publishing and stored as tuples
+    (id, msg_type, JSON string)
+    Ids restart after server restart, so ids sent to clients are prefixed
+    with log epoch, see format_id()
+    """
+
+    def __init__(self, max_size=None):
+        """
+        :param max_size: number of events to keep, default is
+                options.events_log_size
+        """
+        self.max_size = max_size
+        self.events = collections.deque()
+        self.last_id = 0
+        self.epoch = "{0:x}".format(int(time.time() * 1000))
+        self._condition = tornado.locks.Condition()
+
+    def format_id(self, event_id):
+        """ Get event id for clients, e.g. 15f3a8c2b1e-42 """
+        return "{0}-{1}".format(self.epoch, event_id)
+
+    def parse_id(self, client_id):
+        """ Parse event id returned by client
+        :param client_id: string made by format_id()
+        :return: event id, or None if it is malformed or was issued by
+                another log, e.g. before server restart
+        """
+        epoch, _, event_id = client_id.partition("-")
+        if epoch != self.epoch or not event_id.isdigit():
+            return None
+        return int(event_id)
+
+    def publish(self, message):
+        """ Add event to the log and wake up waiting clients
+        :param message: dictionary with 'msg_type' key, e.g.
+                {'msg_type': 'LOCK_UPDATE', 'slot': 1, 'used_by': None}
+        :return: event, tuple (id, msg_type, JSON string)
+        """
+        self.last_id += 1
+        event = (self.last_id, message['msg_type'], json.dumps(message))
+        self.events.append(event)
+        max_size = self.max_size or options.events_log_size
+        while len(self.events) > max_size:
+            self.events.popleft()
+        self._condition.notify_all()
+        return event
+
+    def since(self, last_id):
+        """ Get events published after the specified one
+        :param last_id: id of the last event received by client
+        :return: list of events, or None if some of them are not in the log
+                anymore (or last_id is unknown, e.g. after server restart)
+        """
+        if last_id is None or last_id > self.last_id:
+            return None
+        if not self.events or last_id == self.last_id:
+            return []
+        first_id = self.events[0][0]
+        if last_id < first_id - 1:
+            return None
+        return list(itertools.islice(
+            self.events, last_id - first_id + 1, None))
+
+    def wait(self, timeout=None):
+        """ Wait for the next event
+        :param timeout: seconds, default is options.events_keepalive
+        :return: Future resolving to True if event was published, False on
+                timeout
+        """
+        if timeout is None:
+            timeout = options.events_keepalive
+        return self._condition.wait(datetime.timedelta(seconds=timeout))
+
+
+def format_event(event_id, msg_type, data):
+    """ Format event as text/event-stream message """
+    return "id: {0}\nevent: {1}\ndata: {2}\n\n".format(
+        event_id, msg_type, data)
+
+
+log = EventLog()
@@ -8,18 +8,35 @@ Protocol specification can be found here:
 http://www.ivifoundation.org/downloads/Class%20Specifications/IVI-6.1_HiSLIP-1.1-2011-02-24.pdf
 """
 
+import datetime
+import logging
+import re
 import struct
 
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.locks
 import tornado.tcpserver
 from tornado.options import options, define
 
-# from easy_phi import hwal
+from easy_phi import hwconf, utils
 
 # timeout on network communications in seconds
 # since all messages are less than 500b, 1 second should be more than enough
 # bigger timeout allows to DDOS system by slow connections
 define('hislip_timeout', 1)
 define('hislip_max_message_size', 4096)
+# max size of command sent in a series of Data messages
+define('hislip_max_command_size', 65536)
+
+# HiSLIP 1.1, upper byte is major version, lower byte is minor version
+PROTOCOL_VERSION = 0x0101
+# two ASCII characters identifying server vendor
+VENDOR_ID = 'EP'
+# message header: prologue, type, control code, parameter, payload length.
+# Fields are in network (big endian) byte order, without alignment
+HEADER = struct.Struct('>2sBBIQ')
 
 
 class HiSLIPMessageCodes(object):
@@ -55,12 +72,23 @@ class HiSLIPMessageCodes(object):
 
 
 class HiSLIPErrorCodes(object):
-    """Class to store constant values of HiSLIP error codes """
+    """Class to store constant values of HiSLIP fatal error codes """
     UndefinedError = 0
     PoorlyFormedMessageHeader = 1
-    AttemptToUseConnWithoutBothChannelsEstablished = 0
-    InvalidInitializationSequence = 0
-    MaxClientsExceeded = 0
+    AttemptToUseConnWithoutBothChannelsEstablished = 2
+    InvalidInitializationSequence = 3
+    MaxClientsExceeded = 4
+    # 5..127 reserved for HiSLIP extensions
+    # 128..255 Device-defined errors
+
+
+class HiSLIPNonFatalErrorCodes(object):
+    """Class to store constant values of HiSLIP non-fatal error codes """
+    UndefinedError = 0
+    UnrecognizedMessageType = 1
+    UnrecognizedControlCode = 2
+    UnrecognizedVendorDefinedMessage = 3
+    MessageTooLarge = 4
     # 5..127 reserved for HiSLIP extensions
     # 128..255 Device-defined errors
 
@@ -69,6 +97,16 @@ class HiSLIPBadMessage(IOError):
     """Exception to indicate malformed message"""
 
 
+class HiSLIPMessageTooLarge(HiSLIPBadMessage):
+    """Exception to indicate message exceeding max message size. Its payload
+    is discarded, so connection can be used further"""
+
+    def __init__(self, message, mtype=None):
+        super(HiSLIPMessageTooLarge, self).__init__(message)
+        # type of discarded message
+        self.mtype = mtype
+
+
 class HiSLIPCommError(IOError):
     """Exception to indicate communication issues, such as timeout"""
 
@@ -83,14 +121,14 @@ class HiSLIPMessage(object):
           bytes
     8: 8: payload length
     16: <>: payload
+
+    Payload might be a string or memoryview, e.g. a slice of a bigger buffer,
+    so large transfers are encoded and decoded without copying.
     """
-    type = 0  # 1 byte, subset of HiSLIPMessageCodes properties
-    control_code = 0
-    parameter = 0
-    payload = ''
+    __slots__ = ('type', 'control_code', 'parameter', 'payload')
 
     def __init__(self, mtype, control_code=0, parameter=0, payload=''):
-        self.type = mtype
+        self.type = mtype  # 1 byte, subset of HiSLIPMessageCodes properties
         self.control_code = control_code
         self.parameter = parameter
         self.payload = payload
@@ -121,46 +159,284 @@ class HiSLIPMessage(object):
                          ((word & 0xffff) << 16)
 
     @staticmethod
+    @tornado.gen.coroutine
     def from_stream(stream):
         """ Parse message from IOStream
         :param stream: tornado.iostream.IOStream instance
+        :return: Future resolving to HiSLIPMessage
         """
-        # TODO: use futures. Actually, just copy from parsing HTTP message
-        header = stream.read_bytes(16)
+        header = yield stream.read_bytes(HEADER.size)
 
         # these exceptions should be handled by caller to return corresponding
         # error message or close connection
-        if len(header) < 16:
-            raise HiSLIPCommError('HiSLIP communication timeout')
-        if header[0:2] != b'HS':
+        prologue, mtype, control_code, parameter, payload_length = \
+            HEADER.unpack_from(header)
+        if prologue != b'HS':
             raise HiSLIPBadMessage('Poorly formed message header')
 
-        mtype, control_code, parameter, payload_length = \
-            struct.unpack('bbIQ', header)
+        too_large = payload_length > options.hislip_max_message_size
+        payload = ''
+        if payload_length:
+            # header is received, so client is not idle anymore
+            try:
+                payload = yield tornado.gen.with_timeout(
+                    datetime.timedelta(seconds=options.hislip_timeout),
+                    stream.read_bytes(
+                        payload_length,
+                        # skip payload of too large message without buffering
+                        streaming_callback=(lambda chunk: None)
+                        if too_large else None))
+            except tornado.gen.TimeoutError:
+                raise HiSLIPCommError('HiSLIP communication timeout')
+        if too_large:
+            raise HiSLIPMessageTooLarge(
+                'HiSLIP message exceeds max allowed size', mtype)
+
+        raise tornado.gen.Return(
+            HiSLIPMessage(mtype, control_code, parameter, payload))
 
-        if payload_length > options.hislip_max_message_size:
-            raise HiSLIPBadMessage('HiSLIP message exceeds max allowed size')
+    @staticmethod
+    def unpack_from(buf, offset=0):
+        """ Parse message from buffer
+        :param buf: string, bytearray, mmap or other object supporting buffer
+                protocol
+               offset: position of the message in the buffer
+        :return: tuple (HiSLIPMessage, offset of the next message). Payload is
+                memoryview of the buffer, i.e. it is not copied
+        """
+        if len(buf) - offset < HEADER.size:
+            raise HiSLIPBadMessage('Incomplete message header')
+        prologue, mtype, control_code, parameter, payload_length = \
+            HEADER.unpack_from(buf, offset)
+        if prologue != b'HS':
+            raise HiSLIPBadMessage('Poorly formed message header')
+        start = offset + HEADER.size
+        end = start + payload_length
+        if end > len(buf):
+            raise HiSLIPBadMessage('Incomplete message payload')
+        payload = memoryview(buf)[start:end]
+        return HiSLIPMessage(mtype, control_code, parameter, payload), end
+
+    def pack_header(self):
+        return HEADER.pack(b'HS', self.type, self.control_code,
+                           self.parameter, len(self.payload))
+
+    def pack_into(self, buf, offset=0):
+        """ Serialize message into writable buffer
+        :param buf: bytearray, mmap or other writable buffer big enough to
+                fit the message
+               offset: position in the buffer to write message to
+        :return: offset after the message
+        """
+        HEADER.pack_into(buf, offset, b'HS', self.type, self.control_code,
+                         self.parameter, len(self.payload))
+        start = offset + HEADER.size
+        end = start + len(self.payload)
+        buf[start:end] = self.payload
+        return end
+
+    def write_to(self, stream):
+        """ Send message to IOStream. Header and payload are written
+        separately, so payload (e.g. memoryview slice of a bigger response)
+        is only copied into stream write buffer
+        :return: Future resolving when message is sent
+        """
+        future = stream.write(self.pack_header())
+        if not len(self.payload):
+            return future
+        return stream.write(self.payload)
 
-        payload = stream.read_bytes(payload_length)
+    def __len__(self):
+        return HEADER.size + len(self.payload)
 
-        if len(payload) < payload_length:
-            raise HiSLIPCommError('HiSLIP communication timeout')
+    def __str__(self):
+        buf = bytearray(len(self))
+        self.pack_into(buf)
+        return bytes(buf)
+
+
+def fragment(message_id, payload, max_message_size):
+    """ Split response into sequence of Data messages terminated by DataEnd,
+    so none of them exceeds max message size negotiated by client
+    :param message_id: id of the message being responded to
+           payload: string or memoryview
+           max_message_size: max size of message, including header
+    :return: generator of HiSLIPMessage, payloads are memoryview slices
+    """
+    view = memoryview(payload)
+    chunk_size = max(1, max_message_size - HEADER.size)
+    start = 0
+    while len(view) - start > chunk_size:
+        yield HiSLIPMessage(HiSLIPMessageCodes.Data, 0, message_id,
+                            view[start:start + chunk_size])
+        start += chunk_size
+    yield HiSLIPMessage(HiSLIPMessageCodes.DataEnd, 0, message_id,
+                        view[start:])
+
+
+class HiSLIPSession(object):
+    """ HiSLIP client session, i.e. pair of synchronous and asynchronous
+    connections. Commands are accepted on synchronous channel, asynchronous
+    channel is used for locks, status queries and device clear.
+    """
+    async_stream = None
+    # session holds exclusive lock of the module
+    exclusive_lock = False
+    # lock string of shared lock held by session, None if there is no lock
+    shared_lock = None
 
-        return HiSLIPMessage(mtype, control_code, parameter, payload)
+    def __init__(self, session_id, slot, sync_stream):
+        """
+        :param session_id: 16 bit session id
+               slot: slot of the module this session is connected to
+               sync_stream: tornado.iostream.IOStream of synchronous channel
+        """
+        self.id = session_id
+        self.slot = slot
+        self.sync_stream = sync_stream
+        # max size of message client is willing to accept
+        self.max_message_size = options.hislip_max_message_size
+        # payload of Data messages, until DataEnd is received. None if
+        # command is too large, i.e. the rest of it is discarded
+        self.data = []
+        self.data_size = 0
 
-    def __str__(self):
-        return struct.pack('bbIQ', self.type, self.control_code,
-                           self.parameter, len(self.payload)) + self.payload
+    @property
+    def locked(self):
+        return self.exclusive_lock or self.shared_lock is not None
 
-# context:
-# protocol version
-# message id
-# session id if async not established yet
+    def close(self):
+        self.sync_stream.close()
+        if self.async_stream is not None:
+            self.async_stream.close()
+
+
+def format_response(result):
+    """ Convert module.scpi() result to HiSLIP response payload
+    :param result: string, list of strings, number or memoryview of binary
+            block payload
+    :return: bytes (bytearray for binary block), terminated by newline
+    """
+    if isinstance(result, memoryview):
+        length = str(len(result))
+        header = "#{0}{1}".format(len(length), length)
+        # block payload is copied once, into preallocated response
+        response = bytearray(len(header) + len(result) + 1)
+        response[:len(header)] = header
+        response[len(header):-1] = result
+        response[-1:] = "\n"
+        return response
+    if isinstance(result, list):
+        result = ";".join(str(item) for item in result)
+    return str(result) + "\n"
 
 
 class HiSLIPServer(tornado.tcpserver.TCPServer):
-    _connections = {}
+    """ HiSLIP server, sub-address hislip<N> is mapped to module in slot N.
+    Default sub-address hislip0 is broadcast module, i.e. all modules.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(HiSLIPServer, self).__init__(*args, **kwargs)
+        self.sessions = {}  # session id: HiSLIPSession
+        self._last_session_id = 0
+        # notified when lock is released, to wake up sessions waiting for it
+        self._lock_released = tornado.locks.Condition()
+
+    def _new_session_id(self):
+        """ Get unused 16 bit session id
+        :return: session id, None if all session ids are used
+        """
+        for _ in range(0x10000):
+            self._last_session_id = (self._last_session_id + 1) & 0xffff
+            if self._last_session_id not in self.sessions:
+                return self._last_session_id
+        return None
+
+    def _other_sessions(self, session):
+        """ Sessions connected to the same module """
+        return [other for other in self.sessions.values()
+                if other is not session and other.slot == session.slot]
+
+    def lock_available(self, session, lock_string):
+        """ Check if session can be granted a lock
+        :param lock_string: empty string for exclusive lock, otherwise name
+                of shared lock. Sessions using the same name share the lock
+        :return: boolean
+        """
+        others = self._other_sessions(session)
+        if not lock_string:
+            return not any(other.locked for other in others)
+        return not any(other.exclusive_lock or other.shared_lock not in
+                       (None, lock_string) for other in others)
+
+    @tornado.gen.coroutine
+    def acquire_lock(self, session, lock_string, timeout):
+        """ Lock module for session, waiting for other sessions to release
+        their locks
+        :param lock_string: see lock_available()
+               timeout: max time to wait for lock, seconds
+        :return: Future resolving to True if lock is granted, False if it
+                is held by another session after timeout
+        """
+        io_loop = tornado.ioloop.IOLoop.current()
+        deadline = io_loop.time() + timeout
+        while not self.lock_available(session, lock_string):
+            remaining = deadline - io_loop.time()
+            if remaining <= 0:
+                raise tornado.gen.Return(False)
+            yield self._lock_released.wait(
+                datetime.timedelta(seconds=remaining))
+        if lock_string:
+            session.shared_lock = lock_string
+        else:
+            session.exclusive_lock = True
+        raise tornado.gen.Return(True)
+
+    def release_lock(self, session):
+        """ Release lock held by session
+        :return: 1 if exclusive lock was released, 2 for shared lock, 3 if
+                session had no lock. These are AsyncLockResponse codes
+        """
+        if session.exclusive_lock:
+            code = 1
+            session.exclusive_lock = False
+        elif session.shared_lock is not None:
+            code = 2
+            session.shared_lock = None
+        else:
+            return 3
+        self._lock_released.notify_all()
+        return code
 
+    @staticmethod
+    def send(stream, mtype, control_code=0, parameter=0, payload=''):
+        return HiSLIPMessage(
+            mtype, control_code, parameter, payload).write_to(stream)
+
+    @staticmethod
+    def send_data(session, message_id, payload):
+        """ Send response, split into multiple messages if it exceeds
+        max message size negotiated by client
+        :return: Future resolving when the last message is sent
+        """
+        future = None
+        for message in fragment(message_id, payload,
+                                session.max_message_size):
+            future = message.write_to(session.sync_stream)
+        return future
+
+    @tornado.gen.coroutine
+    def fatal_error(self, stream, code, message):
+        """ Send FatalError message and close connection """
+        try:
+            yield self.send(stream, HiSLIPMessageCodes.FatalError, code,
+                            payload=message)
+        except tornado.iostream.StreamClosedError:
+            pass
+        stream.close()
+
+    @tornado.gen.coroutine
     def handle_stream(self, stream, address):
         """
         :param stream: tornado.iostream.IOStream instance. We need to write
@@ -168,9 +444,241 @@ class HiSLIPServer(tornado.tcpserver.TCPServer):
         :param address: remote address. It is not important for us
         :return: None
         """
-
-        # if it is sync
-        #   create new connection, passing stream in parameters
-        #   add to connection pool
-        #   start serving (actually, wait for async conn)
-        # if it is async, find corresponding sync connection and assign pair
+        # the first message defines channel type (sync or async)
+        try:
+            message = yield tornado.gen.with_timeout(
+                datetime.timedelta(seconds=options.hislip_timeout),
+                HiSLIPMessage.from_stream(stream))
+        except HiSLIPBadMessage as err:
+            yield self.fatal_error(
+                stream, HiSLIPErrorCodes.PoorlyFormedMessageHeader, str(err))
+            return
+        except (tornado.gen.TimeoutError, tornado.iostream.StreamClosedError,
+                HiSLIPCommError):
+            stream.close()
+            return
+
+        if message.type == HiSLIPMessageCodes.Initialize:
+            yield self.serve_sync(stream, message)
+        elif message.type == HiSLIPMessageCodes.AsyncInitialize:
+            yield self.serve_async(stream, message)
+        else:
+            yield self.fatal_error(
+                stream, HiSLIPErrorCodes.InvalidInitializationSequence,
+                'Initialize or AsyncInitialize expected')
+
+    @tornado.gen.coroutine
+    def serve_sync(self, stream, message):
+        """ Serve synchronous channel, starting from Initialize message """
+        match = re.match(r'hislip(\d+)$', message.payload or 'hislip0')
+        session_id = self._new_session_id()
+        if match is None:
+            yield self.fatal_error(stream, HiSLIPErrorCodes.UndefinedError,
+                                   'Unknown sub-address')
+            return
+        if session_id is None:
+            yield self.fatal_error(stream, HiSLIPErrorCodes.MaxClientsExceeded,
+                                   'Max number of clients exceeded')
+            return
+
+        session = HiSLIPSession(session_id, int(match.group(1)), stream)
+        self.sessions[session_id] = session
+        try:
+            # control code 0: synchronized mode, i.e. no overlapping commands
+            yield self.send(stream, HiSLIPMessageCodes.InitializeResponse,
+                            parameter=(PROTOCOL_VERSION << 16) | session_id)
+            while True:
+                try:
+                    # no timeout, client might stay idle for a long time
+                    message = yield HiSLIPMessage.from_stream(stream)
+                except HiSLIPMessageTooLarge as err:
+                    # command is incomplete, discard the rest of it
+                    session.data = None \
+                        if err.mtype == HiSLIPMessageCodes.Data else []
+                    session.data_size = 0
+                    yield self.send(
+                        stream, HiSLIPMessageCodes.Error,
+                        HiSLIPNonFatalErrorCodes.MessageTooLarge,
+                        payload=str(err))
+                    continue
+                yield self.handle_sync_message(session, message)
+        except HiSLIPBadMessage as err:
+            yield self.fatal_error(
+                stream, HiSLIPErrorCodes.PoorlyFormedMessageHeader, str(err))
+        except (tornado.iostream.StreamClosedError, HiSLIPCommError):
+            pass
+        finally:
+            del self.sessions[session_id]
+            self.release_lock(session)
+            session.close()
+
+    @tornado.gen.coroutine
+    def handle_sync_message(self, session, message):
+        stream = session.sync_stream
+        if session.async_stream is None:
+            yield self.fatal_error(
+                stream,
+                HiSLIPErrorCodes.AttemptToUseConnWithoutBothChannelsEstablished,
+                'Asynchronous channel is not established')
+            return
+
+        if message.type in (HiSLIPMessageCodes.Data,
+                            HiSLIPMessageCodes.DataEnd):
+            if session.data is not None:  # None: rest of too large command
+                session.data.append(message.payload)
+                session.data_size += len(message.payload)
+                if session.data_size > options.hislip_max_command_size:
+                    session.data = None
+                    yield self.send(
+                        stream, HiSLIPMessageCodes.Error,
+                        HiSLIPNonFatalErrorCodes.MessageTooLarge,
+                        payload='HiSLIP command exceeds max allowed size')
+            if message.type == HiSLIPMessageCodes.DataEnd:
+                data = session.data
+                session.data = []
+                session.data_size = 0
+                if data is not None:
+                    yield self.execute(session, "".join(data),
+                                       message.parameter)
+        elif message.type == HiSLIPMessageCodes.DeviceClearComplete:
+            session.data = []
+            session.data_size = 0
+            yield self.send(stream, HiSLIPMessageCodes.DeviceClearAcknowledge)
+        elif message.type == HiSLIPMessageCodes.Trigger:
+            pass  # modules don't support triggers
+        else:
+            yield self.send(
+                stream, HiSLIPMessageCodes.Error,
+                HiSLIPNonFatalErrorCodes.UnrecognizedMessageType,
+                payload='Unrecognized message type')
+
+    @tornado.gen.coroutine
+    def execute(self, session, command, message_id):
+        """ Send command to the module and respond with DataEnd message,
+        if command is a query """
+        slot = session.slot
+        module = None
+        if slot < len(hwconf.modules):
+            module = hwconf.modules[slot]
+        if module is None:
+            yield self.send(session.sync_stream, HiSLIPMessageCodes.Error,
+                            HiSLIPNonFatalErrorCodes.UndefinedError,
+                            payload='Selected slot is empty')
+            return
+        # HiSLIP clients are anonymous, so they can't use modules locked
+        # through web API. Broadcast module (slot 0) can't be locked
+        if slot and getattr(module, 'used_by', None) is not None:
+            yield self.send(session.sync_stream, HiSLIPMessageCodes.Error,
+                            HiSLIPNonFatalErrorCodes.UndefinedError,
+                            payload='Module is used by {0}'.format(
+                                module.used_by))
+            return
+        if any(other.exclusive_lock
+               for other in self._other_sessions(session)):
+            yield self.send(session.sync_stream, HiSLIPMessageCodes.Error,
+                            HiSLIPNonFatalErrorCodes.UndefinedError,
+                            payload='Module is locked by another session')
+            return
+
+        try:
+            result = yield tornado.gen.maybe_future(module.scpi(command))
+        except tornado.iostream.StreamClosedError:
+            yield self.send(session.sync_stream, HiSLIPMessageCodes.Error,
+                            HiSLIPNonFatalErrorCodes.UndefinedError,
+                            payload='Module was disconnected')
+            return
+        except Exception:
+            logging.exception("SCPI command %r failed", command)
+            yield self.send(session.sync_stream, HiSLIPMessageCodes.Error,
+                            HiSLIPNonFatalErrorCodes.UndefinedError,
+                            payload='SCPI command failed')
+            return
+
+        if any(utils.is_query(cmd)
+               for cmd in utils.split_compound_command(command)):
+            yield self.send_data(session, message_id, format_response(result))
+
+    @tornado.gen.coroutine
+    def serve_async(self, stream, message):
+        """ Serve asynchronous channel, starting from AsyncInitialize """
+        session = self.sessions.get(message.parameter_lword)
+        if session is None or session.async_stream is not None:
+            yield self.fatal_error(
+                stream, HiSLIPErrorCodes.InvalidInitializationSequence,
+                'Unknown session id')
+            return
+
+        session.async_stream = stream
+        vendor_id = struct.unpack('>H', VENDOR_ID)[0]
+        try:
+            yield self.send(stream, HiSLIPMessageCodes.AsyncInitializeResponse,
+                            parameter=vendor_id)
+            while True:
+                try:
+                    message = yield HiSLIPMessage.from_stream(stream)
+                except HiSLIPMessageTooLarge as err:
+                    yield self.send(
+                        stream, HiSLIPMessageCodes.Error,
+                        HiSLIPNonFatalErrorCodes.MessageTooLarge,
+                        payload=str(err))
+                    continue
+                yield self.handle_async_message(session, message)
+        except HiSLIPBadMessage as err:
+            yield self.fatal_error(
+                stream, HiSLIPErrorCodes.PoorlyFormedMessageHeader, str(err))
+        except (tornado.iostream.StreamClosedError, HiSLIPCommError):
+            pass
+        finally:
+            # sync channel is useless without async one
+            session.close()
+
+    @tornado.gen.coroutine
+    def handle_async_message(self, session, message):
+        stream = session.async_stream
+        codes = HiSLIPMessageCodes
+        if message.type == codes.AsyncMaximumMessageSize:
+            if len(message.payload) != 8:
+                yield self.fatal_error(
+                    stream, HiSLIPErrorCodes.PoorlyFormedMessageHeader,
+                    'Max message size expected as 8 bytes integer')
+                return
+            session.max_message_size = struct.unpack('>Q', message.payload)[0]
+            yield self.send(stream, codes.AsyncMaximumMessageSizeResponse,
+                            payload=struct.pack(
+                                '>Q', options.hislip_max_message_size))
+        elif message.type == codes.AsyncLock:
+            if message.control_code == 1:  # request
+                # parameter is timeout in milliseconds, payload is lock
+                # string: empty for exclusive lock, or name of shared lock.
+                # Response: 1 - success, 0 - failure (locked by another
+                # session), 3 - error (session already has a lock)
+                if session.locked:
+                    code = 3
+                else:
+                    granted = yield self.acquire_lock(
+                        session, bytes(message.payload),
+                        message.parameter / 1000.0)
+                    code = int(granted)
+            else:  # release: 1 - exclusive, 2 - shared, 3 - error (no lock)
+                code = self.release_lock(session)
+            yield self.send(stream, codes.AsyncLockResponse, code)
+        elif message.type == codes.AsyncLockInfo:
+            # control code: exclusive lock is granted, parameter: number of
+            # sessions holding locks
+            sessions = [other for other in self.sessions.values()
+                        if other.slot == session.slot and other.locked]
+            yield self.send(stream, codes.AsynchLockInfoResponse,
+                            int(any(other.exclusive_lock
+                                    for other in sessions)),
+                            len(sessions))
+        elif message.type == codes.AsyncStatusQuery:
+            yield self.send(stream, codes.AsyncStatusResponse, 0)
+        elif message.type == codes.AsyncDeviceClear:
+            yield self.send(stream, codes.AsyncDeviceClearAcknowledge, 0)
+        elif message.type == codes.AsyncRemoteLocalControl:
+            yield self.send(stream, codes.AsyncRemoteLocalResponse)
+        else:
+            yield self.send(
+                stream, codes.Error,
+                HiSLIPNonFatalErrorCodes.UnrecognizedMessageType,
+                payload='Unrecognized message type')
@@ -7,8 +7,14 @@ by broadcast module. These are special SCPI commands returning platform-levevl
 information about the system, such as number of available slots.
 """
 
-import serial
+import collections
 import datetime
+import errno
+import os
+import time
+
+import concurrent.futures
+import serial
 
 from tornado.options import options, define
 import tornado.gen
@@ -21,6 +27,29 @@ from easy_phi import utils
 
 define("serial_port_timeout", default=2)
 define("serial_port_baudrate", default=9600)
+# max number of commands sent to a module before the first one is answered
+define("serial_pipeline_depth", default=8)
+# append *OPC? to commands which produce no output and wait for completion
+define("scpi_opc_handshake", default=False)
+# max size of serial receive buffer, bytes, and what to do if a module sends
+# more than that without delimiter: 'flush' pending data to data callback as
+# if it was a complete line, or 'drop' oldest bytes
+define("serial_buffer_size", default=65536)
+define("serial_buffer_overflow", default='flush')
+# max size of IEEE 488.2 binary block received from serial port, bytes.
+# Incomplete block of announced size up to this limit does not overflow
+# receive buffer. Bigger blocks are handled as text
+define("serial_max_block_size", default=16 * 1024 * 1024)
+# USBTMC messages are delimited by device, timeout is only a safety net
+define("usbtmc_timeout", default=5)
+# bytes requested from USBTMC device per read(). Bigger chunks mean less
+# bulk transfer requests for big responses, e.g. waveforms. Binary blocks of
+# definite length bigger than that are completed by subsequent reads
+define("usbtmc_read_chunk_size", default=1024 * 1024)
+# seconds to answer cacheable queries from memory (see StateMirror).
+# Front panel or another SCPI client may change module state, so cached
+# values are refreshed from the device at least this often. 0 to disable
+define("state_mirror_ttl", default=60)
 
 
 class AbstractMeasurementModule(object):
@@ -31,11 +60,46 @@ class AbstractMeasurementModule(object):
 
     name = "Abstract module"
     lock = None
-
-    def __init__(self, device, data_callback=None):
-        """ Initialize module object with pyudev.Device object """
+    # queries which can be answered from module state mirror
+    cacheable_queries = ()
+    # (mod_conf_patch.version, tuple of supported commands)
+    _configuration = None
+    # time.time() of the last write to the device. It is used by broadcast
+    # module to measure skew between slots
+    last_write_time = None
+
+    def __init__(self, device, data_callback=None, name=None, patch=None):
+        """ Initialize module object with pyudev.Device object
+        :param device: pyudev.Device instance
+               data_callback: callable to receive data sent by module without
+                    request
+               name: module name, if known. Modules which have to ask device
+                    for its name (i.e. perform blocking I/O) will skip it
+               patch: configuration patch of device, as returned by
+                    mod_conf_patch.get_patch(). hwconf.py resolves it on
+                    IOLoop thread at attach time; if not provided, it is
+                    resolved here
+        """
         self.device = device
         self.lock = tornado.locks.Lock()
+        if name is not None:
+            self.name = name
+        if device is not None:
+            if patch is None:
+                patch = mod_conf_patch.get_patch(device)
+            self._configuration = patch[:2]
+            self.cacheable_queries = patch[2]
+
+    def start(self):
+        """ Start asynchronous communication with the device.
+        Unlike __init__(), which might be called on a worker thread, this
+        method is always called on IOLoop thread
+        """
+        pass
+
+    def stop(self):
+        """ Release device resources, called when module is removed """
+        pass
 
     @staticmethod
     def is_instance(device):
@@ -47,17 +111,25 @@ class AbstractMeasurementModule(object):
 
     def scpi(self, command):
         """Send SCPI command to device
-        Note that all subclusses are responsible of handling self.lock to
-        prevent concurrent operations
+        Note that all subclusses are responsible of handling self.lock (or
+        other means of synchronization) to prevent concurrent operations from
+        mixing up responses
         """
         raise NotImplementedError
 
     def get_configuration(self):
         """ Get module configuration.
         Configuration format is still under discussion, but likely it will
-        be represented by hierarchy of available SCPI commands """
+        be represented by hierarchy of available SCPI commands.
+        Configuration is resolved once and kept until configuration patches
+        are reloaded
+        :return: tuple of supported commands
+        """
         # TODO: use SYSTem:HELP? and SYSTem:HELP:SYNTax? <command header>
-        return mod_conf_patch.get_configuration_patch(self.device)
+        if self._configuration is None or \
+                self._configuration[0] != mod_conf_patch.version:
+            self._configuration = mod_conf_patch.get_patch(self.device)[:2]
+        return self._configuration[1]
 
     def __str__(self):
         return self.name
@@ -66,26 +138,235 @@ class AbstractMeasurementModule(object):
         return self.name.decode()
 
 
-class SerialStream(tornado.iostream.BaseIOStream):
+class ReceiveBuffer(object):
+    """ Bounded buffer for data received from serial port
+    Data is stored in a bytearray, consumed bytes are only discarded when
+    they take more than a half of it, so every byte is copied amortized
+    constant number of times. Delimiter is searched only in bytes received
+    since the last search.
+    """
+    # incomplete binary block is being received
+    _block_pending = False
+    # last message was a binary block, so blank line is its terminator
+    _after_block = False
+    # offset to continue search of pending indefinite length block end from
+    _block_scan = 0
+
+    def __init__(self, delimiter, max_size, max_block_size=0):
+        self.delimiter = delimiter
+        self.max_size = max_size
+        self.max_block_size = max_block_size
+        self._data = bytearray()
+        self._start = 0  # offset of the first unconsumed byte
+        self._scan = 0  # offset to continue delimiter search from
+
+    def __len__(self):
+        return len(self._data) - self._start
+
+    def extend(self, chunk):
+        self._data += chunk
+
+    def lines(self):
+        """ Generator of complete messages received so far: lines without
+        delimiter, or memoryview of IEEE 488.2 binary block payload """
+        self._block_pending = False
+        while True:
+            block = utils.parse_block(self._data, self._start,
+                                      scan=self._block_scan)
+            if block is not None:
+                payload_start, payload_end, end = block
+                if end is not None:
+                    # copy, because buffer can't be resized while exported
+                    payload = bytes(self._data[payload_start:payload_end])
+                    self._start = self._scan = end
+                    self._block_scan = 0
+                    self._after_block = True
+                    yield memoryview(payload)
+                    continue
+                # incomplete block. Data might contain delimiters, so wait
+                # for the rest, unless block is too big
+                size = (payload_end or len(self._data)) - self._start
+                if size <= self.max_block_size:
+                    self._block_pending = True
+                    if payload_end is None:  # no newline received so far
+                        self._block_scan = len(self._data)
+                    break
+
+            pos = self._data.find(self.delimiter, self._scan)
+            if pos < 0:
+                # delimiter might be split between this and the next chunk
+                self._scan = max(
+                    self._start, len(self._data) - len(self.delimiter) + 1)
+                break
+            line = bytes(self._data[self._start:pos])
+            self._start = self._scan = pos + len(self.delimiter)
+            self._block_scan = 0
+            if self._after_block and not line.strip():
+                continue  # terminator received after block payload
+            self._after_block = False
+            yield line
+        self._compact()
+
+    def overflow(self):
+        """ Check if incomplete line exceeds buffer size """
+        return not self._block_pending and len(self) > self.max_size
+
+    def take(self):
+        """ Return all pending data and clear the buffer """
+        data = bytes(self._data[self._start:])
+        self.drop(len(self))
+        return data
+
+    def drop(self, size):
+        """ Discard size oldest bytes """
+        self._start = min(self._start + size, len(self._data))
+        self._scan = max(self._scan, self._start)
+        self._block_scan = 0
+        self._compact()
+
+    def _compact(self):
+        if self._start * 2 >= len(self._data):
+            del self._data[:self._start]
+            self._scan -= self._start
+            self._block_scan = max(self._block_scan - self._start, 0)
+            self._start = 0
+
+
+class MessageStream(tornado.iostream.BaseIOStream):
+    """ Base class for streams of messages from device
+    Messages are returned to pending read_message() calls in FIFO order.
+    Messages received when nothing is pending are passed to data callback.
+    Subclasses split incoming data into messages and call _handle_message()
+    """
+    _timeout_handler = None
+    _data_callback = None
+    # timeout of resynchronization, see _handle_timeout(). Messages are
+    # discarded while it is set
+    _sync_timeout_handler = None
+    # command completing resynchronization and its response
+    sync_command = "*OPC?"
+    sync_response = "1"
+
+    def __init__(self, data_callback=None, *args, **kwargs):
+        super(MessageStream, self).__init__(*args, **kwargs)
+        self._data_callback = data_callback
+        # futures waiting for messages, in order of commands written.
+        # Only the head of the queue has timeout armed: responses of pipelined
+        # commands can't arrive before response to the first one
+        self._pending = collections.deque()
+
+    def _handle_message(self, message):
+        if self._sync_timeout_handler is not None:
+            # late responses to commands written before synchronization
+            if not isinstance(message, memoryview) and \
+                    message.strip() == self.sync_response:
+                self._end_sync()
+            return
+        if self._pending:  # called read_message()
+            self._resolve_future(message)
+        elif self._data_callback is not None:
+            self._data_callback(message)
+
+    def _resolve_future(self, message):
+        """ Complete the oldest pending read_message()
+        - set future result
+        - remove timeout and arm it for the next pending read, if any
+        """
+        assert self._pending, "can't complete without future"
+        future = self._pending.popleft()
+        if self._timeout_handler is not None:
+            self.io_loop.remove_timeout(self._timeout_handler)
+            self._timeout_handler = None
+        if self._pending:
+            self._set_timeout()
+        future.set_result(message)
+
+    def _set_timeout(self):
+        self._timeout_handler = self.io_loop.add_timeout(
+            datetime.timedelta(seconds=self.read_timeout()),
+            self._handle_timeout)
+
+    def _handle_timeout(self):
+        """ Force complete read by timeout, returning whatever was received
+        Response might still arrive and would be taken for response to the
+        next command. So reads of all commands written so far are completed
+        as well, and their output is discarded until device answers
+        synchronization command, which is written after them
+        """
+        self._timeout_handler = None
+        pending, self._pending = self._pending, collections.deque()
+        pending.popleft().set_result(self.take_partial())
+        for future in pending:
+            future.set_result("")
+        if self.closed():
+            return
+        if self._sync_timeout_handler is not None:
+            self.io_loop.remove_timeout(self._sync_timeout_handler)
+        # device might not support synchronization command, so give up
+        # waiting after a while
+        self._sync_timeout_handler = self.io_loop.add_timeout(
+            datetime.timedelta(seconds=self.read_timeout()), self._end_sync)
+        try:
+            self.write(self.sync_command + "\n")
+        except tornado.iostream.StreamClosedError:
+            self._end_sync()
+        else:
+            self._read_requested()
+
+    def _end_sync(self):
+        if self._sync_timeout_handler is not None:
+            self.io_loop.remove_timeout(self._sync_timeout_handler)
+            self._sync_timeout_handler = None
+
+    def _read_requested(self):
+        """ Called when a message is expected from device. Streams which
+        are not read continuously start reading here """
+        pass
+
+    def read_timeout(self):
+        """ Return max time to wait for a message, seconds """
+        raise NotImplementedError
+
+    def take_partial(self):
+        """ Return incomplete message received so far and discard it """
+        raise NotImplementedError
+
+    def read_message(self):
+        """ Read a single message with timeout
+        Reads are queued, i.e. it is safe to call it again before the previous
+        call returned. Messages are returned in FIFO order.
+        Timeout is counted from the moment previous message was received or
+        timed out.
+        """
+        future = tornado.concurrent.TracebackFuture()
+        self._pending.append(future)
+        if len(self._pending) == 1:
+            self._set_timeout()
+        self._read_requested()
+        return future
+
+    def connect(self, *args, **kwargs):
+        """ Trap to check that no legacy code uses this method """
+        raise NotImplementedError
+
+
+class SerialStream(MessageStream):
     """ Adaption of tornado.iostream.IOStream from sockets to searial port
 
     Before changing anything here, please look carefully at code of classes
     mentioned in this article:
     http://golubenco.org/understanding-the-code-inside-tornado-the-asynchronous-web-server-powering-friendfeed.html
     """
-    _timeout_handler = None
-    _data_callback = None
     serial = None
 
     # note that self.buffer is different from self._read_buffer
     # we'll use streaming callback, so _read_buffer will remain empty
-    buffer = ''
+    buffer = None
 
     def __init__(self, port, data_callback=None, *args, **kwargs):
         self.serial = port
         self.serial.timeout = 0
-        super(SerialStream, self).__init__(*args, **kwargs)
-        self._data_callback = data_callback
+        super(SerialStream, self).__init__(data_callback, *args, **kwargs)
 
     def start(self, delimiter="\r"):
         """This class represents data communication with serial device.
@@ -100,44 +381,41 @@ class SerialStream(tornado.iostream.BaseIOStream):
             - previous command generates constant stream of data
             -
         """
-        self._read_delimiter = delimiter
+        self.buffer = ReceiveBuffer(delimiter, options.serial_buffer_size,
+                                    options.serial_max_block_size)
         self.read_until_close(streaming_callback=self._handle_chunk)
 
     def _handle_chunk(self, chunk):
-        self.buffer += chunk
-        if self.buffer.endswith(self._read_delimiter):
-            # buffer might catch extra newline at the beginning from previous
+        self.buffer.extend(chunk)
+        # single chunk might contain responses to several pipelined commands
+        for line in self.buffer.lines():
+            if isinstance(line, memoryview):  # binary block, pass as is
+                self._handle_message(line)
+                continue
+            # line might catch extra newline at the beginning from previous
             # output, if command was implemented sloppy or \r\n are in wrong
-            # order. Also, it has a newline at the end
-            self.buffer = self.buffer.strip()
-
-            if self._read_future is not None:  # called readline()
-                self._resolve_future()
-            elif self._data_callback is not None:
-                self._data_callback(self.buffer)
-            self.buffer = ''
-
-    def _resolve_future(self):
-        """ Force complete read, e.g. by timeout
-        - set future result
-        - clear buffer and self._read_future
-        - remove timeout (if set)
+            # order.
+            self._handle_message(line.strip())
+
+        if self.buffer.overflow():
+            # generating command streaming data without delimiters
+            if options.serial_buffer_overflow == 'flush' and \
+                    self._data_callback is not None:
+                self._data_callback(self.buffer.take())
+            else:
+                self.buffer.drop(len(self.buffer) - self.buffer.max_size)
+
+    def read_timeout(self):
+        return options.serial_port_timeout
+
+    def take_partial(self):
+        return self.buffer.take().strip()
+
+    def readline(self):
+        """ Helper method to read a single line with timeout
+        Timeout is options.serial_port_timeout, see read_message()
         """
-        assert self._read_future is not None, "can't complete without future"
-        assert self._timeout_handler is not None, "no timeout handler"
-        self._read_future.set_result(self.buffer)
-        self._read_future = None
-        # remove timeout
-        self.io_loop.remove_timeout(self._timeout_handler)
-        self._timeout_handler = None
-
-    def readline(self, timeout=options.serial_port_timeout):
-        """ Helper method to read a single line with timeout """
-        self._read_future = tornado.concurrent.TracebackFuture()
-        self._timeout_handler = self.io_loop.add_timeout(
-            datetime.timedelta(seconds=timeout),
-            self._resolve_future)
-        return self._read_future
+        return self.read_message()
 
     def fileno(self):
         return self.serial.fileno()
@@ -158,47 +436,339 @@ class SerialStream(tornado.iostream.BaseIOStream):
             res = None
         return res or None
 
-    def connect(self, *args, **kwargs):
-        """ Trap to check that no legacy code uses this method """
+
+class USBTMCStream(MessageStream):
+    """ Stream over USBTMC character device (/dev/usbtmcN)
+    Linux usbtmc driver read() is a synchronous bulk-IN transfer, completed
+    when transfer with End Of Message bit is received. It ignores O_NONBLOCK
+    and device can't be polled for input, so every read_message() is served
+    by a single blocking read() on a worker thread, and its completion is the
+    message boundary. Writes are done on the same thread to keep them in order
+    with reads. Thus, unlike serial ports, message boundaries do not depend on
+    delimiters or timeouts.
+    """
+    fd = None
+
+    def __init__(self, fd, data_callback=None, *args, **kwargs):
+        self.fd = fd
+        kwargs.setdefault('read_chunk_size', options.usbtmc_read_chunk_size)
+        super(USBTMCStream, self).__init__(data_callback, *args, **kwargs)
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    def start(self):
+        """ Nothing to do, device is read on request, see read_message() """
+        pass
+
+    def _read(self):
+        """ Read a single message, executed on the worker thread
+        :return: message, or None if read timed out or device is gone
+        """
+        if self.closed():
+            return None
+        try:
+            message = os.read(self.fd, self.read_chunk_size)
+            # message bigger than read size is continued in the next read.
+            # Only definite length block tells it is not complete
+            block = utils.parse_block(message, eom=True)
+            while block is not None and block[2] is None:
+                chunk = os.read(self.fd, block[1] - len(message))
+                if not chunk:
+                    break
+                message += chunk
+                block = utils.parse_block(message, eom=True)
+        except (IOError, OSError) as err:
+            if err.errno != errno.ETIMEDOUT:
+                # module was extracted, it will be removed soon
+                self.io_loop.add_callback(self.close)
+            return None
+        return message
+
+    def _handle_read(self, future):
+        message = future.result()
+        if message is None:  # read_message() will time out
+            return
+        block = utils.parse_block(message, eom=True)
+        if block is not None and block[2] is not None:
+            # binary block payload, without copying
+            self._handle_message(memoryview(message)[block[0]:block[1]])
+        else:
+            self._handle_message(message.strip())
+
+    def _read_requested(self):
+        self.io_loop.add_future(self._executor.submit(self._read),
+                                self._handle_read)
+
+    def _write(self, data):
+        """ Write data to device, executed on the worker thread """
+        if self.closed():
+            raise tornado.iostream.StreamClosedError()
+        try:
+            while data:
+                data = data[os.write(self.fd, data):]
+        except (IOError, OSError) as err:
+            self.io_loop.add_callback(self.close)
+            raise tornado.iostream.StreamClosedError(real_error=err)
+
+    def write(self, data, callback=None):
+        """ Write data to device
+        :return: Future resolved when data is written
+        """
+        self._check_closed()
+        future = self._executor.submit(self._write, data)
+        if callback is not None:
+            self.io_loop.add_future(future, lambda future: callback())
+        return future
+
+    def read_timeout(self):
+        return options.usbtmc_timeout
+
+    def take_partial(self):
+        # messages are never partially received
+        return ""
+
+    def fileno(self):
+        return self.fd
+
+    def close_fd(self):
+        self._executor.shutdown(wait=False)
+        os.close(self.fd)
+
+    def write_to_fd(self, data):
         raise NotImplementedError
 
+    def read_from_fd(self):
+        raise NotImplementedError
 
-class CDCModule(AbstractMeasurementModule):
-    """New style module with serial interface only, or truly serial device """
+
+class StateMirror(object):
+    """ Cache of module state
+    Only queries listed as cacheable in module configuration patch are
+    mirrored. Value of such query is learned from device response only: set
+    command might be rejected or its parameter normalized by device, e.g.
+    CONF:OUT1 and sets OUT1 to AND, so it just drops cached value of
+    CONFigure:OUT1?. *RST and *RCL change whole module state, so they clear
+    the mirror.
+    """
+    # commands changing module state in a way mirror can't follow
+    reset_commands = ("*RST", "*RCL")
+
+    def __init__(self, queries, ttl=None):
+        """
+        :param queries: list of cacheable queries in canonical form,
+                e.g. ['*IDN?', 'CONFigure:OUT1?']
+               ttl: seconds before cached value expires, default is
+                options.state_mirror_ttl
+        """
+        self.queries = queries
+        self.ttl = options.state_mirror_ttl if ttl is None else ttl
+        # canonical query: (value, time.time() of update)
+        self._values = {}
+        # incremented on every state change. Response to a query written
+        # before the change is outdated, see update()
+        self.version = 0
+
+    def _canonical(self, query):
+        """ Get canonical form of query, None if it is not cacheable """
+        for canonical in self.queries:
+            if utils.scpi_equivalent(query, canonical):
+                return canonical
+        return None
+
+    def get(self, query):
+        """ Get cached response to query
+        :param query: single (not compound) SCPI query
+        :return: string, or None if value is unknown or expired
+        """
+        canonical = self._canonical(query)
+        if canonical not in self._values:
+            return None
+        value, timestamp = self._values[canonical]
+        if time.time() - timestamp >= self.ttl:
+            del self._values[canonical]
+            return None
+        return value
+
+    def update(self, query, response, version=None):
+        """ Remember device response to query, if it is cacheable
+        :param query: single (not compound) SCPI query
+               response: device response
+               version: self.version when query was written. Response is
+                ignored if state has changed since then
+        """
+        if version is not None and version != self.version:
+            return
+        canonical = self._canonical(query)
+        if canonical is not None and response:
+            self._values[canonical] = (response, time.time())
+
+    def update_set(self, command):
+        """ Follow state change made by a command
+        :param command: single (not compound) SCPI command
+        """
+        header = command.strip().partition(" ")[0]
+        if any(utils.scpi_equivalent(header, reset_command)
+               for reset_command in self.reset_commands):
+            self.invalidate()
+        else:
+            self._values.pop(self._canonical(header + "?"), None)
+            self.version += 1
+
+    def invalidate(self):
+        self._values.clear()
+        self.version += 1
+
+
+class StreamModule(AbstractMeasurementModule):
+    """ Base class for modules communicating through MessageStream
+    Subclasses open device in __init__() and create self.stream in start()
+    """
     stream = None
-    serial = None
+    pipeline = None
+    mirror = None
+    _data_callback = None
     _name_scpi_command = "*IDN?"
 
-    def __init__(self, device, data_callback=None):
-        """ This class instantiated by pyudev listener from hwconf.py
-        Listener is run on a separate thread and should not block HTTP requests
+    def __init__(self, device, data_callback=None, name=None, patch=None):
+        super(StreamModule, self).__init__(
+            device, data_callback=data_callback, name=name, patch=patch)
+        self._data_callback = data_callback
+        self.pipeline = tornado.locks.Semaphore(options.serial_pipeline_depth)
+        self.mirror = StateMirror(self.cacheable_queries)
+
+    def stop(self):
+        self.mirror.invalidate()
+        if self.stream is not None:
+            self.stream.close()
+
+    def is_set_command(self, command):
+        """ Check if command produces no response
+        Only queries (header ends with '?') are answered. Output of other
+        commands, e.g. generating ones, is not a response: waiting for it
+        would take response to the next command, so it is passed to data
+        callback instead
+        :param command: single (not compound) SCPI command
+        :return: boolean
+        """
+        return not utils.is_query(command)
+
+    @tornado.gen.coroutine
+    def scpi(self, command, opc=None):
+        """Send SCPI command to the device
+        Commands are pipelined, i.e. command is written to the port without
+        waiting for response to the previous one. Responses are matched to
+        commands in FIFO order. Commands producing no output complete as soon
+        as they are written to the port.
+        :param command: string with SCPI command. It is not validated to be
+                valid SCPI command,  it is your responsibility
+               opc: boolean, append *OPC? to commands producing no output and
+                wait for completion. Default is options.scpi_opc_handshake
+        :return string with command response. Compound queries, e.g.
+                CONF:OUT1?;CONF:OUT2? return list of strings, one per query.
+                Commands producing no output return empty string. Response
+                in IEEE 488.2 binary block format is returned as memoryview
+                of block payload
+        """
+        commands = utils.split_compound_command(command)
+        queries = [cmd for cmd in commands if utils.is_query(cmd)]
+        if len(commands) == 1 and queries:
+            cached = self.mirror.get(command)
+            if cached is not None:
+                raise tornado.gen.Return(cached)
+        silent = all(self.is_set_command(cmd) for cmd in commands)
+        if opc is None:
+            opc = options.scpi_opc_handshake
+
+        command = command.strip()
+        if silent and opc:
+            command += ";*OPC?"
+        # State change is followed before waiting for a pipeline slot: queries
+        # issued after this command must not be answered from the mirror,
+        # and responses to queries queued before it must not be cached
+        for cmd in commands:
+            if not utils.is_query(cmd):
+                self.mirror.update_set(cmd)
+        version = self.mirror.version
+        # Pipeline semaphore only limits number of commands in flight.
+        # Order of responses is guaranteed by writing command and queueing
+        # read in the same IOLoop iteration, i.e. without yield in between
+        with (yield self.pipeline.acquire()):
+            self.last_write_time = time.time()
+            write_future = self.stream.write(command + "\n")
+            if silent and not opc:
+                yield write_future
+                raise tornado.gen.Return("")
+            result = yield self.stream.read_message()
+        # At this point read future is resolved, due to timeout or end of
+        # output, so it is safe to let next command in
+
+        if silent:  # *OPC? response, it is not a part of command output
+            result = ""
+        elif isinstance(result, memoryview):
+            pass
+        # compound query response is a single line, separated by semicolons
+        elif len(queries) > 1:
+            result = result.split(";")
+            if len(result) == len(queries):
+                for query, response in zip(queries, result):
+                    self.mirror.update(query, response, version)
+        elif queries:
+            self.mirror.update(queries[0], result, version)
+        raise tornado.gen.Return(result)
+
+
+
+class CDCModule(StreamModule):
+    """New style module with serial interface only, or truly serial device """
+    serial = None
+
+    def __init__(self, device, data_callback=None, name=None, patch=None):
+        """ This class instantiated by hwconf.py on a worker thread, so
+        blocking name request does not block HTTP requests
         :param device: pyudev.Device instance
                data_callback: will be called after reception of data chunk. It
                     was introduced to support generation commands. For example,
                     this callback can push data to websocket for continuous
                     read
+               name: module name, e.g. from cache of known modules. If
+                    provided, name is not requested from the device
+               patch: configuration patch, see AbstractMeasurementModule
         :return: None
         """
         assert self.is_instance(device)
-        super(CDCModule, self).__init__(device, data_callback=data_callback)
+        super(CDCModule, self).__init__(
+            device, data_callback=data_callback, name=name, patch=patch)
         self.serial = serial.Serial(
             device['DEVNAME'],
             options.serial_port_baudrate,
             timeout=options.serial_port_timeout)
+        if name is not None:
+            return
         # Note that this is a blocking operation. Fortunately, it is executed
-        # on a different thread since module class instantiated by udev listener
+        # on a worker thread.
         # later SerialStream will force port to non-blocking mode (timeout=0)
         try:
             self.serial.write(self._name_scpi_command+"\n")
-            self.name = self.serial.readline()
+            self.name = self.serial.readline().strip()
+            self.mirror.update(self._name_scpi_command, self.name)
         except serial.SerialException:
             # module was extracted before name was read. It is ok, udev will
             # notify about extraction soon and module will be destroyed
-            return
+            self.serial = None
 
-        self.stream = SerialStream(self.serial, data_callback=data_callback)
+    def start(self):
+        """ Switch serial port to non-blocking mode and start listening """
+        if self.serial is None:  # extracted during initialization
+            return
+        self.stream = SerialStream(self.serial,
+                                   data_callback=self._data_callback)
         self.stream.start()
 
+    def stop(self):
+        super(CDCModule, self).stop()
+        if self.stream is None and self.serial is not None:
+            # not started, e.g. removed while probing
+            self.serial.close()
+
     @staticmethod
     def is_instance(device):
         """ Check if the device supported by this module
@@ -207,22 +777,6 @@ class CDCModule(AbstractMeasurementModule):
         """
         return device.get('ID_USB_DRIVER') == 'cdc_acm' and 'DEVNAME' in device
 
-    @tornado.gen.coroutine
-    def scpi(self, command):
-        """Send SCPI command to the device
-        :param command: string with SCPI command. It is not validated to be
-                valid SCPI command,  it is your responsibility
-        :return string with command response.
-        """
-        # First, acquire lock on the port. It is necessary to prevent concurrent
-        # requests from the same user / api token
-        with (yield self.lock.acquire()):
-            yield self.stream.write(command.strip() + "\n")
-            result = yield self.stream.readline()
-        # At this point read future is resolved, due to timeout or end of
-        # output, so it is safe to release lock
-        raise tornado.gen.Return(result)
-
 
 class LegacyEasyPhiModule(CDCModule):
     """ Legacy modules implemented for the first version of Easy Phi platform.
@@ -239,11 +793,47 @@ class LegacyEasyPhiModule(CDCModule):
             and device['ID_VENDOR'] == 'Easy-phi'
 
 
-class USBTMCModule(AbstractMeasurementModule):
-    """Class to represent USB TMC device """
-    def __init__(self, device, data_callback=None):
-        # TODO: implement non blocking read/write in a similar to CDC way
-        super(USBTMCModule, self).__init__(device, data_callback=data_callback)
+class USBTMCModule(StreamModule):
+    """Class to represent USB TMC device, accessed through Linux usbtmc driver
+    character device (/dev/usbtmcN) """
+    fd = None
+
+    def __init__(self, device, data_callback=None, name=None, patch=None):
+        """ Open device and request its name. This is a blocking operation,
+        executed on a worker thread by hwconf.py
+        Parameters are the same as for CDCModule
+        """
+        assert self.is_instance(device)
+        super(USBTMCModule, self).__init__(
+            device, data_callback=data_callback, name=name, patch=patch)
+        # USBTMC devices do not accept new query until previous response is
+        # read, so there is no pipelining
+        self.pipeline = tornado.locks.Semaphore(1)
+        self.fd = os.open(device['DEVNAME'], os.O_RDWR)
+        if name is not None:
+            return
+        try:
+            os.write(self.fd, self._name_scpi_command + "\n")
+            # driver returns complete message in a single read
+            self.name = os.read(
+                self.fd, options.usbtmc_read_chunk_size).strip()
+            self.mirror.update(self._name_scpi_command, self.name)
+        except OSError:
+            # module was extracted or timed out. If it is still there, it will
+            # be displayed without name
+            pass
+
+    def start(self):
+        """ Start communication with the device, see USBTMCStream """
+        self.stream = USBTMCStream(self.fd, data_callback=self._data_callback)
+        self.stream.start()
+
+    def stop(self):
+        super(USBTMCModule, self).stop()
+        if self.stream is None and self.fd is not None:
+            # not started, e.g. removed while probing
+            os.close(self.fd)
+            self.fd = None
 
     @staticmethod
     def is_instance(device):
@@ -251,12 +841,7 @@ class USBTMCModule(AbstractMeasurementModule):
         :param device: pyudev.Device instance
         :return: boolean
         """
-        # TODO: check actual usb-tmc device properties and update
-        return device.get('ID_USB_DRIVER') == 'usbtmc'
-
-    def scpi(self, command):
-        # TODO: write actual implementation
-        return "OK"
+        return device.get('ID_USB_DRIVER') == 'usbtmc' and 'DEVNAME' in device
 
 
 class BroadcastModule(AbstractMeasurementModule):
@@ -266,6 +851,8 @@ class BroadcastModule(AbstractMeasurementModule):
     """
 
     name = "Broadcast dummy module"
+    # time between the first and the last write of the last broadcast command
+    last_skew = None
 
     def platformwide_commands(self):
         return [
@@ -278,36 +865,76 @@ class BroadcastModule(AbstractMeasurementModule):
         self.modules = modules
         super(BroadcastModule, self).__init__(None)
 
-    def scpi(self, command):
+    @tornado.gen.coroutine
+    def scpi(self, command, slot_map=False):
         """Send SCPI command to all connected modules
+        Command is sent to all modules before waiting for any response, so
+        in most cases all ports are written in the same IOLoop iteration.
         :param command: string with SCPI command. It is not validated to be
                 valid SCPI command, it is your responsibility
-        :return always "OK".
+               slot_map: boolean, return responses of all modules
+        :return response of the module in the lowest occupied slot.
+                If slot_map is True, return dictionary:
+                {'responses': {slot: response}, 'skew': seconds}, where skew is
+                time between the first and the last write to modules.
         """
         for canonical, callback in self.platformwide_commands():
             if utils.scpi_equivalent(command, canonical):
                 # systemwide commands do not accept arguments
-                return callback()
-
-        response = None
-        for module in reversed(self.modules[1:]):
-            if isinstance(module, AbstractMeasurementModule):
-                response = module.scpi(command)
-
-        if response is None:
+                raise tornado.gen.Return(callback())
+
+        started = time.time()
+        futures = {}
+        # slots might be emptied or reused while waiting for responses,
+        # so modules are captured before
+        modules = {}
+        for slot, module in enumerate(self.modules):
+            if slot and isinstance(module, AbstractMeasurementModule):
+                futures[slot] = self._module_scpi(module, command)
+                modules[slot] = module
+        # modules with full pipeline will write later, check them again after
+        # responses are received
+        write_times = {slot: module.last_write_time
+                       for slot, module in modules.items()}
+
+        responses = yield futures
+
+        for slot, write_time in write_times.items():
+            if write_time is None or write_time < started:
+                write_times[slot] = modules[slot].last_write_time
+        write_times = [wtime for wtime in write_times.values()
+                       if wtime is not None and wtime >= started]
+        self.last_skew = max(write_times) - min(write_times) \
+            if write_times else None
+
+        if slot_map:
+            raise tornado.gen.Return(
+                {'responses': responses, 'skew': self.last_skew})
+
+        if not responses:
             # if at least one module present, it will be empty string even if
             # no response was received.
-            return "**No modules connected"
+            raise tornado.gen.Return("**No modules connected")
+
+        raise tornado.gen.Return(responses[min(responses)])
 
-        return response
+    @staticmethod
+    @tornado.gen.coroutine
+    def _module_scpi(module, command):
+        """ Send command to a single module, ignoring disconnected ones """
+        try:
+            response = yield tornado.gen.maybe_future(module.scpi(command))
+        except tornado.iostream.StreamClosedError:
+            # module extracted, it will be removed from the list soon
+            response = None
+        raise tornado.gen.Return(response)
 
     def get_configuration(self):
         """ Return list of supported commands
         """
         conf = super(BroadcastModule, self).get_configuration()
-        conf += [cmd[0] for cmd in self.platformwide_commands()
-                 if cmd[0] not in conf]
-        return conf
+        return conf + tuple(cmd[0] for cmd in self.platformwide_commands()
+                            if cmd[0] not in conf)
 
 # Please note that it is not conventional __all__ defined in __init__.py,
 # it contains list of classes instead of strings.
@@ -5,13 +5,27 @@
 up to date.
 """
 
-import pyudev
+import errno
+import heapq
+import json
+import logging
+import os
+import threading
 
+import concurrent.futures
+import pyudev
+import tornado.ioloop
 from tornado.options import define, options
 
-from easy_phi import hwal
+from easy_phi import hwal, mod_conf_patch, utils
 
 define('ports', default=[])
+# number of threads to initialize modules. Module initialization might
+# include blocking requests to device, e.g. to get its name
+define('probe_workers', default=4)
+# names of known modules, to skip name request on startup. Modules are
+# identified by ID_SERIAL_SHORT udev property
+define('modules_cache_path', default='/var/cache/easy_phi/modules.json')
 
 hwconf_change_callbacks = [
     # hardware configuration change listener will call these callbacks upon
@@ -51,79 +65,246 @@ def data_callback(slot):
                 callback(slot, data)
     return caller
 
-modules = [None]
-# device #0 represents broadcast
-modules[0] = hwal.BroadcastModule(modules)
+class SlotRegistry(object):
+    """ Association of devices with rack slots
+    Slots are identified by ID_PATH of USB port (see options.ports), devices
+    by DEVPATH. Devices connected to ports not associated with any rack slot
+    get dynamically allocated slots above configured ones; freed dynamic slots
+    are reused.
+
+    All methods must be called on IOLoop thread. Since modules list is only
+    modified on IOLoop thread, handlers can read it without locking.
+    """
+
+    def __init__(self):
+        self.modules = [None]
+        # device #0 represents broadcast
+        self.modules[0] = hwal.BroadcastModule(self.modules)
+        self._ports = 0  # number of configured (non-dynamic) slots
+        self._by_devpath = {}  # DEVPATH: slot
+        self._by_id_path = {}  # ID_PATH: slot, configured and dynamic
+        self._occupied = set()  # dynamic slots in use
+        self._free = []  # heap of free dynamic slots
+
+    def configure(self, ports):
+        """ Create slots for configured USB ports
+        :param ports: list of ID_PATH properties of ports, see options.ports
+        """
+        self._ports = len(ports)
+        for index, id_path in enumerate(ports):
+            self._by_id_path[id_path] = index + 1
+        if len(self.modules) <= self._ports:
+            self.modules.extend([None] * (self._ports + 1 - len(self.modules)))
+
+    def get_slot(self, device):
+        """ Return rack slot by device object, allocating one if necessary
+        :param device: pyudev.Device object.
+        :return integer slot number, 1...~20. Slot 0 is reserved for
+                broadcasting
+        """
+        devpath = device.get('DEVPATH')
+        slot = self._by_devpath.get(devpath)
+        if slot is not None:
+            return slot
+
+        # match device with USB ports of the rack. Dynamic slots also stay
+        # associated with port, so reconnected module gets the same slot
+        id_path = device.get('ID_PATH')
+        slot = self._by_id_path.get(id_path)
+        if slot is None or slot in self._occupied:
+            # if port is not associated with rack slot, assign to first free
+            # slot. It might happen in standalone mode, or if a supported
+            # device connected directly to a board inside rack, i.e. it is not
+            # a typical scenario for commercially distributed systems.
+            slot = self._allocate()
+            self._by_id_path[id_path] = slot
+        if slot > self._ports:
+            self._occupied.add(slot)
+        self._by_devpath[devpath] = slot
+        return slot
+
+    def release(self, device):
+        """ Forget the device, stop its module and free the slot
+        :return: slot number, None if device was not registered
+        """
+        slot = self._by_devpath.pop(device.get('DEVPATH'), None)
+        if slot is None:
+            return None
+        module, self.modules[slot] = self.modules[slot], None
+        if module is not None:
+            module.stop()
+        if slot in self._occupied:
+            self._occupied.remove(slot)
+            heapq.heappush(self._free, slot)
+        return slot
+
+    def _allocate(self):
+        while self._free:
+            slot = heapq.heappop(self._free)
+            if slot not in self._occupied:  # might be taken by its own port
+                return slot
+        self.modules.append(None)
+        return len(self.modules) - 1
+
+
+registry = SlotRegistry()
+modules = registry.modules
 
 _context = pyudev.Context()
 
 
 def get_rack_slot(device):
-    """ Return rack slot by device object. If usb device hierarchy is not
-    associated with any rack slot, dynamically add a new slot or reuse first
-    free slot from dynamically created before. By default system is configured
-    for 0 slots so everything is created dynamically.
-    :param device: pyudev.Device object.
-    :return integer slot number, 1...~20. Slot 0 is reserved for broadcasting
+    """ Return rack slot by device object, see SlotRegistry.get_slot() """
+    return registry.get_slot(device)
+
+
+# ID_SERIAL_SHORT: {'name': module name, 'class': module class name}
+_modules_cache = {}
+_modules_cache_lock = threading.Lock()
+
+# slot: token of module initialization in progress. Module is put into slot
+# only if token is still there, i.e. module was not removed while probing
+_probes = {}
+_executor = None
+_io_loop = None
+
+
+def _load_modules_cache():
+    global _modules_cache
+    try:
+        with open(options.modules_cache_path) as cache_file:
+            _modules_cache = json.load(cache_file)
+    except (IOError, ValueError):  # doesn't exist yet or corrupted
+        _modules_cache = {}
+
+
+def _save_modules_cache(module):
+    """ Remember name of the module. Called on a worker thread """
+    serial_no = module.device.get('ID_SERIAL_SHORT')
+    if not serial_no or not module.name:
+        return
+    entry = {'name': module.name, 'class': module.__class__.__name__}
+    with _modules_cache_lock:
+        if _modules_cache.get(serial_no) == entry:
+            return
+        _modules_cache[serial_no] = entry
+        try:
+            cache_dir = os.path.dirname(options.modules_cache_path)
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            temp_path = options.modules_cache_path + '.tmp'
+            with open(temp_path, 'w') as cache_file:
+                json.dump(_modules_cache, cache_file)
+            os.rename(temp_path, options.modules_cache_path)
+        except (IOError, OSError) as err:
+            if err.errno != errno.EACCES:
+                logging.warning("Failed to save modules cache: %s", err)
+
+
+def _probe(module_class, device, slot, patch):
+    """ Instantiate module. This function is executed on a worker thread """
+    cached = _modules_cache.get(device.get('ID_SERIAL_SHORT'), {})
+    name = cached.get('name') \
+        if cached.get('class') == module_class.__name__ else None
+    module = module_class(device, data_callback=data_callback(slot), name=name,
+                          patch=patch)
+    if name is None:
+        _save_modules_cache(module)
+    return module
+
+
+def _attach(slot, token, future):
+    """ Put initialized module into slot. Executed on IOLoop thread """
+    if _probes.get(slot) is not token:  # removed or re-added while probing
+        if future.exception() is None:
+            future.result().stop()  # release device, e.g. close serial port
+        return
+    del _probes[slot]
+    utils.bump_generation()  # number of probing modules has changed
+    try:
+        module = future.result()
+    except Exception:
+        logging.exception("Failed to initialize module in slot %s", slot)
+        return
+    module.start()
+    if modules[slot] is not None:  # device re-initialized on udev event
+        modules[slot].stop()
+    modules[slot] = module
+
+    for callback in hwconf_change_callbacks:
+        if callable(callback):
+            callback(slot, True)
+
+
+def attach_module(module_class, device, slot):
+    """ Start module initialization in a worker thread. Module will be put into
+    the slot as soon as it is ready; hwconf_change_callbacks are called then.
     """
-    global modules  # Ugly, I know. Let me know if there is a better way
+    token = object()
+    _probes[slot] = token
+    utils.bump_generation()
+    # configuration patches are loaded here rather than on worker thread,
+    # which would race with other probes and HTTP handlers reloading them
+    mod_conf_patch.refresh()
+    patch = mod_conf_patch.get_patch(device)
+    future = _executor.submit(_probe, module_class, device, slot, patch)
+    _io_loop.add_future(
+        future, lambda ready_future: _attach(slot, token, ready_future))
+
 
-    # first, check if device is already represented in modules
-    # pyudev.Device does not guarantee uniqueness, so we have to ensure if
-    # device isn't already associated with some slot
-    for i, module in enumerate(modules):
-        if module is not None and module.device == device:
-            return i
+def probing():
+    """ Return number of modules being initialized at the moment """
+    return len(_probes)
 
-    # if it is not in the list, match it with USB ports of the rack
-    if device['ID_PATH'] in options.ports:
-        return options.ports.index(device['ID_PATH']) + 1
 
-    # if device is neither in modules list nor port is associated with rack
-    # slot, assign to first free slot. It might happen in standalone mode, or
-    # if a supported device connected directly to a board inside rack, i.e.
-    # it is not not a typical scenario for commercially distributed systems.
-    modules += [None]
-    options.ports.append(device['ID_PATH'])
-    return len(modules)
+def get_module_class(device):
+    """ Return module class supporting device, None if not supported """
+    for module_class in hwal.module_classes:
+        if module_class.is_instance(device):
+            return module_class
+    return None
 
 
 def hwconf_update():
     """ Check connected devices and refresh modules list.
     Usually this method is called upon system startup or restart to
-    restore current hardware configuration
+    restore current hardware configuration. Modules are initialized in
+    background, so this function returns immediately.
     """
     for device in _context.list_devices():
-        for module_class in hwal.module_classes:
-            if module_class.is_instance(device):
-                slot = get_rack_slot(device)
-                modules[slot] = module_class(
-                    device, data_callback=data_callback(slot))
-                break
+        module_class = get_module_class(device)
+        if module_class is not None:
+            attach_module(module_class, device, get_rack_slot(device))
 
 
-def hwconf_listener(action, device):
-    """ udev events listener to update modules list dynamically
-    This method shall not be used directly. It is only for purpose of
-    integration with pyudev
-    """
-
-    module_class = None
-    for supported_class in hwal.module_classes:
-        if supported_class.is_instance(device):
-            module_class = supported_class
-            break
+def hwconf_event(action, device):
+    """ Update modules list on udev event. Executed on IOLoop thread """
+    module_class = get_module_class(device)
     if module_class is None:
         return
 
-    rack_slot = get_rack_slot(device)
-    added = action not in ('remove', 'offline')
-    modules[rack_slot] = module_class(
-        device, data_callback=data_callback(rack_slot)) if added else None
+    if action not in ('remove', 'offline'):
+        attach_module(module_class, device, get_rack_slot(device))
+        return
+
+    rack_slot = registry.release(device)
+    if rack_slot is None:  # module was never attached
+        return
+    _probes.pop(rack_slot, None)
+    utils.bump_generation()
 
     for callback in hwconf_change_callbacks:
         if callable(callback):
-            callback(rack_slot, added)
+            callback(rack_slot, False)
+
+
+def hwconf_listener(action, device):
+    """ udev events listener to update modules list dynamically
+    This method shall not be used directly. It is only for purpose of
+    integration with pyudev. It is called on observer thread, so all the work
+    is passed to IOLoop thread
+    """
+    _io_loop.add_callback(hwconf_event, action, device)
 
 # for asynchronous hw configuration monitoring reference see
 # https://pyudev.readthedocs.org/en/latest/guide.html#asynchronous-monitoring
@@ -136,8 +317,14 @@ def start():
     """ update hardware configuration on start and install udev listener """
     # We initialize modules with observer start because configuration is not
     # parsed yet when module is being imported, so we don't know ports number.
-    global modules
-    modules += [None] * len(options.ports)
+    global _executor, _io_loop
+    registry.configure(options.ports)
+
+    _io_loop = tornado.ioloop.IOLoop.current()
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(
+            options.probe_workers)
+    _load_modules_cache()
 
     if not observer.is_alive():  # start() called twice before stop()
         observer.start()
@@ -9,13 +9,18 @@ https://en.wikipedia.org/wiki/Standard_Commands_for_Programmable_Instruments
 """
 
 import ConfigParser
+import os
+import threading
 
 from tornado.options import define, options
 
+from easy_phi import utils
+
 define('modules_conf_patches_path',
        default='/etc/easy_phi/modules_conf_patches.conf')
 
-# legacy_configs holds list of tuples (device_config, module_config)
+# legacy_configs holds list of tuples (device_config, module_config,
+# cacheable_queries)
 #
 # module_config is a list of supported SCPI commands separated by newline
 # Example:
@@ -28,25 +33,60 @@ define('modules_conf_patches_path',
 # property is a name of udev device property, see device_detection.md
 # Example:
 # [('ID_VENDOR', 'Easy-phi'), ('ID_SERIAL_SHORT','123123123123')]
+#
+# cacheable_queries is a list of queries separated by newline, which can be
+# answered from module state mirror (see hwal.StateMirror), i.e. queries whose
+# response only changes by the corresponding set command, *RST or *RCL
 legacy_configs = None
 # legacy_commands is a list of commands mandatory for all modules
 # it is defined in section [Default] of the configuration file
 # example of such commands is *RST, *IDN? and *WAI
 legacy_commands = ''
-
-
-def configuration_match(device, device_config):
-    """ This method compares pyudev device to stored configuration.
-    It is necessary to return stored configuration for SCPI devices which
-    do not return list of available SCPI commands by SYSTem:HELP?
-    Device configuration in this case will be obtained from list of hardcoded
-    configurations, usually configuration file or separate Python module.
-    :param device: pyudev device instance
-    :param device_config: list of (name, value) device properties to match
-    :return: boolean, True if device matches configuration.
-    """
-    return all(key in device and device[key] == value
-               for key, value in device_config)
+# cacheable queries applicable to all modules, e.g. *IDN?
+legacy_cacheable = ''
+
+# options of configuration section which are not device properties
+_reserved_options = ('scpi', 'cacheable')
+
+# Configuration patches compiled by _init_config(). Sections are grouped by
+# set of device properties they match, e.g. (ID_SERIAL_SHORT, ID_VENDOR), so
+# device is matched by one dictionary lookup per group:
+# list of (tuple of property names, {tuple of values: section index})
+_index = []
+# section index: (tuple of module commands, tuple of cacheable queries),
+# default commands are included
+_resolved = []
+# configuration of devices not matching any section
+_default_resolved = ((), ())
+# incremented every time configuration file is loaded, so modules can
+# refresh configuration they have cached
+version = 0
+# (path, modification time) of loaded configuration file
+_conf_file_version = None
+# Configuration is loaded on IOLoop thread (see hwconf.attach_module()), but
+# modules created elsewhere might resolve it on other threads. Lock makes
+# loading and resolving atomic
+_lock = threading.RLock()
+
+
+def _split_lines(*texts):
+    """ Join lists separated by newline, e.g. SCPI commands, into tuple
+    without blank lines and duplicates """
+    result = []
+    for text in texts:
+        for line in text.split("\n"):
+            line = line.strip()
+            if line and line not in result:
+                result.append(line)
+    return tuple(result)
+
+
+def _file_version():
+    path = options.modules_conf_patches_path
+    try:
+        return path, os.stat(path).st_mtime
+    except OSError:  # ConfigParser ignores missing files as well
+        return path, None
 
 
 def _init_config():
@@ -54,19 +94,100 @@ def _init_config():
     This method is created for lazy initialization
     :return: None
     """
-    global legacy_configs, legacy_commands
+    with _lock:
+        _load_config()
+
+
+def _load_config():
+    global legacy_configs, legacy_commands, legacy_cacheable, version
+    global _index, _resolved, _default_resolved, _conf_file_version
+    _conf_file_version = _file_version()
     confpatch_parser = ConfigParser.ConfigParser()
     confpatch_parser.read(options.modules_conf_patches_path)
     legacy_configs = []
     for section in confpatch_parser.sections():
         module_config = confpatch_parser.get(section, 'scpi')
+        cacheable = confpatch_parser.get(section, 'cacheable') \
+            if confpatch_parser.has_option(section, 'cacheable') else ''
         # key.upper() is necessary because pyudev.Device keys are uppercase
         # and we want keys in config patches file to be case insensitive
         device_config = [(key.upper(), value) for key, value in
-                         confpatch_parser.items(section) if key != 'scpi']
-        legacy_configs.append((device_config, module_config))
+                         confpatch_parser.items(section)
+                         if key not in _reserved_options]
+        legacy_configs.append((device_config, module_config, cacheable))
     default_section = confpatch_parser.defaults()
     legacy_commands = default_section.get('scpi', '')
+    legacy_cacheable = default_section.get('cacheable', '')
+
+    groups = {}
+    index = []
+    resolved = []
+    for position, (device_config, module_config, cacheable) in \
+            enumerate(legacy_configs):
+        properties = dict(device_config)
+        keys = tuple(sorted(properties))
+        if keys not in groups:
+            groups[keys] = {}
+            index.append((keys, groups[keys]))
+        # the first section wins if several have the same properties
+        groups[keys].setdefault(
+            tuple(properties[key] for key in keys), position)
+        resolved.append((_split_lines(legacy_commands, module_config),
+                         _split_lines(legacy_cacheable, cacheable)))
+    _index = index
+    _resolved = resolved
+    _default_resolved = (_split_lines(legacy_commands),
+                         _split_lines(legacy_cacheable))
+    version += 1
+    utils.bump_generation()
+
+
+def refresh():
+    """ Load configuration file if it was not loaded yet or was modified """
+    with _lock:
+        if legacy_configs is None or _conf_file_version != _file_version():
+            _load_config()
+
+
+def _find_section(device):
+    """ Return index of the first configuration section matching device,
+    None if there is no such section """
+    if device is None:  # pseudo modules, e.g. broadcast
+        return None
+    found = None
+    for keys, sections in _index:
+        try:
+            values = tuple(device[key] for key in keys)
+        except KeyError:
+            continue
+        position = sections.get(values)
+        if position is not None and (found is None or position < found):
+            found = position
+    return found
+
+
+def resolve(device):
+    """ Get module configuration and cacheable queries from configuration
+    patches, see get_configuration_patch() and get_cacheable_queries()
+    :param device: pyudev device instance
+    :return: tuple (tuple of commands, tuple of cacheable queries)
+    """
+    return get_patch(device)[1:]
+
+
+def get_patch(device):
+    """ Get configuration patch of device together with version of
+    configuration it was resolved from
+    :param device: pyudev device instance
+    :return: tuple (version, tuple of commands, tuple of cacheable queries)
+    """
+    with _lock:
+        if legacy_configs is None:
+            _load_config()
+        position = _find_section(device)
+        if position is None:
+            return (version,) + _default_resolved
+        return (version,) + _resolved[position]
 
 
 def get_configuration_patch(device):
@@ -76,20 +197,16 @@ def get_configuration_patch(device):
     :param device:
     :return: list of supported commands
     """
-    if legacy_configs is None:
-        _init_config()
-
-    commands = legacy_commands
-    if device is not None:  # pseudo modules, e.g. broadcast
-        for device_config, module_config in legacy_configs:
-            if configuration_match(device, device_config):
-                if not commands.endswith("\n"):
-                    commands += "\n"
-                commands += module_config
-                break
-
-    # final step - remove blank lines if any
-    return [command for command in commands.split("\n") if command]
+    return list(resolve(device)[0])
+
+
+def get_cacheable_queries(device):
+    """ Return list of queries which can be answered from module state mirror
+
+    :param device: pyudev device instance
+    :return: list of queries, e.g. ['*IDN?', 'CONFigure:OUT1?']
+    """
+    return list(resolve(device)[1])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Raw socket SCPI server, based on tornado.TCPServer
+
+Raw socket is the simplest instrument protocol supported by VISA libraries
+(TCPIP::<host>::5025::SOCKET resources): newline terminated commands are sent
+over TCP connection, query responses are newline terminated as well.
+
+Connection is bound to a slot either by port (see raw_socket_slot_port
+option) or by INSTrument:NSELect <slot> command. Commands can be pipelined,
+i.e. client might send several commands without waiting for responses.
+Responses are written in the same order.
+"""
+
+import logging
+import re
+
+import tornado.gen
+import tornado.iostream
+import tornado.locks
+import tornado.queues
+import tornado.tcpserver
+from tornado.options import options, define
+
+from easy_phi import hwconf, utils
+from easy_phi.hislip import format_response
+
+# port of slot 1, slot N is served on raw_socket_slot_port + N - 1.
+# 0 to disable per-slot ports, so only raw_socket_port (broadcast module by
+# default) is available
+define('raw_socket_slot_port', default=0)
+# number of per-slot ports
+define('raw_socket_slots', default=16)
+# max length of command line, bytes. Connection is closed if exceeded
+define('raw_socket_max_line', default=65536)
+# max number of commands executed concurrently for one connection
+define('raw_socket_pipeline', default=16)
+
+# INSTrument:NSELect <slot> and INSTrument:NSELect? are handled by server
+_nselect = re.compile(r':?INST(?:RUMENT)?:NSEL(?:ECT)?(\?|\s+(\S+))$',
+                      re.IGNORECASE)
+
+# standard SCPI errors, returned for queries to empty slots, to modules
+# locked through web API and on unexpected module failure
+HARDWARE_MISSING = '-241,"Hardware missing"'
+MODULE_LOCKED = '-200,"Execution error; module locked"'
+EXECUTION_ERROR = '-200,"Execution error"'
+
+
+class RawSocketServer(tornado.tcpserver.TCPServer):
+    """ Raw socket SCPI server """
+
+    def __init__(self, slot=0, *args, **kwargs):
+        """
+        :param slot: slot selected for new connections, 0 is broadcast module
+        """
+        super(RawSocketServer, self).__init__(*args, **kwargs)
+        self.slot = slot
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        """ Read commands and start their execution. Futures of results are
+        passed to respond() in order of commands. Number of commands in
+        flight, either queries or set commands, is limited by
+        raw_socket_pipeline """
+        slot = self.slot
+        pipeline = tornado.locks.Semaphore(options.raw_socket_pipeline)
+        responses = tornado.queues.Queue()
+        writer = self.respond(stream, responses, pipeline)
+        try:
+            while True:
+                line = yield stream.read_until(
+                    b'\n', max_bytes=options.raw_socket_max_line)
+                command = line.strip()
+                if not command:
+                    continue
+                match = _nselect.match(command)
+                if match is not None and match.group(1) != '?':
+                    try:
+                        slot = int(match.group(2))
+                    except ValueError:
+                        pass
+                    continue
+                # released by respond() when command is complete
+                yield pipeline.acquire()
+                if match is None:
+                    result = self.execute(slot, command)
+                else:
+                    result = tornado.gen.maybe_future(str(slot))
+                is_query = any(
+                    utils.is_query(cmd)
+                    for cmd in utils.split_compound_command(command))
+                responses.put_nowait((result, is_query))
+        except (tornado.iostream.StreamClosedError,
+                tornado.iostream.UnsatisfiableReadError):
+            pass
+        finally:
+            # let responses to already received queries be sent
+            yield responses.put(None)
+            yield writer
+            stream.close()
+
+    @staticmethod
+    @tornado.gen.coroutine
+    def respond(stream, responses, pipeline):
+        """ Write query responses to the stream, in order of queries
+        :param responses: queue of tuples (future resolving to module.scpi()
+                result, boolean: command is a query). None terminates
+               pipeline: tornado.locks.Semaphore, released on every
+                completed command
+        """
+        while True:
+            item = yield responses.get()
+            if item is None:
+                break
+            result, is_query = item
+            response = yield result
+            pipeline.release()
+            if not is_query:
+                continue
+            try:
+                yield stream.write(format_response(response))
+            except tornado.iostream.StreamClosedError:
+                pass
+
+    @staticmethod
+    @tornado.gen.coroutine
+    def execute(slot, command):
+        """ Send command to the module in the slot
+        :return: Future resolving to module.scpi() result, or SCPI error
+                string if there is no module in the slot, module is locked
+                or command failed
+        """
+        module = None
+        if 0 <= slot < len(hwconf.modules):
+            module = hwconf.modules[slot]
+        if module is None:
+            raise tornado.gen.Return(HARDWARE_MISSING)
+        # raw socket clients are anonymous, so they can't use modules locked
+        # through web API. Broadcast module (slot 0) can't be locked
+        if slot and getattr(module, 'used_by', None) is not None:
+            raise tornado.gen.Return(MODULE_LOCKED)
+        try:
+            result = yield tornado.gen.maybe_future(module.scpi(command))
+        except tornado.iostream.StreamClosedError:
+            result = HARDWARE_MISSING
+        except Exception:
+            logging.exception("SCPI command %r failed", command)
+            result = EXECUTION_ERROR
+        raise tornado.gen.Return(result)
+
+
+def listen():
+    """ Start raw socket servers according to options """
+    RawSocketServer().listen(options.raw_socket_port)
+    if options.raw_socket_slot_port:
+        for slot in range(1, options.raw_socket_slots + 1):
+            RawSocketServer(slot).listen(
+                options.raw_socket_slot_port + slot - 1)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This module records numeric data generated by modules to disk.
+Every recording is a sequence of files (parts) with fixed size records
+(timestamp, value), both are little endian doubles. Files are memory mapped
+and grow by chunks, so writing a sample does not involve system calls and
+does not block IOLoop. When part reaches options.recorder_file_size, next
+part is started.
+
+Files are named <recording name>.<part number>.rec, where recording name is
+slot<N>-<start time>, e.g. slot1-20150301-120000.0000.rec
+"""
+
+import errno
+import mmap
+import os
+import re
+import struct
+import time
+
+from tornado.options import define, options
+
+from easy_phi import timeseries, utils
+
+define('recorder_path', default='/var/lib/easy_phi/recordings')
+# max size of recording file, bytes. Next file is started when it is reached
+define('recorder_file_size', default=64 * 1024 * 1024)
+# files are extended by this number of bytes at once
+define('recorder_chunk_size', default=1024 * 1024)
+
+RECORD = struct.Struct('<dd')
+# NumPy dtype of the record, see utils.npy_header()
+RECORD_DTYPE = [('t', '<f8'), ('value', '<f8')]
+
+_file_name = re.compile(r'(slot(\d+)-\d{8}-\d{6}(?:-\d+)?)\.(\d{4})\.rec$')
+
+
+def _part_path(name, part):
+    return os.path.join(options.recorder_path,
+                        "{0}.{1:04d}.rec".format(name, part))
+
+
+class Recorder(object):
+    """ Recording of data generated by module in a slot """
+    _file = None
+    _map = None
+
+    def __init__(self, slot, name):
+        self.slot = slot
+        self.name = name
+        self.part = -1
+        self.offset = 0  # bytes written to current part
+        self.records = 0  # total number of records written
+        self._next_part()
+
+    def _close_part(self):
+        if self._map is None:
+            return
+        if self.offset:
+            # also truncates file
+            self._map.resize(self.offset)
+            self._map.close()
+        else:
+            self._map.close()
+            self._file.truncate(0)
+        self._file.close()
+        self._map = self._file = None
+
+    def _next_part(self):
+        self._close_part()
+        self.part += 1
+        self.offset = 0
+        self._file = open(_part_path(self.name, self.part), 'w+b')
+        self._file.truncate(options.recorder_chunk_size)
+        self._map = mmap.mmap(self._file.fileno(), options.recorder_chunk_size)
+
+    def write(self, timestamp, value):
+        if self.offset + RECORD.size > options.recorder_file_size:
+            self._next_part()
+        elif self.offset + RECORD.size > len(self._map):
+            self._map.resize(min(len(self._map) + options.recorder_chunk_size,
+                                 options.recorder_file_size))
+        RECORD.pack_into(self._map, self.offset, timestamp, value)
+        self.offset += RECORD.size
+        self.records += 1
+
+    def close(self):
+        self._close_part()
+
+
+# slot: Recorder, active recordings
+recorders = {}
+
+
+def start(slot):
+    """ Start recording data of the slot
+    :param slot: slot number
+    :return: recording name
+    """
+    if slot in recorders:
+        return recorders[slot].name
+    try:
+        os.makedirs(options.recorder_path)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+    name = "slot{0}-{1}".format(slot, time.strftime("%Y%m%d-%H%M%S"))
+    # recording started and stopped within a second
+    suffix = 0
+    while os.path.exists(_part_path(name, 0)):
+        suffix += 1
+        name = "slot{0}-{1}-{2}".format(
+            slot, time.strftime("%Y%m%d-%H%M%S"), suffix)
+    recorders[slot] = Recorder(slot, name)
+    return name
+
+
+def stop(slot):
+    """ Stop recording data of the slot
+    :return: recording name, None if slot was not recorded
+    """
+    recorder = recorders.pop(slot, None)
+    if recorder is None:
+        return None
+    recorder.close()
+    return recorder.name
+
+
+def _parts(name):
+    """ Return list of (path, size of valid data) of recording parts """
+    active = None
+    for recorder in recorders.values():
+        if recorder.name == name:
+            active = recorder
+    parts = []
+    part = 0
+    while os.path.exists(_part_path(name, part)):
+        path = _part_path(name, part)
+        if active is not None and part == active.part:
+            size = active.offset
+        else:
+            size = _valid_size(path)
+        parts.append((path, size))
+        part += 1
+    return parts
+
+
+def _valid_size(path):
+    """ Size of file without unused space at the end. Normally, file is
+    truncated when recording is stopped, but not if server crashed """
+    size = os.path.getsize(path)
+    size -= size % RECORD.size
+    if not size:
+        return 0
+    with open(path, 'rb') as rec_file:
+        rec_map = mmap.mmap(rec_file.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            # timestamps are non-zero, unused space is zero filled.
+            # Binary search for the first unused record
+            lo, hi = 0, size // RECORD.size
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if RECORD.unpack_from(rec_map, mid * RECORD.size)[0]:
+                    lo = mid + 1
+                else:
+                    hi = mid
+        finally:
+            rec_map.close()
+    return lo * RECORD.size
+
+
+def list_recordings():
+    """ List recordings available on disk
+    :return: list of dictionaries with recording name, slot, number of
+            records and boolean active flag
+    """
+    recordings = {}
+    try:
+        file_names = os.listdir(options.recorder_path)
+    except OSError:  # nothing was recorded yet
+        file_names = []
+    for file_name in file_names:
+        match = _file_name.match(file_name)
+        if match is not None:
+            recordings[match.group(1)] = int(match.group(2))
+    active = set(recorder.name for recorder in recorders.values())
+    return [{
+        'name': name,
+        'slot': slot,
+        'records': sum(size for _, size in _parts(name)) // RECORD.size,
+        'active': name in active,
+    } for name, slot in sorted(recordings.items())]
+
+
+def exists(name):
+    return _file_name.match(name + ".0000.rec") is not None and \
+        os.path.exists(_part_path(name, 0))
+
+
+def export(name, fmt, chunk_size=65536):
+    """ Generator of recording data chunks, to stream recording without
+    loading it into memory
+    :param name: recording name
+           fmt: 'csv' for text, 'npy' for NumPy array file
+           chunk_size: bytes of recording to read at once
+    """
+    parts = _parts(name)
+    chunk_size -= chunk_size % RECORD.size
+    if fmt == 'npy':
+        yield utils.npy_header(
+            RECORD_DTYPE, sum(size for _, size in parts) // RECORD.size)
+    else:
+        yield "timestamp,value\n"
+    for path, size in parts:
+        with open(path, 'rb') as rec_file:
+            while size > 0:
+                chunk = rec_file.read(min(chunk_size, size))
+                if not chunk:
+                    break
+                size -= len(chunk)
+                if fmt == 'npy':
+                    yield chunk
+                else:
+                    yield "".join(
+                        "{0!r},{1!r}\n".format(*RECORD.unpack_from(chunk, pos))
+                        for pos in range(0, len(chunk), RECORD.size))
+
+
+def data_callback(slot, data):
+    """ Record numbers from data generated by a module, see
+    hwconf.data_callback() """
+    recorder = recorders.get(slot)
+    if recorder is None or isinstance(data, memoryview):
+        return
+    timestamp = time.time()
+    for value in timeseries.parse_samples(data):
+        recorder.write(timestamp, value)
+
+
+def hwconf_callback(slot, added):
+    """ Stop recording when module is removed """
+    if not added:
+        stop(slot)
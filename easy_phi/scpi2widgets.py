@@ -5,57 +5,116 @@ Utility library to convert list of supported SCPI commands to HTML widgets
 """
 
 import logging
+import os
 import ConfigParser
 
 from tornado.options import options, define
 
+from easy_phi import utils
 
-define("widgets_conf_path", default='/etc/easy_phi/widgets.conf')
 
-# This is a ConfigParser object for lazy initialization in scpi2widgets()
-_widgets_storage = None
+define("widgets_conf_path", default='/etc/easy_phi/widgets.conf')
 
 
-def scpi2widgets(configuration):
-    """ Return javascript widgets to create UI corresponding to supported
-    SCPI commands.
-
-    :param configuration: list (iterable) of SCPI commands supported by module.
-            This list can be obtained by module.get_configuration
-    :return: list of widgets, i.e. chunks of javascript creating web UI
+class WidgetsIndex(object):
+    """ Compiled widgets configuration
+    Widgets are matched by inverted index (SCPI command: sections requiring
+    it), so only sections sharing commands with module are checked.
     """
-    global _widgets_storage
 
-    def valid_section(section):
-        return _widgets_storage.has_option(section, 'scpi') and \
-            _widgets_storage.has_option(section, 'widget')
+    def __init__(self, parser):
+        """
+        :param parser: ConfigParser with widgets configuration
+        """
+        # (set of required commands, widget) in order of sections in file
+        self.sections = []
+        self.index = {}  # SCPI command: list of indexes in self.sections
+        self.default_widget = parser.defaults().get('default_widget')
+        # frozenset of module commands: tuple of widgets
+        self._matches = {}
 
-    if _widgets_storage is None:  # lazy initialization
-        _widgets_storage = ConfigParser.ConfigParser()
-        _widgets_storage.read(options.widgets_conf_path)
-        if 'scpi' in _widgets_storage.defaults() or \
-                'widget' in _widgets_storage.defaults():
+        if 'scpi' in parser.defaults() or 'widget' in parser.defaults():
             logging.warning("widgets configuration file has default values "
                             "for scpi or widget (it should not)")
-        for section in _widgets_storage.sections():
-            if not valid_section(section):
+        for section in parser.sections():
+            if not (parser.has_option(section, 'scpi') and
+                    parser.has_option(section, 'widget')):
                 logging.warning("Section {0} does not define "
                                 "scpi or widget attribute".format(section))
+                continue
+            commands = frozenset(parser.get(section, 'scpi').split("\n"))
+            for command in commands:
+                self.index.setdefault(command, []).append(len(self.sections))
+            self.sections.append((commands, parser.get(section, 'widget')))
+
+    def match(self, configuration):
+        """ Get widgets for module configuration. Sections are checked in
+        order of configuration file, every command is shown by the first
+        widget requiring it
+        :param configuration: frozenset of supported SCPI commands
+        :return: tuple of widgets
+        """
+        widgets = self._matches.get(configuration)
+        if widgets is not None:
+            return widgets
+
+        candidates = set()
+        for command in configuration:
+            candidates.update(self.index.get(command, ()))
+
+        available = set(configuration)
+        widgets = []
+        for position in sorted(candidates):
+            commands, widget = self.sections[position]
+            if available.issuperset(commands):
+                if widget:  # commands in ignore list have empty widgets
+                    widgets.append(widget)
+                available.difference_update(commands)
+
+        if self.default_widget is not None:
+            widgets.append(self.default_widget)
+
+        widgets = tuple(widgets)
+        self._matches[configuration] = widgets
+        return widgets
 
-    module_conf = set(configuration)
-    widgets = []
 
-    for section in _widgets_storage.sections():
-        if not valid_section:
-            continue
-        widget_conf = _widgets_storage.get(section, 'scpi').split("\n")
-        if module_conf.issuperset(widget_conf):
-            widget = _widgets_storage.get(section, 'widget')
-            if widget:  # commands in ignore list have empty widgets
-                widgets.append(widget)
-            module_conf = module_conf.difference(widget_conf)
+# This is a WidgetsIndex object for lazy initialization in scpi2widgets(),
+# it is rebuilt when configuration file is modified
+_widgets_index = None
+# (path, modification time) of configuration file _widgets_index is built of
+_widgets_conf_version = None
 
-    if 'default_widget' in _widgets_storage.defaults():
-        widgets.append(_widgets_storage.defaults()['default_widget'])
 
-    return widgets
+def _get_widgets_index():
+    global _widgets_index, _widgets_conf_version
+    path = options.widgets_conf_path
+    try:
+        version = (path, os.stat(path).st_mtime)
+    except OSError:  # ConfigParser ignores missing files as well
+        version = (path, None)
+
+    if _widgets_index is None or version != _widgets_conf_version:
+        parser = ConfigParser.ConfigParser()
+        parser.read(path)
+        _widgets_index = WidgetsIndex(parser)
+        _widgets_conf_version = version
+        utils.bump_generation()
+    return _widgets_index
+
+
+def refresh():
+    """ Reload widgets configuration if file was modified. Generation of
+    platform state is bumped then, see utils.generation """
+    _get_widgets_index()
+
+
+def scpi2widgets(configuration):
+    """ Return javascript widgets to create UI corresponding to supported
+    SCPI commands.
+
+    :param configuration: list (iterable) of SCPI commands supported by module.
+            This list can be obtained by module.get_configuration
+    :return: list of widgets, i.e. chunks of javascript creating web UI
+    """
+    return list(_get_widgets_index().match(frozenset(configuration)))
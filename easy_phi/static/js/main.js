@@ -18,6 +18,8 @@ var ep = window['ep'] || {
     _empty_slot_str: "Empty slot", // moved out of func for localization purposes
     _broadcast_slot: 0,
     _ws: null, //WebSocket object
+    _scpi_id: 0, //id of the last SCPI request sent through WebSocket
+    _scpi_callbacks: {}, //request id: callback, for requests sent through WebSocket
     _console: document.getElementById("console_log"),
 
     init: function(base_url) {
@@ -64,6 +66,17 @@ var ep = window['ep'] || {
 
     scpi: function(slot_id, scpi_command, callback) {
         ep.log("Slot "+slot_id+": Request: " + scpi_command);
+        if (ep._ws.readyState == WebSocket.OPEN && ep._ws.onmessage) {
+            // commands are sent through WebSocket, response comes with the same id
+            ep._scpi_id += 1;
+            ep._scpi_callbacks[ep._scpi_id] = function(scpi_response) {
+                if (callback != null) callback(scpi_response);
+                ep.log("Slot "+slot_id+": Response: " + scpi_response);
+            };
+            ep._ws.send(JSON.stringify(
+                {id: ep._scpi_id, slot: slot_id, command: scpi_command}));
+            return;
+        }
         $.post(
             ep.base_url + '/api/v1/send_scpi?format=json&slot='+slot_id,
             scpi_command,
@@ -153,7 +166,14 @@ var ep = window['ep'] || {
         $.get(ep.base_url+"/api/v1/modules_list?format=json", function(modules){
             modules.forEach(function(module_name, slot_id) {
                 ep._add_module(module_list_container, slot_id, ep._empty_slot_str);
-                ep._updateModuleUI(slot_id, module_name);
+                ep._updateModuleUI(slot_id, module_name, true);
+            });
+            // UI of all modules is loaded in one request
+            $.getScript(ep.base_url + '/api/v1/modules_ui').done(function(){
+                modules.forEach(function(module_name, slot_id) {
+                    if (module_name != null)
+                        $("#module_header_"+slot_id).addClass("active");
+                });
             });
 
             // Websocket handler assigned after module list updated manually to
@@ -162,7 +182,7 @@ var ep = window['ep'] || {
         });
     },
 
-    _updateModuleUI: function(slot_id, module_name) {
+    _updateModuleUI: function(slot_id, module_name, skip_widgets) {
         /* TODO: replace with next sibling selector (less chance to be screwed
         up with custom themes */
         var control_panel = $("#module_control_panel_"+slot_id);
@@ -186,7 +206,7 @@ var ep = window['ep'] || {
                 });
         }
 
-        if (module_name == null) return;
+        if (module_name == null || skip_widgets) return;
 
         // FROM THIS POINT ON, IT IS A REAL MODULE
         // get module webUI based on config
@@ -226,6 +246,28 @@ var ep = window['ep'] || {
         var message = event.data;
         console.log("Message from ws: " + message);
         var json = JSON.parse(message);
+        // messages produced at the same time are sent as an array
+        if ($.isArray(json)) {
+            $.each(json, function(index, item) {
+                ep._handleWSMessage(item);
+            });
+        } else {
+            ep._handleWSMessage(json);
+        }
+    },
+
+    _handleWSMessage: function (json) {
+        if (json.id !== undefined && json.id in ep._scpi_callbacks) {
+            //Response to SCPI request
+            var scpi_callback = ep._scpi_callbacks[json.id];
+            delete ep._scpi_callbacks[json.id];
+            if (json.error !== undefined) {
+                ep.log("Error: " + json.error);
+            } else {
+                scpi_callback(json.result);
+            }
+            return;
+        }
         switch (json.msg_type) {
             case 'MODULE_UPDATE':
                 //Request to update Module info has been received
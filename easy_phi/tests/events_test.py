@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+""" Unit tests for easy_phi.events module """
+
+import json
+
+import tornado.testing
+from tornado.test.util import unittest
+
+from easy_phi import events
+
+
+class EventLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log = events.EventLog(max_size=3)
+
+    def publish(self, slot):
+        return self.log.publish({'msg_type': 'LOCK_UPDATE', 'slot': slot})
+
+    def test_since(self):
+        for slot in range(1, 3):
+            self.publish(slot)
+        self.assertEqual(self.log.since(2), [])
+        since = self.log.since(0)
+        self.assertEqual([event[:2] for event in since],
+                         [(1, 'LOCK_UPDATE'), (2, 'LOCK_UPDATE')])
+        self.assertEqual(json.loads(since[1][2]),
+                         {'msg_type': 'LOCK_UPDATE', 'slot': 2})
+        self.assertEqual([event[0] for event in self.log.since(1)], [2])
+
+    def test_bounded(self):
+        for slot in range(1, 6):
+            self.publish(slot)
+        self.assertEqual(len(self.log.events), 3)
+        # events 3..5 are available
+        self.assertEqual([event[0] for event in self.log.since(2)], [3, 4, 5])
+        # event 2 was dropped
+        self.assertIsNone(self.log.since(1))
+        # unknown id, e.g. server restarted
+        self.assertIsNone(self.log.since(10))
+        self.assertIsNone(self.log.since(None))
+
+    def test_event_id(self):
+        client_id = self.log.format_id(5)
+        self.assertEqual(self.log.parse_id(client_id), 5)
+        # issued before server restart
+        self.assertIsNone(events.EventLog().parse_id("1-5"))
+        self.assertIsNone(self.log.parse_id("5"))
+        self.assertIsNone(self.log.parse_id(self.log.epoch + "-x"))
+
+    def test_format_event(self):
+        self.assertEqual(events.format_event(1, 'RESYNC', '{}'),
+                         "id: 1\nevent: RESYNC\ndata: {}\n\n")
+
+
+class EventLogWaitTest(tornado.testing.AsyncTestCase):
+
+    @tornado.testing.gen_test
+    def test_wait(self):
+        log = events.EventLog()
+        future = log.wait(1)
+        log.publish({'msg_type': 'DATA_UPDATE'})
+        published = yield future
+        self.assertTrue(published)
+        published = yield log.wait(0.01)
+        self.assertFalse(published)
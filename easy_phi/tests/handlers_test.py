@@ -2,14 +2,21 @@
 
 """ Unit tests for Tornado web app handlers of Easy Phi platform """
 
+import collections
 import json
+import shutil
+import struct
+import tempfile
 
+import tornado.concurrent
+import tornado.httpclient
 import tornado.testing
 from tornado.options import options
 import tornado.websocket
 from tornado import gen
+from tornado.test.util import unittest
 
-from easy_phi import app
+from easy_phi import app, auth, events, hwconf, recorder, timeseries, utils
 
 
 class BaseTestCase(tornado.testing.AsyncHTTPTestCase):
@@ -50,6 +57,56 @@ class PlatformInfoTest(BaseTestCase):
                 "Field '{0}' not found in platform info".format(field))
 
 
+class ConditionalGetTest(BaseTestCase):
+
+    url_name = 'api_module_list'
+
+    def test_not_modified(self):
+        response = self.fetch(self.url)
+        self.failIf(response.error)
+        etag = response.headers.get('Etag')
+        self.assertTrue(etag)
+
+        response = self.fetch(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, '')
+
+        # ETag depends on format
+        response = self.fetch(self.url.replace('json', 'plain'),
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+
+    def test_jsonp(self):
+        """ JSONP callback is not a part of cache key """
+        before = len(app._response_cache._values)
+        for index in range(5):
+            response = self.fetch(self.url + "&callback=cb{0}".format(index))
+            self.assertTrue(response.body.startswith("cb{0}([".format(index)))
+        etag = response.headers.get('Etag')
+        self.assertLessEqual(len(app._response_cache._values), before + 2)
+
+        response = self.fetch(self.url + "&callback=cb4",
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+        # ETag depends on callback
+        response = self.fetch(self.url + "&callback=cb3",
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+
+    def test_generation(self):
+        etag = self.fetch(self.url).headers.get('Etag')
+        hwconf.modules.append(BinaryBlockModule())
+        try:
+            utils.bump_generation()
+            response = self.fetch(self.url, headers={'If-None-Match': etag})
+            self.assertEqual(response.code, 200)
+            self.assertEqual(json.loads(response.body)[-1],
+                             BinaryBlockModule.name)
+        finally:
+            hwconf.modules.pop()
+            utils.bump_generation()
+
+
 class ContentTypeTest(BaseTestCase):
 
     url_name = 'api_platform_info'
@@ -70,6 +127,26 @@ class ContentTypeTest(BaseTestCase):
                 'text/plain'),
             "Wrong response content type for 'format=plain'")
 
+    @unittest.skipIf(utils.msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        headers = {'Accept': 'application/x-msgpack, application/json'}
+        response = self.fetch(self.url, headers=headers)
+        self.assertEqual(response.headers.get('Content-Type'),
+                         'application/msgpack')
+        self.assertIn('Accept', response.headers.get('Vary', ''))
+        self.assertIn('sw_version',
+                      utils.msgpack.unpackb(response.body, raw=False))
+        # format parameter takes precedence over Accept header
+        response = self.fetch(self.url + '?format=json', headers=headers)
+        self.assertIn('sw_version', json.loads(response.body))
+
+    @unittest.skipIf(utils.cbor2 is None, "cbor2 is not installed")
+    def test_cbor(self):
+        response = self.fetch(self.url + '?format=cbor')
+        self.assertEqual(response.headers.get('Content-Type'),
+                         'application/cbor')
+        self.assertIn('sw_version', utils.cbor2.loads(response.body))
+
 
 class ModuleInfoTest(BaseTestCase):
 
@@ -224,6 +301,250 @@ class SCPICommandTest(BaseTestCase):
                     "{0}".format(response.body))
 
 
+class BinaryBlockModule(object):
+    """ Module returning IEEE 488.2 binary block """
+    name = 'Binary module'
+
+    def scpi(self, command):
+        return memoryview(struct.pack('<3f', 1, 2, 3))
+
+
+class BinaryResponseTest(BaseTestCase):
+
+    url_name = 'api_send_scpi'
+    format = None
+
+    def setUp(self):
+        super(BinaryResponseTest, self).setUp()
+        module = BinaryBlockModule()
+        # dummy auth backend user, to pass user lock check
+        module.used_by = auth.user_by_token('')
+        hwconf.modules.append(module)
+        self.url += '?slot={0}'.format(len(hwconf.modules) - 1)
+
+    def tearDown(self):
+        hwconf.modules.pop()
+        super(BinaryResponseTest, self).tearDown()
+
+    def test_octet_stream(self):
+        response = self.fetch(self.url, method='POST', body='TRAC:DATA?')
+        self.failIf(response.error)
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/octet-stream')
+        self.assertEqual(response.body, struct.pack('<3f', 1, 2, 3))
+
+    def test_npy(self):
+        response = self.fetch(self.url + '&dtype=<f4', method='POST',
+                              body='TRAC:DATA?')
+        self.failIf(response.error)
+        self.assertTrue(response.body.startswith(utils.npy_header('<f4', 3)))
+        self.assertTrue(response.body.endswith(struct.pack('<3f', 1, 2, 3)))
+
+        # data size is not a multiple of item size
+        response = self.fetch(self.url + '&dtype=<f8', method='POST',
+                              body='TRAC:DATA?')
+        self.assertEqual(response.code, 400)
+
+
+class TimeSeriesTest(BaseTestCase):
+
+    url_name = 'api_timeseries'
+
+    def setUp(self):
+        super(TimeSeriesTest, self).setUp()
+        module = BinaryBlockModule()
+        hwconf.modules.append(module)
+        self.slot = len(hwconf.modules) - 1
+        self.url += '&slot={0}'.format(self.slot)
+
+    def tearDown(self):
+        hwconf.modules.pop()
+        timeseries.buffers.pop(self.slot, None)
+        super(TimeSeriesTest, self).tearDown()
+
+    def test_timeseries(self):
+        response = self.fetch(self.url)
+        self.failIf(response.error)
+        self.assertEqual(json.loads(response.body)['t'], [])
+
+        for value in range(10):
+            timeseries.data_callback(self.slot, str(value))
+        response = self.fetch(self.url + '&points=1')
+        self.failIf(response.error)
+        result = json.loads(response.body)
+        self.assertEqual(result['min'], [0])
+        self.assertEqual(result['max'], [9])
+
+        response = self.fetch(self.url + '&points=x')
+        self.assertEqual(response.code, 400)
+
+
+class RecordTest(BaseTestCase):
+
+    url_name = 'api_record'
+
+    def setUp(self):
+        super(RecordTest, self).setUp()
+        self.recorder_path = options.recorder_path
+        options.recorder_path = tempfile.mkdtemp()
+        module = BinaryBlockModule()
+        module.used_by = auth.user_by_token('')
+        hwconf.modules.append(module)
+        self.slot = len(hwconf.modules) - 1
+        self.url += '&slot={0}'.format(self.slot)
+
+    def tearDown(self):
+        hwconf.modules.pop()
+        recorder.stop(self.slot)
+        shutil.rmtree(options.recorder_path)
+        options.recorder_path = self.recorder_path
+        super(RecordTest, self).tearDown()
+
+    def test_record(self):
+        response = self.fetch(self.url, method='POST', body='')
+        self.failIf(response.error)
+        name = json.loads(response.body)['name']
+        recorder.data_callback(self.slot, "0.5")
+        response = self.fetch(self.url, method='DELETE')
+        self.failIf(response.error)
+
+        response = self.fetch(
+            self._app.reverse_url('api_recordings') + '?format=json')
+        self.assertEqual(json.loads(response.body)[0]['name'], name)
+
+        response = self.fetch(
+            self._app.reverse_url('api_recording_export') +
+            '?format=csv&name=' + name)
+        self.failIf(response.error)
+        self.assertEqual(response.body.splitlines()[1].split(",")[1], "0.5")
+
+        response = self.fetch(
+            self._app.reverse_url('api_recording_export') +
+            '?format=csv&name=../etc/passwd')
+        self.assertEqual(response.code, 404)
+
+    def test_user_lock(self):
+        """ Recording of module locked by another user can't be stopped """
+        response = self.fetch(self.url, method='POST', body='')
+        self.failIf(response.error)
+        hwconf.modules[self.slot].used_by = 'another user'
+        response = self.fetch(self.url, method='DELETE')
+        self.assertEqual(response.code, 409)
+        self.assertIsNotNone(recorder.recorders.get(self.slot))
+
+
+class SCPIBatchTest(BaseTestCase):
+    """ Test sending batch of SCPI commands to multiple modules """
+
+    url_name = 'api_send_scpi_batch'
+
+    def test_malformed_batch(self):
+        for body in ('*IDN?', '{"slot": 0, "command": "*IDN?"}',
+                     '[{"slot": 0}]', '[{"slot": 0, "command": 5}]',
+                     '[{"slot": 0, "command": ["*IDN?"]}]'):
+            response = self.fetch(self.url, method='POST', body=body,
+                                  headers=self.headers)
+            self.assertEqual(
+                response.code, 400,
+                "Malformed batch did not cause error response: " + body)
+
+    def test_batch(self):
+        batch = [
+            {'slot': 0, 'command': 'RAck:Size?'},
+            {'slot': 65535, 'command': '*IDN?'},
+            {'slot': 0, 'command': 'SYSTem:VERSion?'},
+        ]
+        response = self.fetch(self.url, method='POST', body=json.dumps(batch),
+                              headers=self.headers)
+        self.failIf(response.error)
+        results = json.loads(response.body)
+
+        self.assertIsInstance(results, list)
+        self.assertEqual(len(results), len(batch),
+                         "Batch response expected to have entry per command")
+        self.assertEqual(results[0], {'slot': 0, 'result': len(options.ports)})
+        self.assertIn('error', results[1],
+                      "Invalid slot in batch did not cause error entry")
+        self.assertEqual(results[2],
+                         {'slot': 0, 'result': options.sw_version})
+
+    def test_concurrency(self):
+        """ Commands for different slots run concurrently, commands for the
+        same slot run in order """
+        log = []
+
+        class SlowModule(object):
+            used_by = auth.user_by_token('')
+
+            def __init__(self, name):
+                self.name = name
+
+            @gen.coroutine
+            def scpi(self, command):
+                log.append(('start', self.name, command))
+                yield gen.sleep(0.05)
+                log.append(('end', self.name, command))
+                raise gen.Return(command)
+
+        hwconf.modules.extend([SlowModule('A'), SlowModule('B')])
+        slot = len(hwconf.modules) - 2
+        batch = [
+            {'slot': slot, 'command': 'A1?'},
+            {'slot': slot, 'command': 'A2?'},
+            {'slot': slot + 1, 'command': 'B1?'},
+        ]
+        try:
+            response = self.fetch(self.url, method='POST',
+                                  body=json.dumps(batch), headers=self.headers)
+        finally:
+            del hwconf.modules[-2:]
+        self.failIf(response.error)
+        self.assertEqual(json.loads(response.body), [
+            {'slot': slot, 'result': 'A1?'},
+            {'slot': slot, 'result': 'A2?'},
+            {'slot': slot + 1, 'result': 'B1?'},
+        ])
+        # B1 started before A1 finished
+        self.assertLess(log.index(('start', 'B', 'B1?')),
+                        log.index(('end', 'A', 'A1?')))
+        # A2 started after A1 finished
+        self.assertLess(log.index(('end', 'A', 'A1?')),
+                        log.index(('start', 'A', 'A2?')))
+
+    def test_module_error(self):
+        """ Failure of one module does not lose other results """
+        class FailingModule(object):
+            used_by = auth.user_by_token('')
+
+            def scpi(self, command):
+                raise ValueError(command)
+
+        hwconf.modules.append(FailingModule())
+        batch = [
+            {'slot': len(hwconf.modules) - 1, 'command': '*IDN?'},
+            {'slot': 0, 'command': 'SYSTem:VERSion?'},
+        ]
+        try:
+            response = self.fetch(self.url, method='POST',
+                                  body=json.dumps(batch), headers=self.headers)
+        finally:
+            hwconf.modules.pop()
+        self.failIf(response.error)
+        results = json.loads(response.body)
+        self.assertEqual(results[0]['error'], 'SCPI command failed')
+        self.assertEqual(results[1],
+                         {'slot': 0, 'result': options.sw_version})
+
+    @unittest.skipIf(utils.msgpack is None, "msgpack is not installed")
+    def test_native_numbers(self):
+        batch = [{'slot': 0, 'command': 'RAck:Size?'}]
+        response = self.fetch(self.url + '&format=msgpack', method='POST',
+                              body=json.dumps(batch), headers=self.headers)
+        self.failIf(response.error)
+        results = utils.msgpack.unpackb(response.body, raw=False)
+        self.assertEqual(results, [{'slot': 0, 'result': len(options.ports)}])
+
+
 class ModuleUIHandlerTest(BaseTestCase):
 
     url_name = 'api_widgets'
@@ -266,6 +587,52 @@ class ModuleUIHandlerTest(BaseTestCase):
             response.code, 400,
             "Request without slot number did not cause error response")
 
+    def test_cache(self):
+        url = self.url + "?slot=0&container=%23blah"
+        response = self.fetch(url + "&_=1", headers=self.headers)
+        self.failIf(response.error)
+        # script does not depend on time, e.g. widget ids, so it is cached
+        cached = self.fetch(url + "&_=2", headers=self.headers)
+        self.assertEqual(response.body, cached.body)
+        self.assertEqual(response.headers.get('Etag'),
+                         cached.headers.get('Etag'))
+
+    def test_cache_size(self):
+        """ client supplied container is not cached """
+        self.fetch(self.url + "?slot=0&container=%23a", headers=self.headers)
+        scripts = len(app._ui_scripts._values)
+        responses = len(app._response_cache._values)
+        for index in range(5):
+            response = self.fetch(
+                self.url + "?slot=0&container=%23c{0}".format(index),
+                headers=self.headers)
+            self.assertTrue(response.body.endswith(
+                '(0, "#c{0}");\n'.format(index)))
+        self.assertEqual(len(app._ui_scripts._values), scripts)
+        self.assertEqual(len(app._response_cache._values), responses)
+
+    def test_bundle(self):
+        url = self._app.reverse_url('api_widgets_bundle')
+        response = self.fetch(url, headers=self.headers)
+        self.failIf(response.error)
+        self.assertEqual(response.headers.get('Content-Type'),
+                         'application/javascript')
+        # broadcast module is always there
+        self.assertIn('(0, "#module_control_panel_0");', response.body)
+
+        response = self.fetch(url + "?container=.slot{slot}",
+                              headers=self.headers)
+        self.assertIn('(0, ".slot0");', response.body)
+
+    def test_shared_script(self):
+        """ modules with the same configuration share cached script body """
+        module = hwconf.modules[0]
+        first = app.module_ui_script(1, module, '#a')
+        second = app.module_ui_script(2, module, '#b')
+        self.assertEqual(first[:-len('(1, "#a");\n')],
+                         second[:-len('(2, "#b");\n')])
+        self.assertTrue(second.endswith('(2, "#b");\n'))
+
     def test_mime_type(self):
         # test on Broadcast pseudo module
         response = self.fetch(self.url+"?slot=0&container=%23blah",
@@ -279,13 +646,110 @@ class ModuleUIHandlerTest(BaseTestCase):
         )
 
 
+class EventsTest(BaseTestCase):
+
+    url_name = 'api_events'
+    format = None
+
+    def setUp(self):
+        super(EventsTest, self).setUp()
+        self.keepalive = options.events_keepalive
+        options.events_keepalive = 0.1
+
+    def tearDown(self):
+        options.events_keepalive = self.keepalive
+        super(EventsTest, self).tearDown()
+
+    @tornado.testing.gen_test
+    def test_resume(self):
+        """ Client receives events published after Last-Event-ID """
+        app.lock_callback(1, 'user')
+        last_id = events.log.last_id
+        app.lock_callback(1, None)
+
+        chunks = []
+        future = self.http_client.fetch(
+            self.get_url(self.url), streaming_callback=chunks.append,
+            headers={'Last-Event-ID': events.log.format_id(last_id)},
+            request_timeout=0.5)
+        yield gen.sleep(0.1)
+        app.data_callback(1, '0.5')
+        yield gen.sleep(0.1)
+
+        stream = ''.join(chunks)
+        self.assertNotIn(
+            "id: {0}\n".format(events.log.format_id(last_id)), stream)
+        self.assertIn("id: {0}\nevent: LOCK_UPDATE\n".format(
+            events.log.format_id(last_id + 1)), stream)
+        self.assertIn("id: {0}\nevent: DATA_UPDATE\n".format(
+            events.log.format_id(last_id + 2)), stream)
+        # stream is endless, so request ends by timeout
+        with self.assertRaises(tornado.httpclient.HTTPError):
+            yield future
+
+    @tornado.testing.gen_test
+    def test_resync(self):
+        """ Unknown Last-Event-ID means client has to refetch state """
+        chunks = []
+        future = self.http_client.fetch(
+            self.get_url(self.url), streaming_callback=chunks.append,
+            headers={'Last-Event-ID': events.log.format_id(
+                events.log.last_id + 100)},
+            request_timeout=0.2)
+        with self.assertRaises(tornado.httpclient.HTTPError):
+            yield future
+        self.assertIn("event: RESYNC\n", ''.join(chunks))
+
+    @tornado.testing.gen_test
+    def test_restart(self):
+        """ Event ids issued before server restart cause RESYNC """
+        chunks = []
+        future = self.http_client.fetch(
+            self.get_url(self.url), streaming_callback=chunks.append,
+            headers={'Last-Event-ID': str(events.log.last_id)},
+            request_timeout=0.2)
+        with self.assertRaises(tornado.httpclient.HTTPError):
+            yield future
+        self.assertIn("event: RESYNC\n", ''.join(chunks))
+
+    @tornado.testing.gen_test
+    def test_published_while_flushing(self):
+        """ Event published during flush is sent without waiting for the
+        next one """
+        options.events_keepalive = 10.0
+        flush = app.EventsHandler.flush
+        published = []
+
+        def flush_and_publish(handler, *args, **kwargs):
+            future = flush(handler, *args, **kwargs)
+            if not published:
+                app.data_callback(1, '0.5')
+                published.append(events.log.last_id)
+            return future
+
+        app.EventsHandler.flush = flush_and_publish
+        chunks = []
+        try:
+            future = self.http_client.fetch(
+                self.get_url(self.url), streaming_callback=chunks.append,
+                request_timeout=0.3)
+            with self.assertRaises(tornado.httpclient.HTTPError):
+                yield future
+        finally:
+            app.EventsHandler.flush = flush
+        self.assertIn("id: {0}\nevent: DATA_UPDATE\n".format(
+            events.log.format_id(published[0])), ''.join(chunks))
+
+
 class WebSocketBaseTestCase(tornado.testing.AsyncHTTPTestCase):
 
     @gen.coroutine
-    def ws_connect(self, path, compression_options=None):
-        ws = yield tornado.websocket.websocket_connect(
+    def ws_connect(self, path, compression_options=None, headers=None):
+        request = tornado.httpclient.HTTPRequest(
             'ws://127.0.0.1:%d%s' % (self.get_http_port(), path),
-            compression_options=compression_options)
+            headers=headers)
+        ws = yield tornado.websocket.websocket_connect(
+            request, compression_options=compression_options)
         raise gen.Return(ws)
 
     @gen.coroutine
@@ -309,3 +773,203 @@ class WebSocketTest(WebSocketBaseTestCase):
         response = yield ws.read_message()
         self.assertEqual(response, 'Echo:hello')
         yield self.close(ws)
+
+    @tornado.testing.gen_test
+    def test_subscription(self):
+        """ Client receives only updates of subscribed slots """
+        ws = yield self.ws_connect('/websocket')
+        ws.write_message(json.dumps({'subscribe': {'slots': [2]}}))
+        response = yield ws.read_message()
+        self.assertEqual(json.loads(response)['msg_type'], 'SUBSCRIBED')
+
+        app.data_callback(1, '0.1')
+        app.data_callback(2, '0.2')
+        response = yield ws.read_message()
+        self.assertEqual(json.loads(response), {
+            'msg_type': 'DATA_UPDATE', 'slot': 2, 'data': '0.2'})
+        yield self.close(ws)
+
+    @tornado.testing.gen_test
+    def test_binary_data(self):
+        """ Binary blocks are not sent, they are not representable in JSON """
+        ws = yield self.ws_connect('/websocket')
+        app.data_callback(1, memoryview(b"\x00\x01"))
+        app.data_callback(1, '0.1')
+        response = yield ws.read_message()
+        self.assertEqual(json.loads(response)['data'], '0.1')
+        yield self.close(ws)
+
+    @tornado.testing.gen_test
+    def test_coalescing(self):
+        """ Updates produced in the same IOLoop iteration share a frame """
+        ws = yield self.ws_connect('/websocket')
+        app.data_callback(1, '0.1')
+        app.lock_callback(1, None)
+        response = yield ws.read_message()
+        self.assertEqual([message['msg_type'] for message in
+                          json.loads(response)],
+                         ['DATA_UPDATE', 'LOCK_UPDATE'])
+        yield self.close(ws)
+
+    @tornado.testing.gen_test
+    def test_websockets_list(self):
+        ws = yield self.ws_connect('/websocket')
+        response = yield self.http_client.fetch(
+            self.get_url('/api/v1/websockets?format=json'))
+        clients = json.loads(response.body)
+        # connections of other tests might be not cleaned up yet
+        self.assertGreaterEqual(len(clients), 1)
+        self.assertEqual(set(clients[0]), {
+            'remote_ip', 'slots', 'msg_types', 'queued', 'dropped'})
+        yield self.close(ws)
+
+
+class WebSocketSCPITest(WebSocketBaseTestCase):
+
+    def get_app(self):
+        options.security_backend = 'easy_phi.auth.DummyLoginHandler'
+        return app.get_application()
+
+    @tornado.testing.gen_test
+    def test_scpi(self):
+        """ Responses are matched to requests by id """
+        ws = yield self.ws_connect('/websocket')
+        ws.write_message(json.dumps(
+            {'id': 1, 'slot': 0, 'command': 'RAck:Size?'}))
+        ws.write_message(json.dumps(
+            {'id': 2, 'slot': 'x', 'command': '*IDN?'}))
+        responses = {}
+        for _ in range(2):
+            response = json.loads((yield ws.read_message()))
+            responses[response['id']] = response
+        self.assertGreaterEqual(responses[1]['result'], len(options.ports))
+        self.assertIn('error', responses[2])
+        yield self.close(ws)
+
+    @tornado.testing.gen_test
+    def test_invalid_requests(self):
+        ws = yield self.ws_connect('/websocket')
+        ws.write_message(json.dumps({'id': 1, 'slot': 0, 'command': ' '}))
+        ws.write_message(json.dumps({'id': 2, 'slot': 0, 'command': None}))
+        for _ in range(2):
+            response = json.loads((yield ws.read_message()))
+            self.assertEqual(response['error'], 'SCPI command expected')
+        for subscription in ([1], {'slots': 2}, {'slots': [[1]]},
+                             {'msg_types': 'DATA_UPDATE'}):
+            ws.write_message(json.dumps({'subscribe': subscription}))
+            response = json.loads((yield ws.read_message()))
+            self.assertEqual(response, {'error': 'Invalid subscription'})
+        # connection is still usable
+        ws.write_message(json.dumps({'subscribe': {'slots': [1]}}))
+        response = json.loads((yield ws.read_message()))
+        self.assertEqual(response['msg_type'], 'SUBSCRIBED')
+        yield self.close(ws)
+
+    @tornado.testing.gen_test
+    def test_module_error(self):
+        """ Unexpected module failure is reported to client """
+        class FailingModule(object):
+            used_by = auth.user_by_token('')
+
+            def scpi(self, command):
+                raise ValueError(command)
+
+        hwconf.modules.append(FailingModule())
+        slot = len(hwconf.modules) - 1
+        try:
+            ws = yield self.ws_connect('/websocket')
+            ws.write_message(json.dumps(
+                {'id': 1, 'slot': slot, 'command': '*IDN?'}))
+            response = json.loads((yield ws.read_message()))
+        finally:
+            hwconf.modules.pop()
+        self.assertEqual(response['error'], 'SCPI command failed')
+        yield self.close(ws)
+
+    @tornado.testing.gen_test
+    def test_origin(self):
+        """ Pages of other sites can't open WebSocket """
+        with self.assertRaises(tornado.httpclient.HTTPError) as context:
+            yield self.ws_connect(
+                '/websocket', headers={'Origin': 'http://evil.example.com'})
+        self.assertEqual(context.exception.code, 403)
+        options.websocket_origins = ['http://lab.example.com']
+        try:
+            ws = yield self.ws_connect(
+                '/websocket', headers={'Origin': 'http://lab.example.com'})
+        finally:
+            options.websocket_origins = []
+        yield self.close(ws)
+        ws = yield self.ws_connect('/websocket', headers={
+            'Origin': 'http://127.0.0.1:%d' % self.get_http_port()})
+        yield self.close(ws)
+
+
+class WebSocketQueueTest(tornado.testing.AsyncTestCase):
+    """ Test outbound queue of a client which doesn't read fast enough """
+
+    def setUp(self):
+        super(WebSocketQueueTest, self).setUp()
+        self.queue_size = options.websocket_queue_size
+        self.queue_policy = options.websocket_queue_policy
+        options.websocket_queue_size = 2
+        # handler without connection, frames are "sent" by write_message()
+        self.websocket = app.WebSocketHandler.__new__(app.WebSocketHandler)
+        self.websocket.queue = collections.deque()
+        self.frames = []
+        self.write_futures = []
+        self.websocket.write_message = self.write_message
+        self.websocket.close = lambda: self.frames.append('CLOSE')
+
+    def tearDown(self):
+        options.websocket_queue_size = self.queue_size
+        options.websocket_queue_policy = self.queue_policy
+        super(WebSocketQueueTest, self).tearDown()
+
+    def write_message(self, frame):
+        self.frames.append(frame)
+        self.write_futures.append(tornado.concurrent.Future())
+        return self.write_futures[-1]
+
+    def send(self, slot, data):
+        message = app.data_update_message(slot, data)
+        encoded = json.dumps(message)
+        self.websocket.send([(message, encoded)], encoded)
+
+    def sent_data(self, frame):
+        messages = json.loads(frame)
+        return [message['data'] for message in messages] \
+            if isinstance(messages, list) else [messages['data']]
+
+    def test_queue(self):
+        """ Messages are queued until previous frame is sent """
+        self.send(1, '1')
+        self.send(1, '2')
+        self.send(2, '3')
+        self.assertEqual(len(self.frames), 1)
+        self.write_futures[0].set_result(None)
+        self.assertEqual(self.sent_data(self.frames[1]), ['2', '3'])
+        self.assertEqual(self.websocket.dropped, 0)
+
+    def test_drop_oldest(self):
+        options.websocket_queue_policy = 'drop_oldest'
+        for data in '1234':
+            self.send(1, data)
+        self.write_futures[0].set_result(None)
+        self.assertEqual(self.sent_data(self.frames[1]), ['3', '4'])
+        self.assertEqual(self.websocket.dropped, 1)
+
+    def test_latest_per_slot(self):
+        options.websocket_queue_policy = 'latest_per_slot'
+        for slot, data in ((1, '1'), (1, '2'), (2, '3'), (1, '4')):
+            self.send(slot, data)
+        self.write_futures[0].set_result(None)
+        self.assertEqual(self.sent_data(self.frames[1]), ['3', '4'])
+        self.assertEqual(self.websocket.dropped, 1)
+
+    def test_disconnect(self):
+        options.websocket_queue_policy = 'disconnect'
+        for data in '1234':
+            self.send(1, data)
+        self.assertEqual(self.frames[-1], 'CLOSE')
+        self.assertEqual(self.websocket.dropped, 3)
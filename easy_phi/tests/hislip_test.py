@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import tornado.gen
+import tornado.tcpclient
+import tornado.testing
+from tornado.options import options
 from tornado.test.util import unittest
 
-from easy_phi import hislip
+from easy_phi import hislip, hwconf
 
 
 class HiSLIPMessageTest(unittest.TestCase):
@@ -17,3 +21,260 @@ class HiSLIPMessageTest(unittest.TestCase):
         self.assertEqual(message.parameter, 0xff88aadd)
         message.parameter_uword = 0x88ff
         self.assertEqual(message.parameter, 0x88ffaadd)
+
+    def test_serialization(self):
+        message = hislip.HiSLIPMessage(
+            hislip.HiSLIPMessageCodes.DataEnd, parameter=0xffffff00,
+            payload='*IDN?\n')
+        self.assertEqual(str(message)[:16],
+                         'HS\x07\x00\xff\xff\xff\x00' + '\x00' * 7 + '\x06')
+        self.assertEqual(str(message)[16:], '*IDN?\n')
+
+    def test_unpack_from(self):
+        codes = hislip.HiSLIPMessageCodes
+        buf = bytearray(64)
+        offset = hislip.HiSLIPMessage(
+            codes.Data, parameter=7, payload='*IDN').pack_into(buf, 3)
+        hislip.HiSLIPMessage(codes.DataEnd, 1, 7, '?\n').pack_into(buf, offset)
+
+        message, offset = hislip.HiSLIPMessage.unpack_from(buf, 3)
+        self.assertEqual(offset, 3 + 16 + 4)
+        self.assertEqual((message.type, message.parameter),
+                         (codes.Data, 7))
+        self.assertEqual(message.payload.tobytes(), '*IDN')
+        message, offset = hislip.HiSLIPMessage.unpack_from(buf, offset)
+        self.assertEqual((message.type, message.control_code),
+                         (codes.DataEnd, 1))
+        self.assertEqual(message.payload.tobytes(), '?\n')
+
+        self.assertRaises(hislip.HiSLIPBadMessage,
+                          hislip.HiSLIPMessage.unpack_from, buf, 60)
+        self.assertRaises(hislip.HiSLIPBadMessage,
+                          hislip.HiSLIPMessage.unpack_from, b'XS' + b'\0' * 14)
+
+    def test_fragment(self):
+        codes = hislip.HiSLIPMessageCodes
+        messages = list(hislip.fragment(5, 'a' * 10 + 'b' * 10 + 'c', 26))
+        self.assertEqual([m.type for m in messages],
+                         [codes.Data, codes.Data, codes.DataEnd])
+        self.assertEqual([m.payload.tobytes() for m in messages],
+                         ['a' * 10, 'b' * 10, 'c'])
+        self.assertTrue(all(m.parameter == 5 for m in messages))
+        self.assertTrue(all(len(m) <= 26 for m in messages))
+        # empty response is still terminated by DataEnd
+        messages = list(hislip.fragment(5, '', 26))
+        self.assertEqual([m.type for m in messages], [codes.DataEnd])
+
+
+class HiSLIPServerTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(HiSLIPServerTest, self).setUp()
+        sock, self.port = tornado.testing.bind_unused_port()
+        self.server = hislip.HiSLIPServer()
+        self.server.add_socket(sock)
+
+    def tearDown(self):
+        self.server.stop()
+        super(HiSLIPServerTest, self).tearDown()
+
+    @tornado.gen.coroutine
+    def request(self, stream, mtype, control_code=0, parameter=0, payload=''):
+        yield stream.write(str(hislip.HiSLIPMessage(
+            mtype, control_code, parameter, payload)))
+        response = yield hislip.HiSLIPMessage.from_stream(stream)
+        raise tornado.gen.Return(response)
+
+    @tornado.gen.coroutine
+    def connect(self, sub_address='hislip0'):
+        """ Establish sync and async channels """
+        codes = hislip.HiSLIPMessageCodes
+        client = tornado.tcpclient.TCPClient()
+        sync = yield client.connect('127.0.0.1', self.port)
+        response = yield self.request(sync, codes.Initialize,
+                                      parameter=0x01000000, payload=sub_address)
+        self.assertEqual(response.type, codes.InitializeResponse)
+        self.assertEqual(response.parameter_uword, hislip.PROTOCOL_VERSION)
+        session_id = response.parameter_lword
+        self.assertIn(session_id, self.server.sessions)
+
+        async = yield client.connect('127.0.0.1', self.port)
+        response = yield self.request(async, codes.AsyncInitialize,
+                                      parameter=session_id)
+        self.assertEqual(response.type, codes.AsyncInitializeResponse)
+        raise tornado.gen.Return((sync, async))
+
+    @tornado.gen.coroutine
+    def close(self, *streams):
+        """ Close client streams and let server finish sessions """
+        for stream in streams:
+            stream.close()
+        yield tornado.gen.sleep(0.05)
+
+    @tornado.testing.gen_test
+    def test_query(self):
+        codes = hislip.HiSLIPMessageCodes
+        sync, async = yield self.connect()
+        # command split into Data and DataEnd
+        yield sync.write(str(hislip.HiSLIPMessage(
+            codes.Data, parameter=0xffffff00, payload='RAck:')))
+        response = yield self.request(sync, codes.DataEnd,
+                                      parameter=0xffffff00, payload='Size?\n')
+        self.assertEqual(response.type, codes.DataEnd)
+        self.assertEqual(response.parameter, 0xffffff00)
+        self.assertEqual(response.payload, str(len(options.ports)) + "\n")
+
+        response = yield self.request(
+            async, codes.AsyncMaximumMessageSize, payload='\x00' * 7 + '\xff')
+        self.assertEqual(response.type, codes.AsyncMaximumMessageSizeResponse)
+        self.assertEqual(self.server.sessions.values()[0].max_message_size,
+                         255)
+
+        # response exceeds negotiated size, 1 byte of payload per message
+        response = yield self.request(
+            async, codes.AsyncMaximumMessageSize, payload='\x00' * 7 + '\x11')
+        yield sync.write(str(hislip.HiSLIPMessage(
+            codes.DataEnd, parameter=0xffffff02, payload='RAck:Size?\n')))
+        expected = str(len(options.ports)) + "\n"
+        for char in expected[:-1]:
+            response = yield hislip.HiSLIPMessage.from_stream(sync)
+            self.assertEqual(response.type, codes.Data)
+            self.assertEqual(response.payload, char)
+        response = yield hislip.HiSLIPMessage.from_stream(sync)
+        self.assertEqual(response.type, codes.DataEnd)
+        self.assertEqual(response.parameter, 0xffffff02)
+        self.assertEqual(response.payload, "\n")
+
+        async.close()
+        # session is closed together with asynchronous channel
+        yield tornado.gen.sleep(0.05)
+        self.assertEqual(self.server.sessions, {})
+        sync.close()
+
+    @tornado.testing.gen_test
+    def test_invalid_initialization(self):
+        codes = hislip.HiSLIPMessageCodes
+        client = tornado.tcpclient.TCPClient()
+        stream = yield client.connect('127.0.0.1', self.port)
+        response = yield self.request(stream, codes.AsyncInitialize,
+                                      parameter=12345)
+        self.assertEqual(response.type, codes.FatalError)
+        self.assertEqual(response.control_code,
+                         hislip.HiSLIPErrorCodes.InvalidInitializationSequence)
+        stream.close()
+
+    def test_format_response(self):
+        self.assertEqual(hislip.format_response(["AND", "OR"]), "AND;OR\n")
+        self.assertEqual(hislip.format_response(memoryview("abc")),
+                         "#13abc\n")
+
+    @tornado.testing.gen_test
+    def test_exclusive_lock(self):
+        codes = hislip.HiSLIPMessageCodes
+        sync1, async1 = yield self.connect()
+        sync2, async2 = yield self.connect()
+        response = yield self.request(async1, codes.AsyncLock, 1, 0)
+        self.assertEqual(response.control_code, 1)
+        # lock is held by another session, 50ms timeout
+        response = yield self.request(async2, codes.AsyncLock, 1, 50)
+        self.assertEqual(response.control_code, 0)
+        response = yield self.request(async2, codes.AsyncLockInfo)
+        self.assertEqual((response.control_code, response.parameter), (1, 1))
+        # commands of other sessions are rejected
+        response = yield self.request(
+            sync2, codes.DataEnd, payload='RAck:Size?\n')
+        self.assertEqual(response.type, codes.Error)
+        # waiting session gets the lock when it is released
+        future = self.request(async2, codes.AsyncLock, 1, 1000)
+        response = yield self.request(async1, codes.AsyncLock, 0)
+        self.assertEqual(response.control_code, 1)
+        response = yield future
+        self.assertEqual(response.control_code, 1)
+        yield self.close(sync1, async1, sync2, async2)
+
+    @tornado.testing.gen_test
+    def test_shared_lock(self):
+        codes = hislip.HiSLIPMessageCodes
+        sync1, async1 = yield self.connect()
+        sync2, async2 = yield self.connect()
+        response = yield self.request(
+            async1, codes.AsyncLock, 1, 0, payload='scope')
+        self.assertEqual(response.control_code, 1)
+        response = yield self.request(
+            async2, codes.AsyncLock, 1, 0, payload='scope')
+        self.assertEqual(response.control_code, 1)
+        # shared lock excludes exclusive lock and shared locks of other name
+        response = yield self.request(
+            async2, codes.AsyncLock, 0)
+        self.assertEqual(response.control_code, 2)
+        response = yield self.request(
+            async2, codes.AsyncLock, 1, 0, payload='other')
+        self.assertEqual(response.control_code, 0)
+        response = yield self.request(async2, codes.AsyncLock, 1, 0)
+        self.assertEqual(response.control_code, 0)
+        yield self.close(sync1, async1, sync2, async2)
+
+    @tornado.testing.gen_test
+    def test_user_lock(self):
+        """ Modules locked through web API can't be used """
+        codes = hislip.HiSLIPMessageCodes
+
+        class LockedModule(object):
+            used_by = 'user'
+
+            def scpi(self, command):
+                return "Locked module"
+
+        hwconf.modules.append(LockedModule())
+        slot = len(hwconf.modules) - 1
+        try:
+            sync, async = yield self.connect('hislip{0}'.format(slot))
+            response = yield self.request(
+                sync, codes.DataEnd, payload='*IDN?\n')
+        finally:
+            hwconf.modules.pop()
+        self.assertEqual(response.type, codes.Error)
+        self.assertIn('user', response.payload)
+        yield self.close(sync, async)
+
+    @tornado.testing.gen_test
+    def test_message_too_large(self):
+        """ Too large message is rejected, session stays usable """
+        codes = hislip.HiSLIPMessageCodes
+        sync, async = yield self.connect()
+        response = yield self.request(
+            sync, codes.DataEnd,
+            payload='x' * (options.hislip_max_message_size + 1))
+        self.assertEqual(response.type, codes.Error)
+        self.assertEqual(response.control_code,
+                         hislip.HiSLIPNonFatalErrorCodes.MessageTooLarge)
+        response = yield self.request(
+            sync, codes.DataEnd, payload='RAck:Size?\n')
+        self.assertEqual(response.type, codes.DataEnd)
+        yield self.close(sync, async)
+
+    @tornado.testing.gen_test
+    def test_command_too_large(self):
+        """ Data messages are not buffered beyond max command size """
+        codes = hislip.HiSLIPMessageCodes
+        sync, async = yield self.connect()
+        session = self.server.sessions.values()[0]
+        chunk = 'x' * options.hislip_max_message_size
+        for _ in range(options.hislip_max_command_size //
+                       options.hislip_max_message_size):
+            yield sync.write(str(hislip.HiSLIPMessage(
+                codes.Data, payload=chunk)))
+        response = yield self.request(sync, codes.Data, payload=chunk)
+        self.assertEqual(response.type, codes.Error)
+        self.assertEqual(response.control_code,
+                         hislip.HiSLIPNonFatalErrorCodes.MessageTooLarge)
+        self.assertIsNone(session.data)
+        # the rest of command is discarded, the next one is executed
+        yield sync.write(str(hislip.HiSLIPMessage(codes.Data, payload=chunk)))
+        yield sync.write(str(hislip.HiSLIPMessage(
+            codes.DataEnd, payload='*IDN?\n')))
+        response = yield self.request(
+            sync, codes.DataEnd, payload='RAck:Size?\n')
+        self.assertEqual(response.type, codes.DataEnd)
+        self.assertEqual(response.payload, str(len(options.ports)) + "\n")
+        yield self.close(sync, async)
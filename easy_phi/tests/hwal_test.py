@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+
+""" Unit tests for easy_phi.hwal module
+Serial modules are emulated by pseudo terminals: module is connected to the
+slave end, test plays the role of equipment on the master end.
+"""
+
+import os
+import threading
+import tty
+
+import tornado.testing
+from tornado import gen
+from tornado.test.util import unittest
+from tornado.options import options
+
+from easy_phi import hwal
+from easy_phi import mod_conf_patch
+
+CONF_PATCHES_PATH = os.path.join(os.path.dirname(__file__), '..', '..',
+                                 'scripts', 'modules_conf_patches.conf')
+
+
+class FakeCDCDevice(object):
+    """ Pseudo terminal pretending to be a CDC module """
+    driver = 'cdc_acm'
+
+    def __init__(self, name="Fake module"):
+        self.master, self.slave = os.openpty()
+        # no echo, no line editing
+        tty.setraw(self.slave)
+        self.device = {
+            'ID_USB_DRIVER': self.driver,
+            'DEVNAME': os.ttyname(self.slave),
+            # high speed logic gate in default configuration patches
+            'ID_VENDOR': 'Easy-phi',
+            'ID_SERIAL_SHORT': '123123123123',
+        }
+        # answer to name request, sent by module constructor. Port input is
+        # flushed on open, so it can't be written in advance
+        self._name_responder = threading.Thread(
+            target=lambda: self.received() and self.respond(name + "\r\n"))
+        self._name_responder.start()
+
+    def respond(self, data):
+        os.write(self.master, data)
+
+    def received(self):
+        return os.read(self.master, 4096)
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class FakeUSBTMCDevice(FakeCDCDevice):
+    """ Pseudo terminal pretending to be usbtmc character device. Every write
+    of the fake device is received by module in one read, which is what
+    usbtmc driver does with USBTMC messages """
+    driver = 'usbtmc'
+
+
+class ReceiveBufferTest(unittest.TestCase):
+
+    def test_lines(self):
+        buf = hwal.ReceiveBuffer("\r\n", 1024)
+        buf.extend("AND\r\nOR\r")
+        self.assertEqual(list(buf.lines()), ["AND"])
+        # delimiter split between chunks
+        buf.extend("\nIN")
+        self.assertEqual(list(buf.lines()), ["OR"])
+        self.assertEqual(len(buf), 2)
+        buf.extend("1\r\n")
+        self.assertEqual(list(buf.lines()), ["IN1"])
+        self.assertEqual(len(buf), 0)
+
+    def test_overflow(self):
+        buf = hwal.ReceiveBuffer("\r", 4)
+        buf.extend("012345")
+        self.assertEqual(list(buf.lines()), [])
+        self.assertTrue(buf.overflow())
+        buf.drop(len(buf) - buf.max_size)
+        self.assertFalse(buf.overflow())
+        self.assertEqual(buf.take(), "2345")
+        self.assertEqual(len(buf), 0)
+
+    def test_binary_block(self):
+        buf = hwal.ReceiveBuffer("\r", 4, max_block_size=1024)
+        buf.extend("#19A\rB\n")
+        # block is incomplete, delimiters inside are ignored
+        self.assertEqual(list(buf.lines()), [])
+        self.assertFalse(buf.overflow())
+        buf.extend("CDEFG\r")
+        block, = list(buf.lines())
+        self.assertIsInstance(block, memoryview)
+        self.assertEqual(block.tobytes(), "A\rB\nCDEFG")
+        # terminator split from the block is not a message
+        buf.extend("\r\nAND\r")
+        self.assertEqual(list(buf.lines()), ["\nAND"])
+
+    def test_indefinite_block(self):
+        buf = hwal.ReceiveBuffer("\r", 4, max_block_size=1024)
+        buf.extend("#0A\rB")
+        self.assertEqual(list(buf.lines()), [])
+        # bytes received before are not searched for the end again
+        self.assertEqual(buf._block_scan, 5)
+        buf.extend("C\n")
+        block, = list(buf.lines())
+        self.assertEqual(block.tobytes(), "A\rBC")
+
+    def test_block_like_text(self):
+        """ Text starting with #<digit> is not a block """
+        buf = hwal.ReceiveBuffer("\r", 1024, max_block_size=1024)
+        buf.extend("#2 channels\r")
+        self.assertEqual(list(buf.lines()), ["#2 channels"])
+
+
+class StateMirrorTest(unittest.TestCase):
+
+    def test_update(self):
+        mirror = hwal.StateMirror(["CONFigure:OUT1?"], ttl=60)
+        mirror.update("CONF:OUT1?", "AND")
+        self.assertEqual(mirror.get("conf:out1?"), "AND")
+        # not cacheable
+        mirror.update("CONF:OUT2?", "OR")
+        self.assertIsNone(mirror.get("CONF:OUT2?"))
+
+    def test_update_set(self):
+        mirror = hwal.StateMirror(["CONFigure:OUT1?", "*IDN?"], ttl=60)
+        mirror.update("CONF:OUT1?", "AND")
+        mirror.update("*IDN?", "Fake module")
+        # value is not known until device confirms it
+        mirror.update_set("CONFigure:OUT1 IN2")
+        self.assertIsNone(mirror.get("CONF:OUT1?"))
+        self.assertEqual(mirror.get("*IDN?"), "Fake module")
+        mirror.update_set("*RCL 1")
+        self.assertIsNone(mirror.get("*IDN?"))
+
+    def test_outdated_response(self):
+        """ Response to query written before set command is not cached """
+        mirror = hwal.StateMirror(["CONFigure:OUT1?"], ttl=60)
+        version = mirror.version
+        mirror.update_set("CONF:OUT1 OR")
+        mirror.update("CONF:OUT1?", "AND", version)
+        self.assertIsNone(mirror.get("CONF:OUT1?"))
+
+    def test_ttl(self):
+        mirror = hwal.StateMirror(["CONFigure:OUT1?"], ttl=0)
+        mirror.update("CONF:OUT1?", "AND")
+        self.assertIsNone(mirror.get("CONF:OUT1?"))
+
+
+class CDCModuleTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(CDCModuleTest, self).setUp()
+        options.modules_conf_patches_path = CONF_PATCHES_PATH
+        mod_conf_patch._init_config()
+        self.fake = FakeCDCDevice()
+        self.module = hwal.CDCModule(self.fake.device)
+        self.module.start()
+
+    def tearDown(self):
+        self.module.stream.close()
+        self.fake.close()
+        super(CDCModuleTest, self).tearDown()
+
+    def test_name(self):
+        self.assertEqual(self.module.name, "Fake module")
+
+    def test_configuration(self):
+        """ Configuration is resolved at attach time and kept until
+        configuration patches are reloaded """
+        configuration = self.module.get_configuration()
+        self.assertIsInstance(configuration, tuple)
+        self.assertIs(self.module.get_configuration(), configuration)
+        mod_conf_patch._init_config()
+        self.assertIsNot(self.module.get_configuration(), configuration)
+        self.assertEqual(self.module.get_configuration(), configuration)
+
+    def test_stop_not_started(self):
+        """ Module discarded before start releases serial port """
+        module = hwal.CDCModule(self.fake.device, name="Fake module")
+        module.stop()
+        self.assertFalse(module.serial.isOpen())
+
+    @tornado.testing.gen_test
+    def test_pipelined_commands(self):
+        """ Commands are written without waiting for previous responses and
+        responses are matched to commands in FIFO order"""
+        futures = [self.module.scpi(cmd) for cmd in
+                   ("CONF:OUT1?", "CONF:OUT2?", "CONF:OUT3?")]
+        yield gen.sleep(0.05)
+        self.assertEqual(self.fake.received(),
+                         "CONF:OUT1?\nCONF:OUT2?\nCONF:OUT3?\n")
+
+        # all responses in one chunk
+        self.fake.respond("AND\r\nOR\r\nIN1\r\n")
+        responses = yield futures
+        self.assertEqual(responses, ["AND", "OR", "IN1"])
+
+    @tornado.testing.gen_test
+    def test_compound_query(self):
+        future = self.module.scpi("CONF:OUT1?;CONF:OUT2?")
+        self.fake.respond("AND;OR\r\n")
+        response = yield future
+        self.assertEqual(response, ["AND", "OR"])
+
+    @tornado.testing.gen_test
+    def test_unsolicited_data(self):
+        """ Data received without pending command goes to data callback """
+        received = []
+        self.module.stream._data_callback = received.append
+        self.fake.respond("0.5\r\n")
+        yield gen.sleep(0.05)
+        self.assertEqual(received, ["0.5"])
+
+    @tornado.testing.gen_test(timeout=1)
+    def test_set_command(self):
+        """ Commands producing no output don't wait for serial timeout """
+        response = yield self.module.scpi("*RST")
+        self.assertEqual(response, "")
+        self.assertEqual(self.fake.received(), "*RST\n")
+
+    @tornado.testing.gen_test(timeout=1)
+    def test_opc_handshake(self):
+        future = self.module.scpi("CONF:OUT1 AND", opc=True)
+        yield gen.sleep(0.05)
+        self.assertFalse(future.done())
+        self.assertEqual(self.fake.received(), "CONF:OUT1 AND;*OPC?\n")
+        self.fake.respond("1\r\n")
+        response = yield future
+        self.assertEqual(response, "")
+
+    def test_is_set_command(self):
+        self.assertTrue(self.module.is_set_command("CONF:OUT1 AND"))
+        self.assertTrue(self.module.is_set_command("*rst"))
+        self.assertFalse(self.module.is_set_command("CONF:OUT1?"))
+        # output of unknown command is not a response
+        self.assertTrue(self.module.is_set_command("MEASure:START"))
+
+    @tornado.testing.gen_test(timeout=1)
+    def test_generating_command(self):
+        """ Output of non-query does not take response of the next query """
+        received = []
+        self.module.stream._data_callback = received.append
+        response = yield self.module.scpi("MEASure:START")
+        self.assertEqual(response, "")
+        self.fake.respond("0.5\r\n")
+        yield gen.sleep(0.05)
+        self.assertEqual(received, ["0.5"])
+        future = self.module.scpi("CONF:OUT1?")
+        self.fake.respond("AND\r\n")
+        response = yield future
+        self.assertEqual(response, "AND")
+
+    @tornado.testing.gen_test(timeout=2)
+    def test_timeout_resync(self):
+        """ Late response is discarded after timeout """
+        self.module.stream.read_timeout = lambda: 0.1
+        response = yield self.module.scpi("CONF:OUT1?")
+        self.assertEqual(response, "")
+        yield gen.sleep(0.05)
+        self.assertEqual(self.fake.received(), "CONF:OUT1?\n*OPC?\n")
+        future = self.module.scpi("CONF:OUT2?")
+        # late response, then answer to synchronization command
+        self.fake.respond("AND\r\n1\r\nOR\r\n")
+        response = yield future
+        self.assertEqual(response, "OR")
+
+    @tornado.testing.gen_test(timeout=1)
+    def test_state_mirror(self):
+        """ Cacheable queries are answered from memory after device
+        response """
+        # name is learned during initialization
+        response = yield self.module.scpi("*idn?")
+        self.assertEqual(response, "Fake module")
+        yield self.module.scpi("CONF:OUT1 and")
+        self.assertEqual(self.fake.received(), "CONF:OUT1 and\n")
+        future = self.module.scpi("CONF:OUT1?")
+        yield gen.sleep(0.05)
+        self.assertEqual(self.fake.received(), "CONF:OUT1?\n")
+        self.fake.respond("AND\r\n")
+        response = yield future
+        self.assertEqual(response, "AND")
+        response = yield self.module.scpi("CONFigure:OUT1?")
+        self.assertEqual(response, "AND")
+        # *RST clears the mirror, so next query goes to the device
+        yield self.module.scpi("*RST")
+        self.assertEqual(self.fake.received(), "*RST\n")
+        future = self.module.scpi("CONF:OUT1?")
+        yield gen.sleep(0.05)
+        self.assertEqual(self.fake.received(), "CONF:OUT1?\n")
+        self.fake.respond("OR\r\n")
+        response = yield future
+        self.assertEqual(response, "OR")
+        self.assertEqual(self.module.mirror.get("CONF:OUT1?"), "OR")
+        self.module.stop()
+        self.assertIsNone(self.module.mirror.get("CONF:OUT1?"))
+
+    @tornado.testing.gen_test(timeout=1)
+    def test_state_mirror_full_pipeline(self):
+        """ Set command waiting for a pipeline slot invalidates mirror """
+        self.module.mirror.update("CONF:OUT1?", "AND")
+        queries = [self.module.scpi("CONF:OUT2?")
+                   for _ in range(options.serial_pipeline_depth)]
+        set_future = self.module.scpi("CONF:OUT1 OR")
+        future = self.module.scpi("CONF:OUT1?")
+        yield gen.sleep(0.05)
+        self.assertFalse(future.done())
+        self.assertNotIn("CONF:OUT1", self.fake.received())
+        # responses to queries written before the set command are not cached
+        self.fake.respond("OR\r\n" * options.serial_pipeline_depth)
+        yield queries
+        yield set_future
+        yield gen.sleep(0.05)
+        self.assertEqual(self.fake.received(), "CONF:OUT1 OR\nCONF:OUT1?\n")
+        self.fake.respond("OR\r\n")
+        response = yield future
+        self.assertEqual(response, "OR")
+
+    @tornado.testing.gen_test
+    def test_binary_block(self):
+        future = self.module.scpi("TRACe:DATA?")
+        self.fake.respond("#16\x00\r\n\x01\x02\x03\r\n")
+        response = yield future
+        self.assertIsInstance(response, memoryview)
+        self.assertEqual(response.tobytes(), "\x00\r\n\x01\x02\x03")
+
+    @tornado.testing.gen_test
+    def test_buffer_overflow(self):
+        """ Data without delimiter is flushed to data callback on overflow """
+        received = []
+        self.module.stream._data_callback = received.append
+        self.module.stream.buffer.max_size = 16
+        self.fake.respond("0" * 32)
+        yield gen.sleep(0.05)
+        self.assertEqual(received, ["0" * 32])
+
+
+class BroadcastModuleTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(BroadcastModuleTest, self).setUp()
+        options.modules_conf_patches_path = CONF_PATCHES_PATH
+        mod_conf_patch._init_config()
+        self.fakes = [FakeCDCDevice(), FakeCDCDevice()]
+        self.modules = [None]
+        self.modules[0] = hwal.BroadcastModule(self.modules)
+        self.modules += [hwal.CDCModule(fake.device) for fake in self.fakes]
+        for module in self.modules[1:]:
+            module.start()
+
+    def tearDown(self):
+        for slot, fake in enumerate(self.fakes):
+            self.modules[slot + 1].stream.close()
+            fake.close()
+        super(BroadcastModuleTest, self).tearDown()
+
+    @tornado.testing.gen_test
+    def test_systemwide_command(self):
+        response = yield self.modules[0].scpi("SYSTem:NUMber:SLots?")
+        self.assertEqual(response, 3)
+
+    @tornado.testing.gen_test
+    def test_slot_map(self):
+        future = self.modules[0].scpi("CONF:OUT1?", slot_map=True)
+        # both modules received command before any of them responded
+        for fake in self.fakes:
+            self.assertEqual(fake.received(), "CONF:OUT1?\n")
+        self.fakes[0].respond("AND\r")
+        self.fakes[1].respond("OR\r")
+        response = yield future
+        self.assertEqual(response['responses'], {1: "AND", 2: "OR"})
+        self.assertGreaterEqual(response['skew'], 0)
+        self.assertLess(response['skew'], 0.1)
+
+    @tornado.testing.gen_test
+    def test_lowest_slot_response(self):
+        future = self.modules[0].scpi("CONF:OUT1?")
+        self.fakes[1].respond("OR\r")
+        self.fakes[0].respond("AND\r")
+        response = yield future
+        self.assertEqual(response, "AND")
+
+    @tornado.testing.gen_test
+    def test_slot_emptied(self):
+        """ Module removed while waiting for responses """
+        future = self.modules[0].scpi("CONF:OUT1?", slot_map=True)
+        module = self.modules[2]
+        self.modules[2] = None
+        self.fakes[0].respond("AND\r")
+        self.fakes[1].respond("OR\r")
+        response = yield future
+        self.modules[2] = module
+        self.assertEqual(response['responses'], {1: "AND", 2: "OR"})
+        self.assertIsNotNone(response['skew'])
+
+
+class USBTMCModuleTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(USBTMCModuleTest, self).setUp()
+        options.modules_conf_patches_path = CONF_PATCHES_PATH
+        mod_conf_patch._init_config()
+        self.fake = FakeUSBTMCDevice()
+        self.module = hwal.USBTMCModule(self.fake.device)
+        self.module.start()
+
+    def tearDown(self):
+        self.module.stop()
+        self.fake.close()
+        super(USBTMCModuleTest, self).tearDown()
+
+    def test_name(self):
+        self.assertEqual(self.module.name, "Fake module")
+
+    def test_stop_not_started(self):
+        """ Module discarded before start closes device """
+        module = hwal.USBTMCModule(self.fake.device, name="Fake module")
+        fd = module.fd
+        module.stop()
+        self.assertIsNone(module.fd)
+        self.assertRaises(OSError, os.fstat, fd)
+
+    @tornado.testing.gen_test(timeout=1)
+    def test_end_of_message(self):
+        """ Message ends with the read, regardless of delimiters """
+        future = self.module.scpi("CONF:OUT1?")
+        yield gen.sleep(0.05)
+        self.assertEqual(self.fake.received(), "CONF:OUT1?\n")
+        self.fake.respond("AND")
+        response = yield future
+        self.assertEqual(response, "AND")
+
+    @tornado.testing.gen_test(timeout=1)
+    def test_set_command(self):
+        response = yield self.module.scpi("*RST")
+        self.assertEqual(response, "")
+        self.assertEqual(self.fake.received(), "*RST\n")
+
+    @tornado.testing.gen_test(timeout=1)
+    def test_binary_block(self):
+        future = self.module.scpi("TRACe:DATA?")
+        yield gen.sleep(0.05)
+        self.fake.received()
+        self.fake.respond("#0\x00\r\x01\n")
+        response = yield future
+        self.assertEqual(response.tobytes(), "\x00\r\x01")
+
+    @tornado.testing.gen_test(timeout=1)
+    def test_read_size(self):
+        """ Message of exactly read size is not split """
+        self.module.stream.read_chunk_size = 3
+        future = self.module.scpi("CONF:OUT1?")
+        yield gen.sleep(0.05)
+        self.fake.received()
+        self.fake.respond("AND")
+        response = yield future
+        self.assertEqual(response, "AND")
+        future = self.module.scpi("CONF:OUT2?")
+        yield gen.sleep(0.05)
+        self.fake.received()
+        self.fake.respond("OR")
+        response = yield future
+        self.assertEqual(response, "OR")
+
+    @tornado.testing.gen_test(timeout=1)
+    def test_block_bigger_than_read(self):
+        self.module.stream.read_chunk_size = 4
+        future = self.module.scpi("TRACe:DATA?")
+        yield gen.sleep(0.05)
+        self.fake.received()
+        self.fake.respond("#15HELLO\n")
+        response = yield future
+        self.assertEqual(response.tobytes(), "HELLO")
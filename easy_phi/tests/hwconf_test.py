@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+""" Unit tests for easy_phi.hwconf module """
+
+import tempfile
+import threading
+
+import concurrent.futures
+import tornado.testing
+from tornado import gen
+from tornado.options import options
+from tornado.test.util import unittest
+
+from easy_phi import hwal
+from easy_phi import hwconf
+from easy_phi import mod_conf_patch
+
+
+class FakeModule(hwal.AbstractMeasurementModule):
+    """ Module which takes some time to ask device for its name """
+    probes = 0
+    instances = []
+
+    def __init__(self, device, data_callback=None, name=None, patch=None):
+        super(FakeModule, self).__init__(
+            device, data_callback=data_callback, name=name, patch=patch)
+        if name is None:
+            FakeModule.probes += 1
+            self.name = device['NAME']
+        self.init_thread = threading.current_thread()
+        self.patch = patch
+        self.started = False
+        self.stopped = False
+        FakeModule.instances.append(self)
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.stopped = True
+
+    @staticmethod
+    def is_instance(device):
+        return 'NAME' in device
+
+
+class ModuleProbingTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(ModuleProbingTest, self).setUp()
+        self.cache = tempfile.NamedTemporaryFile()
+        options.modules_cache_path = self.cache.name
+        hwconf._load_modules_cache()
+        hwconf._io_loop = self.io_loop
+        hwconf._executor = concurrent.futures.ThreadPoolExecutor(2)
+        hwal.module_classes.insert(0, FakeModule)
+        self.device = {'NAME': 'fake', 'ID_SERIAL_SHORT': '42',
+                       'DEVPATH': '/devices/fake', 'ID_PATH': 'fake-usb-0:1'}
+        self.slot = hwconf.get_rack_slot(self.device)
+        self.updates = []
+        hwconf.hwconf_change_callbacks.append(self.hwconf_callback)
+        FakeModule.probes = 0
+        FakeModule.instances = []
+
+    def tearDown(self):
+        hwconf.hwconf_change_callbacks.remove(self.hwconf_callback)
+        hwconf.registry.release(self.device)
+        hwal.module_classes.remove(FakeModule)
+        hwconf._executor.shutdown()
+        hwconf._executor = None
+        super(ModuleProbingTest, self).tearDown()
+
+    def hwconf_callback(self, slot, added):
+        self.updates.append((slot, added))
+        if added:
+            self.stop()
+
+    def test_attach_module(self):
+        device = self.device
+        hwconf.attach_module(FakeModule, device, self.slot)
+        self.assertEqual(hwconf.probing(), 1)
+        self.wait()
+
+        module = hwconf.modules[self.slot]
+        self.assertEqual(self.updates, [(self.slot, True)])
+        self.assertEqual(hwconf.probing(), 0)
+        self.assertEqual(module.name, 'fake')
+        self.assertTrue(module.started)
+        self.assertIsNot(module.init_thread, threading.current_thread(),
+                         "Module was initialized on IOLoop thread")
+        # configuration patch is resolved on IOLoop thread
+        self.assertEqual(module.patch, mod_conf_patch.get_patch(device))
+
+        # known module is not probed again, even after restart
+        hwconf._load_modules_cache()
+        hwconf.attach_module(FakeModule, device, self.slot)
+        self.wait()
+        self.assertEqual(FakeModule.probes, 1)
+        self.assertEqual(hwconf.modules[self.slot].name, 'fake')
+
+    @tornado.testing.gen_test
+    def test_removed_while_probing(self):
+        hwconf.hwconf_event('add', self.device)
+        self.assertEqual(hwconf.probing(), 1)
+        hwconf.hwconf_event('remove', self.device)
+        yield gen.sleep(0.05)
+        self.assertIsNone(hwconf.modules[self.slot])
+        self.assertEqual(hwconf.probing(), 0)
+        self.assertEqual(self.updates, [(self.slot, False)])
+        # device of discarded module is released
+        module, = FakeModule.instances
+        self.assertFalse(module.started)
+        self.assertTrue(module.stopped)
+
+    def test_listener_thread(self):
+        """ udev events from observer thread are handled on IOLoop thread """
+        listener = threading.Thread(target=hwconf.hwconf_listener,
+                                    args=('add', self.device))
+        listener.start()
+        self.wait()
+        listener.join()
+        self.assertEqual(hwconf.modules[self.slot].name, 'fake')
+
+
+class SlotRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = hwconf.SlotRegistry()
+        self.registry.configure(['usb-0:1', 'usb-0:2'])
+
+    @staticmethod
+    def device(devpath, id_path):
+        return {'DEVPATH': devpath, 'ID_PATH': id_path}
+
+    def test_configured_ports(self):
+        self.assertEqual(len(self.registry.modules), 3)
+        self.assertEqual(
+            self.registry.get_slot(self.device('/dev1', 'usb-0:2')), 2)
+        self.assertEqual(
+            self.registry.get_slot(self.device('/dev1', 'usb-0:2')), 2)
+        self.assertEqual(
+            self.registry.get_slot(self.device('/dev2', 'usb-0:1')), 1)
+        self.assertEqual(len(self.registry.modules), 3)
+
+    def test_dynamic_slots(self):
+        first = self.device('/dev1', 'usb-1:1')
+        second = self.device('/dev2', 'usb-1:2')
+        self.assertEqual(self.registry.get_slot(first), 3)
+        self.assertEqual(self.registry.get_slot(second), 4)
+
+        self.assertEqual(self.registry.release(first), 3)
+        self.assertIsNone(self.registry.release(first))
+        # freed slot is reused
+        self.assertEqual(
+            self.registry.get_slot(self.device('/dev3', 'usb-1:3')), 3)
+        self.assertEqual(len(self.registry.modules), 5)
+
+        # module reconnected to its port gets the same slot, if it is free
+        self.registry.release(second)
+        self.assertEqual(
+            self.registry.get_slot(self.device('/dev4', 'usb-1:2')), 4)
+        self.assertEqual(len(self.registry.modules), 5)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import os
 import tempfile
 
 from tornado.test.util import unittest
@@ -44,6 +45,7 @@ class BasicConfParserTest(unittest.TestCase):
         confpatch = tempfile.NamedTemporaryFile()
         confpatch.write("""[DEFAULT]
 scpi = *IDN?
+cacheable = *IDN?
 
 [Easy Phi high speed Logic gate]
 ID_VENDOR = Easy-phi
@@ -52,6 +54,7 @@ scpi = CONFigure:OUT1? (OR|AND|IN1|IN2)
         CONFigure:OUT2? (OR|AND|IN1|IN2)
         CONFigure:OUT3? (OR|AND|IN1|IN2)
         CONFigure:OUT4? (OR|AND|IN1|IN2)
+cacheable = CONFigure:OUT1?
         """)
         confpatch.flush()
 
@@ -64,38 +67,25 @@ scpi = CONFigure:OUT1? (OR|AND|IN1|IN2)
         self.assertEqual(mod_conf_patch.legacy_commands.strip(), "*IDN?")
         self.assertIsInstance(mod_conf_patch.legacy_configs, list)
 
-    def test_configuration_match(self):
-        self.assertTrue(mod_conf_patch.configuration_match(
-            self.device,
-            [('ID_VENDOR', 'Easy-phi'), ('ID_SERIAL_SHORT', '123123123123')]
-        ))
-
-        # match by single property
-        self.assertTrue(mod_conf_patch.configuration_match(
-            self.device,
-            [('ID_VENDOR', 'Easy-phi')]
-        ))
+    def test_match(self):
+        commands = mod_conf_patch.resolve(self.device)[0]
+        self.assertIn("CONFigure:OUT1? (OR|AND|IN1|IN2)", commands)
 
+        # mismatch by one property
         device = self.device.copy()
         device['ID_VENDOR'] = 'ACME'
-
-        # mismatch by one property
-        self.assertFalse(mod_conf_patch.configuration_match(
-            device,
-            [('ID_VENDOR', 'Easy-phi'), ('ID_SERIAL_SHORT', '123123123123')]
-        ))
-
-        # mismatch by single property
-        self.assertFalse(mod_conf_patch.configuration_match(
-            device,
-            [('ID_SERIAL_SHORT', '0000000')]
-        ))
+        self.assertEqual(mod_conf_patch.resolve(device)[0], ("*IDN?",))
 
         # if desired property not in device properties, don't count it as match
-        self.assertFalse(mod_conf_patch.configuration_match(
-            {},
-            [('ID_SERIAL_SHORT', '123123123123')]
-        ))
+        device = self.device.copy()
+        del device['ID_SERIAL_SHORT']
+        self.assertEqual(mod_conf_patch.resolve(device)[0], ("*IDN?",))
+
+    def test_get_patch(self):
+        version, commands, cacheable = mod_conf_patch.get_patch(self.device)
+        self.assertEqual(version, mod_conf_patch.version)
+        self.assertEqual(commands[0], "*IDN?")
+        self.assertEqual(cacheable, ("*IDN?", "CONFigure:OUT1?"))
 
     def test_get_configuration_patch(self):
         self.assertSequenceEqual(
@@ -114,3 +104,63 @@ scpi = CONFigure:OUT1? (OR|AND|IN1|IN2)
             ["*IDN?"]
         )
 
+    def test_get_cacheable_queries(self):
+        self.assertSequenceEqual(
+            mod_conf_patch.get_cacheable_queries(self.device),
+            ["*IDN?", "CONFigure:OUT1?"]
+        )
+
+        self.assertSequenceEqual(
+            mod_conf_patch.get_cacheable_queries({}),
+            ["*IDN?"]
+        )
+
+    def test_first_match(self):
+        """ Sections matching different sets of properties are still checked
+        in order of configuration file """
+        self.conf.seek(0)
+        self.conf.truncate()
+        self.conf.write("""[DEFAULT]
+scpi = *IDN?
+
+[Any Easy Phi]
+ID_VENDOR = Easy-phi
+scpi = VENDOR
+
+[Template board]
+ID_MODEL = Template_Board
+ID_VENDOR = Easy-phi
+scpi = MODEL
+
+[Template board duplicate]
+ID_VENDOR = Easy-phi
+ID_MODEL = Template_Board
+scpi = DUPLICATE
+""")
+        self.conf.flush()
+        mod_conf_patch._init_config()
+
+        self.assertEqual(mod_conf_patch.resolve(self.device)[0],
+                         ("*IDN?", "VENDOR"))
+        device = dict(self.device, ID_VENDOR='ACME')
+        self.assertEqual(mod_conf_patch.resolve(device)[0], ("*IDN?",))
+        self.assertEqual(mod_conf_patch.resolve(None)[0], ("*IDN?",))
+
+    def test_refresh(self):
+        version = mod_conf_patch.version
+        mod_conf_patch.refresh()
+        self.assertEqual(mod_conf_patch.version, version,
+                         "Configuration reloaded without modification")
+
+        self.conf.seek(0)
+        self.conf.truncate()
+        self.conf.write("[DEFAULT]\nscpi = *RST\n")
+        self.conf.flush()
+        # make sure modification time is changed on filesystems with low
+        # timestamp resolution
+        mtime = os.stat(self.conf.name).st_mtime
+        os.utime(self.conf.name, (mtime + 1, mtime + 1))
+        mod_conf_patch.refresh()
+        self.assertEqual(mod_conf_patch.version, version + 1)
+        self.assertEqual(mod_conf_patch.get_configuration_patch(self.device),
+                         ["*RST"])
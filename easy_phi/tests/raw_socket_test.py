@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import tornado.gen
+import tornado.tcpclient
+import tornado.testing
+
+from tornado.options import options
+
+from easy_phi import hwconf, raw_socket
+
+
+class EchoModule(object):
+    """ Module echoing queries, SLOW queries take longer to complete,
+    FAIL commands raise exception """
+    name = 'Echo module'
+    used_by = None
+
+    def __init__(self):
+        self.commands = []
+
+    @tornado.gen.coroutine
+    def scpi(self, command):
+        self.commands.append(command)
+        if command.startswith('SLOW'):
+            yield tornado.gen.sleep(0.05)
+        if command.startswith('FAIL'):
+            raise ValueError(command)
+        raise tornado.gen.Return(command)
+
+
+class RawSocketServerTest(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        super(RawSocketServerTest, self).setUp()
+        self.module = EchoModule()
+        hwconf.modules.append(self.module)
+        self.slot = len(hwconf.modules) - 1
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        hwconf.modules.pop()
+        super(RawSocketServerTest, self).tearDown()
+
+    @tornado.gen.coroutine
+    def connect(self, slot=0):
+        sock, port = tornado.testing.bind_unused_port()
+        server = raw_socket.RawSocketServer(slot)
+        server.add_socket(sock)
+        self.servers.append(server)
+        stream = yield tornado.tcpclient.TCPClient().connect('127.0.0.1', port)
+        raise tornado.gen.Return(stream)
+
+    @tornado.testing.gen_test
+    def test_pipelining(self):
+        stream = yield self.connect(self.slot)
+        # responses are in order of queries, not in order of completion
+        yield stream.write("SLOW?\nCONF:OUT1 AND\n\nFAST?\n")
+        response = yield stream.read_until("\n")
+        self.assertEqual(response, "SLOW?\n")
+        response = yield stream.read_until("\n")
+        self.assertEqual(response, "FAST?\n")
+        stream.close()
+
+    @tornado.testing.gen_test
+    def test_slot_selection(self):
+        stream = yield self.connect()
+        yield stream.write("INST:NSEL?\ninstrument:nselect {0}\n"
+                           "INSTrument:NSELect?\nECHO?\n".format(self.slot))
+        response = yield stream.read_until("\n")
+        self.assertEqual(response, "0\n")
+        response = yield stream.read_until("\n")
+        self.assertEqual(response, "{0}\n".format(self.slot))
+        response = yield stream.read_until("\n")
+        self.assertEqual(response, "ECHO?\n")
+
+        yield stream.write("INST:NSEL {0}\n*IDN?\n".format(self.slot + 1))
+        response = yield stream.read_until("\n")
+        self.assertEqual(response, raw_socket.HARDWARE_MISSING + "\n")
+        stream.close()
+
+    @tornado.testing.gen_test
+    def test_module_error(self):
+        """ Failed command does not stop responses to the next ones """
+        stream = yield self.connect(self.slot)
+        yield stream.write("FAIL?\nFAIL 1\nECHO?\n")
+        response = yield stream.read_until("\n")
+        self.assertEqual(response, raw_socket.EXECUTION_ERROR + "\n")
+        response = yield stream.read_until("\n")
+        self.assertEqual(response, "ECHO?\n")
+        stream.close()
+
+    @tornado.testing.gen_test
+    def test_user_lock(self):
+        self.module.used_by = 'user'
+        stream = yield self.connect(self.slot)
+        yield stream.write("*IDN?\n")
+        response = yield stream.read_until("\n")
+        self.assertEqual(response, raw_socket.MODULE_LOCKED + "\n")
+        self.assertEqual(self.module.commands, [])
+        stream.close()
+
+    @tornado.testing.gen_test
+    def test_set_commands_pipeline(self):
+        """ Set commands count towards pipeline limit as well """
+        pipeline = options.raw_socket_pipeline
+        options.raw_socket_pipeline = 2
+        try:
+            stream = yield self.connect(self.slot)
+            yield stream.write("SLOW 1\nSLOW 2\nSLOW 3\nSLOW 4\nECHO?\n")
+            yield tornado.gen.sleep(0.02)
+            # two commands are executing, the rest are waiting
+            self.assertEqual(len(self.module.commands), 2)
+            response = yield stream.read_until("\n")
+            self.assertEqual(response, "ECHO?\n")
+        finally:
+            options.raw_socket_pipeline = pipeline
+        stream.close()
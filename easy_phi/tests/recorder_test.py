@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+""" Unit tests for easy_phi.recorder module """
+
+import os
+import shutil
+import tempfile
+
+from tornado.test.util import unittest
+from tornado.options import options
+
+from easy_phi import recorder, utils
+
+
+class RecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.saved_options = (options.recorder_path,
+                              options.recorder_file_size,
+                              options.recorder_chunk_size)
+        options.recorder_path = self.path
+        # 4 records per file, file grows by 2 records
+        options.recorder_file_size = 4 * recorder.RECORD.size
+        options.recorder_chunk_size = 2 * recorder.RECORD.size
+
+    def tearDown(self):
+        for slot in list(recorder.recorders):
+            recorder.stop(slot)
+        options.recorder_path, options.recorder_file_size, \
+            options.recorder_chunk_size = self.saved_options
+        shutil.rmtree(self.path)
+
+    def test_rotation(self):
+        name = recorder.start(1)
+        for value in range(6):
+            recorder.data_callback(1, str(value))
+        # active recording
+        self.assertEqual(recorder.list_recordings(), [
+            {'name': name, 'slot': 1, 'records': 6, 'active': True}])
+        self.assertEqual(recorder.stop(1), name)
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         [name + '.0000.rec', name + '.0001.rec'])
+        self.assertEqual(
+            os.path.getsize(os.path.join(self.path, name + '.0001.rec')),
+            2 * recorder.RECORD.size)
+        self.assertFalse(recorder.list_recordings()[0]['active'])
+
+    def test_export(self):
+        name = recorder.start(1)
+        recorder.data_callback(1, "1.5,2.5")
+        recorder.data_callback(1, "DONE")
+        recorder.stop(1)
+
+        csv = "".join(recorder.export(name, 'csv', chunk_size=16))
+        lines = csv.splitlines()
+        self.assertEqual(lines[0], "timestamp,value")
+        self.assertEqual([line.split(",")[1] for line in lines[1:]],
+                         ["1.5", "2.5"])
+
+        npy = "".join(recorder.export(name, 'npy'))
+        header = utils.npy_header(recorder.RECORD_DTYPE, 2)
+        self.assertTrue(npy.startswith(header))
+        self.assertEqual(len(npy), len(header) + 2 * recorder.RECORD.size)
+
+    def test_crash_recovery(self):
+        """ Zero filled space of not truncated file is not exported """
+        name = recorder.start(1)
+        recorder.data_callback(1, "1.5")
+        # emulate crash: file is not truncated
+        recorder.recorders.pop(1)
+        self.assertEqual(recorder.list_recordings()[0]['records'], 1)
+
+    def test_data_without_recording(self):
+        recorder.data_callback(2, "1.5")
+        self.assertEqual(recorder.list_recordings(), [])
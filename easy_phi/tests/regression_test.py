@@ -2,6 +2,9 @@
 
 import timeit
 
+from tornado.test.util import unittest
+
+from easy_phi import hislip
 from handlers_test import BaseTestCase
 
 
@@ -43,3 +46,51 @@ class PerformanceTest(BaseTestCase):
 
         # actually, unittest will print total execution time
         # but you can also output elapsed here
+
+
+class HiSLIPCodecPerformanceTest(unittest.TestCase):
+
+    # typical size of oscilloscope waveform dump
+    size = 8 * 1024 * 1024
+    max_message_size = 1024 * 1024
+
+    def test_timing_codec(self):
+        payload = memoryview('\xa5' * self.size)
+
+        class Stream(object):
+            """ Write buffer of tornado IOStream """
+            def __init__(self):
+                self.buffer = bytearray()
+
+            def write(self, data):
+                self.buffer += data
+
+        stream = Stream()
+
+        def encode():
+            del stream.buffer[:]
+            response = hislip.format_response(payload)
+            for message in hislip.fragment(1, response,
+                                           self.max_message_size):
+                message.write_to(stream)
+
+        def decode():
+            offset = 0
+            length = 0
+            buf = stream.buffer
+            while offset < len(buf):
+                message, offset = hislip.HiSLIPMessage.unpack_from(buf, offset)
+                length += len(message.payload)
+            # block header and terminating newline
+            self.assertEqual(length, self.size + 9 + 1)
+
+        encode()
+        messages = list(hislip.fragment(
+            1, hislip.format_response(payload), self.max_message_size))
+        self.assertEqual(str(stream.buffer[-17:]), str(messages[-1])[-17:])
+
+        number = 20
+        for name, func in (('encode', encode), ('decode', decode)):
+            elapsed = timeit.timeit(func, number=number)
+            print("HiSLIP {0}: {1:.1f} MB/s".format(
+                name, self.size * number / elapsed / 1024 / 1024))
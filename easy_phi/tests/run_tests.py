@@ -5,9 +5,15 @@ from tornado.test.util import unittest
 
 TEST_MODULES = [
     'easy_phi.tests.auth_test',
+    'easy_phi.tests.events_test',
     'easy_phi.tests.handlers_test',
+    'easy_phi.tests.hwconf_test',
+    'easy_phi.tests.hwal_test',
     'easy_phi.tests.mod_conf_patch_test',
+    'easy_phi.tests.raw_socket_test',
+    'easy_phi.tests.recorder_test',
     'easy_phi.tests.scpi2widgets_test',
+    'easy_phi.tests.timeseries_test',
     'easy_phi.tests.utils_test',
     'easy_phi.tests.hislip_test',
 ]
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import ConfigParser
+import os
+import StringIO
 import tempfile
-import unittest
 
 from tornado.test.util import unittest
 from tornado.options import options
@@ -32,8 +34,6 @@ widget = {sysname_widget}\n""".format(reset_widget=self.reset_widget,
 
         options.widgets_conf_path = widgets_conf.name
 
-    # Somehow doesn't get test config. TODO: Fix it"
-    @unittest.expectedFailure
     def test_scpi2widgets(self):
         widgets = scpi2widgets.scpi2widgets([])
         self.assertIsInstance(widgets, list)
@@ -65,3 +65,54 @@ widget = {sysname_widget}\n""".format(reset_widget=self.reset_widget,
         self.assertIsInstance(widgets, list)
         self.assertSequenceEqual(
             widgets, [self.reset_widget, self.sysname_widget])
+
+    def test_reload(self):
+        self.assertEqual(scpi2widgets.scpi2widgets(["*RST"]),
+                         [self.reset_widget])
+        self.conf.seek(0)
+        self.conf.truncate()
+        self.conf.write("[RESET]\nscpi = *RST\nwidget = new widget\n")
+        self.conf.flush()
+        # make sure modification time is changed on filesystems with low
+        # timestamp resolution
+        mtime = os.stat(self.conf.name).st_mtime
+        os.utime(self.conf.name, (mtime + 1, mtime + 1))
+        self.assertEqual(scpi2widgets.scpi2widgets(["*RST"]), ["new widget"])
+
+
+class WidgetsIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        parser = ConfigParser.ConfigParser()
+        parser.readfp(StringIO.StringIO("""[DEFAULT]
+default_widget = default
+
+[Output]
+scpi = CONF:OUT1?
+    CONF:OUT1 (AND|OR)
+widget = output
+
+[Output query]
+scpi = CONF:OUT1?
+widget = query
+
+[Broken]
+scpi = *TST?
+
+[Ignored]
+scpi = *IDN?
+widget =
+"""))
+        self.index = scpi2widgets.WidgetsIndex(parser)
+
+    def test_match(self):
+        self.assertEqual(self.index.match(frozenset()), ('default',))
+        # sections without widget are skipped
+        self.assertEqual(self.index.match(frozenset(['*TST?', '*IDN?'])),
+                         ('default',))
+        self.assertEqual(self.index.match(frozenset(['CONF:OUT1?'])),
+                         ('query', 'default'))
+        # commands are shown by the first matching widget only
+        self.assertEqual(
+            self.index.match(frozenset(['CONF:OUT1?', 'CONF:OUT1 (AND|OR)'])),
+            ('output', 'default'))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+""" Unit tests for easy_phi.timeseries module """
+
+import array
+
+from tornado.test.util import unittest
+
+from easy_phi import timeseries
+
+
+class RingBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.buf = timeseries.RingBuffer(4)
+
+    def test_range(self):
+        for second in range(3):
+            self.buf.append(second, second * 10)
+        timestamps, values = self.buf.range(1, 2)
+        self.assertEqual(timestamps.tolist(), [1])
+        self.assertEqual(values.tolist(), [10])
+        timestamps, values = self.buf.range()
+        self.assertEqual(values.tolist(), [0, 10, 20])
+
+    def test_overwrite(self):
+        for second in range(6):
+            self.buf.append(second, second * 10)
+        self.assertEqual(len(self.buf), 4)
+        # range crossing the end of underlying arrays
+        timestamps, values = self.buf.range(start=3)
+        self.assertEqual(timestamps.tolist(), [3, 4, 5])
+        self.assertEqual(values.tolist(), [30, 40, 50])
+        timestamps, values = self.buf.range(end=3)
+        self.assertEqual(timestamps.tolist(), [2])
+
+
+class DecimateTest(unittest.TestCase):
+
+    def test_decimate(self):
+        timestamps = array.array('d', range(10))
+        values = array.array('d', [1, 5, 2, 2, 3, 3, 0, 9, 4, 4])
+        result = timeseries.decimate(timestamps, values, 2)
+        self.assertEqual(result['t'], [0, 5])
+        self.assertEqual(result['min'], [1, 0])
+        self.assertEqual(result['max'], [5, 9])
+        self.assertAlmostEqual(result['mean'][0], 2.6)
+
+    def test_no_decimation(self):
+        timestamps = array.array('d', [0, 1])
+        values = array.array('d', [1, 2])
+        result = timeseries.decimate(timestamps, values, 10)
+        self.assertEqual(result['t'], [0, 1])
+        self.assertEqual(result['mean'], [1, 2])
+
+
+class DataCallbackTest(unittest.TestCase):
+
+    def tearDown(self):
+        timeseries.buffers.pop(1, None)
+
+    def test_parse_samples(self):
+        self.assertEqual(timeseries.parse_samples("1.5, 2.5;3"),
+                         [1.5, 2.5, 3.0])
+        self.assertEqual(timeseries.parse_samples("ERROR nan 1e400"), [])
+
+    def test_data_callback(self):
+        timeseries.data_callback(1, "0.5,0.6")
+        timeseries.data_callback(1, "DONE")
+        timestamps, values = timeseries.buffers[1].range()
+        self.assertEqual(values.tolist(), [0.5, 0.6])
+        # new module in the slot
+        timeseries.hwconf_callback(1, True)
+        self.assertNotIn(1, timeseries.buffers)
@@ -41,6 +41,105 @@ class FormatConversionsTest(unittest.TestCase):
                         '{"one": 1, "2": null}' == response_text)
         self.assertEqual("application/json", ctype)
 
+    def test_encoders(self):
+        """ Test encoders returned by get_encoder() """
+        encoder = utils.get_encoder('plain')
+        self.assertEqual(encoder.encode([u'\u0444', 'a']), '\xd1\x84\na')
+        self.assertIsInstance(encoder.encode(u'\u0444'), str)
+
+        encoder = utils.get_encoder('json', debug=True)
+        self.assertEqual(encoder.encode({'b': 1, 'a': [2]}),
+                         '{\n    "a": [\n        2\n    ], \n    "b": 1\n}')
+
+        encoder = utils.get_encoder('json', callback='cb')
+        self.assertEqual(encoder.encode([1]), 'cb([1]);')
+        self.assertEqual(encoder.content_type, 'application/json')
+        # JSONP is not applicable to plain text
+        self.assertEqual(utils.get_encoder('plain', callback='cb').encode(1),
+                         '1')
+        self.assertRaises(ValueError, utils.get_encoder, 'xml')
+
+    def test_accepted_format(self):
+        self.assertEqual(utils.accepted_format(
+            'text/html, application/json;q=0.9, */*;q=0.8'), 'json')
+        self.assertEqual(utils.accepted_format('TEXT/PLAIN'), 'plain')
+        self.assertIsNone(utils.accepted_format('*/*'))
+        self.assertIsNone(utils.accepted_format(''))
+
+    def test_native_numbers(self):
+        self.assertEqual(utils.native_numbers("42"), 42)
+        self.assertEqual(utils.native_numbers(" -1.5E-3\n"), -1.5e-3)
+        self.assertEqual(utils.native_numbers(["1", "AND", "+.5"]),
+                         [1, "AND", 0.5])
+        self.assertEqual(
+            utils.native_numbers({'responses': {1: "2"}, 'skew': 0.1}),
+            {'responses': {1: 2}, 'skew': 0.1})
+        self.assertEqual(utils.native_numbers("Easy Phi,1,2"), "Easy Phi,1,2")
+        self.assertEqual(utils.native_numbers("0.25"), 0.25)
+        self.assertEqual(utils.native_numbers("0"), 0)
+        # identifiers with leading zeros and numbers not representable in
+        # binary formats are kept as strings
+        self.assertEqual(utils.native_numbers("00123"), "00123")
+        self.assertEqual(utils.native_numbers(str(2 ** 64)), str(2 ** 64))
+        self.assertEqual(utils.native_numbers(str(-2 ** 63)), -2 ** 63)
+        self.assertEqual(utils.native_numbers("1E999"), "1E999")
+
+
+class SCPIUtilsTest(unittest.TestCase):
+    """ Test helper functions to parse SCPI commands """
+
+    def test_scpi_equivalent(self):
+        canonical = "CONFigure:OUT1 (OR|AND|IN1|IN2)"
+        self.assertTrue(utils.scpi_equivalent("CONF:OUT1 AND", canonical))
+        self.assertTrue(utils.scpi_equivalent("configure:out1", canonical))
+        self.assertTrue(utils.scpi_equivalent(":CONF:OUT1", canonical))
+        # partial long form is not allowed
+        self.assertFalse(utils.scpi_equivalent("CONFig:OUT1", canonical))
+        # query is a different command
+        self.assertFalse(utils.scpi_equivalent("CONF:OUT1?", canonical))
+        self.assertTrue(utils.scpi_equivalent("*IDN?", "*IDN?"))
+
+    def test_scpi_equivalent_optional_nodes(self):
+        canonical = "[SOURce]:FREQuency"
+        self.assertTrue(utils.scpi_equivalent("FREQ 100", canonical))
+        self.assertTrue(utils.scpi_equivalent("SOUR:FREQ 100", canonical))
+        canonical = "SYSTem:ERRor[:NEXT]?"
+        self.assertTrue(utils.scpi_equivalent("SYST:ERR?", canonical))
+        self.assertTrue(utils.scpi_equivalent("SYST:ERR:NEXT?", canonical))
+
+    def test_split_compound_command(self):
+        self.assertEqual(utils.split_compound_command("CONF:OUT1?; *RST;"),
+                         ["CONF:OUT1?", "*RST"])
+        self.assertTrue(utils.is_query("CONF:OUT1?"))
+        self.assertFalse(utils.is_query("CONF:OUT1 AND"))
+
+    def test_parse_block(self):
+        data = "#15A\rB\nC\r\nAND\r\n"
+        start, end, block_end = utils.parse_block(data)
+        self.assertEqual(data[start:end], "A\rB\nC")
+        self.assertEqual(data[block_end:], "AND\r\n")
+        # incomplete block, size is known
+        self.assertEqual(utils.parse_block("#15A\r"), (3, 8, None))
+        # indefinite length block
+        start, end, block_end = utils.parse_block("#0A\rB\n")
+        self.assertEqual((start, end, block_end), (2, 5, 6))
+        self.assertEqual(utils.parse_block("#0AB", eom=True), (2, 4, 4))
+        self.assertIsNone(utils.parse_block("AND\r\n"))
+        # search continues after bytes known to have no newline
+        self.assertEqual(utils.parse_block("#0A\nB\n", scan=4), (2, 5, 6))
+        # text starting with #<digit>
+        self.assertIsNone(utils.parse_block("#1 channel\r\n"))
+        self.assertIsNone(utils.parse_block("#3", eom=True))
+        # header is not complete yet
+        self.assertIsNone(utils.parse_block("#21"))
+
+    def test_npy_header(self):
+        header = utils.npy_header('<f4', 3)
+        self.assertTrue(header.startswith("\x93NUMPY\x01\x00"))
+        self.assertEqual(len(header) % 16, 0)
+        self.assertTrue(header.endswith("\n"))
+        self.assertIn("'shape': (3,)", header)
+
 
 class UpdateUtilFunctionTest(unittest.TestCase):
     """ Test function used by software update """
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""This module keeps recent numeric data generated by modules, so clients
+can get data received before they connected, e.g. to draw a chart.
+Data chunks passed to hwconf data callbacks are parsed into numbers and
+stored with reception time in per-slot ring buffers.
+"""
+
+import array
+import bisect
+import math
+import re
+import time
+
+from tornado.options import define, options
+
+# number of samples kept per slot. Every sample takes 16 bytes
+define('timeseries_capacity', default=100000)
+
+
+class _Timestamps(object):
+    """ Sequence of ring buffer timestamps in chronological order, for bisect
+    """
+    def __init__(self, ring):
+        self.ring = ring
+
+    def __len__(self):
+        return len(self.ring)
+
+    def __getitem__(self, index):
+        return self.ring.timestamps[self.ring.physical(index)]
+
+
+class RingBuffer(object):
+    """ Fixed capacity buffer of timestamped samples
+    Timestamps and values are stored in preallocated arrays of doubles. When
+    buffer is full, new samples overwrite the oldest ones.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array.array('d', [0.0]) * capacity
+        self.values = array.array('d', [0.0]) * capacity
+        self.count = 0
+        self._next = 0  # index to write next sample to
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, value):
+        self.timestamps[self._next] = timestamp
+        self.values[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def physical(self, index):
+        """ Convert index in chronological order to index in arrays """
+        return (self._next - self.count + index) % self.capacity
+
+    def _slice(self, data, lo, hi):
+        start = self.physical(lo)
+        if start + hi - lo <= self.capacity:
+            return data[start:start + hi - lo]
+        return data[start:] + data[:start + hi - lo - self.capacity]
+
+    def range(self, start=None, end=None):
+        """ Get samples received in time range start <= t < end
+        :param start: unix timestamp, None for the oldest sample
+               end: unix timestamp, None for the newest sample
+        :return: tuple of arrays (timestamps, values) in chronological order
+        """
+        timestamps = _Timestamps(self)
+        lo = 0 if start is None else bisect.bisect_left(timestamps, start)
+        hi = self.count if end is None else bisect.bisect_left(timestamps, end)
+        hi = max(lo, hi)
+        return self._slice(self.timestamps, lo, hi), \
+            self._slice(self.values, lo, hi)
+
+
+def decimate(timestamps, values, points):
+    """ Reduce samples to at most specified number of points
+    Time range is split into intervals of equal duration, every non-empty
+    interval is represented by time of its first sample and min, max and
+    mean of its values.
+    :param timestamps: array of timestamps in chronological order
+           values: array of values
+           points: max number of points
+    :return: dictionary of lists: {'t': [], 'min': [], 'max': [], 'mean': []}
+    """
+    if len(timestamps) <= points:
+        values = values.tolist()
+        return {'t': timestamps.tolist(), 'min': values, 'max': values,
+                'mean': values}
+
+    result = {'t': [], 'min': [], 'max': [], 'mean': []}
+    first = timestamps[0]
+    step = float(timestamps[-1] - first) / points
+    lo = 0
+    for interval in range(1, points + 1):
+        if interval == points:
+            hi = len(timestamps)
+        else:
+            hi = bisect.bisect_left(timestamps, first + step * interval, lo)
+        if hi > lo:
+            chunk = values[lo:hi]
+            result['t'].append(timestamps[lo])
+            result['min'].append(min(chunk))
+            result['max'].append(max(chunk))
+            result['mean'].append(math.fsum(chunk) / len(chunk))
+        lo = hi
+    return result
+
+
+def parse_samples(data):
+    """ Extract numbers from data chunk, e.g. '0.5' or '1.5,2.5'
+    :param data: string sent by a module
+    :return: list of finite floats, other tokens are ignored
+    """
+    samples = []
+    for token in re.split(r'[,;\s]+', data):
+        try:
+            value = float(token)
+        except ValueError:
+            continue
+        if not math.isinf(value) and not math.isnan(value):
+            samples.append(value)
+    return samples
+
+
+# slot: RingBuffer
+buffers = {}
+
+
+def data_callback(slot, data):
+    """ Store numbers from data generated by a module, see
+    hwconf.data_callback() """
+    if isinstance(data, memoryview):  # binary block, not a time series
+        return
+    samples = parse_samples(data)
+    if not samples:
+        return
+    if slot not in buffers:
+        buffers[slot] = RingBuffer(options.timeseries_capacity)
+    timestamp = time.time()
+    for value in samples:
+        buffers[slot].append(timestamp, value)
+
+
+def hwconf_callback(slot, added):
+    """ Data of the old module is not relevant to the new one """
+    if added:
+        buffers.pop(slot, None)
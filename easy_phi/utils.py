@@ -1,45 +1,400 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import json
+import math
+import re
+import struct
 
 import pkgtools.pypi
 
+try:  # optional, C accelerated JSON encoder
+    import simplejson as json
+except ImportError:
+    import json
 
-def format_conversion(chunk, fmt, debug=False):
-    if fmt == 'plain':  # Plain text
-        ctype = 'text/plain'
+# optional, compact binary response formats
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class PlainEncoder(object):
+    """ Plain text encoder: dictionaries are formatted as key: value lines,
+    lists as one item per line """
+    content_type = 'text/plain'
+    native_numbers = False
+
+    @staticmethod
+    def _encode_item(item):
+        if isinstance(item, str):
+            return item
+        if not isinstance(item, unicode):
+            item = unicode(item)
+        return item.encode('utf-8')
+
+    def encode(self, chunk):
+        """ :return: UTF-8 encoded bytes """
         if isinstance(chunk, dict):
-            chunk = "\n".join((u"{0}: {1}".format(key, chunk[key])
-                               for key in sorted(chunk.keys())))
-        elif isinstance(chunk, list):
-            chunk = "\n".join((unicode(bit) for bit in chunk))
-        else:
-            chunk = unicode(chunk)
+            return "\n".join(
+                "{0}: {1}".format(self._encode_item(key),
+                                  self._encode_item(chunk[key]))
+                for key in sorted(chunk.keys()))
+        elif isinstance(chunk, (list, tuple)):
+            return "\n".join(self._encode_item(bit) for bit in chunk)
+        return self._encode_item(chunk)
+
+
+class JSONEncoder(object):
+    """ JSON encoder, human readable (sorted keys and indented) in debug mode
+    """
+    content_type = 'application/json'
+    native_numbers = False
+
+    def __init__(self, debug=False):
+        self._encoder = json.JSONEncoder(
+            sort_keys=debug, indent=debug*4 or None, separators=(', ', ': '))
+
+    def encode(self, chunk):
+        """ :return: ASCII bytes, non-ASCII characters are escaped """
+        return self._encoder.encode(chunk)
+
+
+class JSONPEncoder(object):
+    """ JSON wrapped into callback call, for cross-domain static JS API """
+    content_type = 'application/json'
+    native_numbers = False
+
+    def __init__(self, encoder, callback):
+        self.encoder = encoder
+        self.callback = callback
+
+    def wrap(self, body):
+        """ Wrap JSON encoded by self.encoder into callback call """
+        return "{0}({1});".format(self.callback, body)
+
+    def encode(self, chunk):
+        return self.wrap(self.encoder.encode(chunk))
+
+
+def _decode_strings(chunk):
+    """ Convert byte strings in response to unicode, so binary formats
+    encode them as text """
+    if isinstance(chunk, str):
+        return chunk.decode('utf-8', 'replace')
+    if isinstance(chunk, (list, tuple)):
+        return [_decode_strings(item) for item in chunk]
+    if isinstance(chunk, dict):
+        return dict((_decode_strings(key), _decode_strings(value))
+                    for key, value in chunk.items())
+    return chunk
+
+
+class MsgPackEncoder(object):
+    """ MessagePack encoder, strings are encoded as text (str type) """
+    content_type = 'application/msgpack'
+    native_numbers = True
+
+    def encode(self, chunk):
+        return msgpack.packb(_decode_strings(chunk), use_bin_type=True)
+
+
+class CBOREncoder(object):
+    """ CBOR (RFC 7049) encoder, strings are encoded as text strings """
+    content_type = 'application/cbor'
+    native_numbers = True
+
+    def encode(self, chunk):
+        return cbor2.dumps(_decode_strings(chunk))
+
+
+# (format, debug): encoder. Encoders are stateless, so they are shared
+_encoders = {
+    ('plain', False): PlainEncoder(),
+    ('plain', True): PlainEncoder(),
+    ('json', False): JSONEncoder(),
+    ('json', True): JSONEncoder(debug=True),
+}
+if msgpack is not None:
+    _encoders[('msgpack', False)] = _encoders[('msgpack', True)] = \
+        MsgPackEncoder()
+if cbor2 is not None:
+    _encoders[('cbor', False)] = _encoders[('cbor', True)] = CBOREncoder()
+
+# formats supported by installed libraries
+response_formats = frozenset(fmt for fmt, _ in _encoders)
+
+# media type: format, for content negotiation
+_media_types = {
+    'application/json': 'json',
+    'text/plain': 'plain',
+    'application/msgpack': 'msgpack',
+    'application/x-msgpack': 'msgpack',
+    'application/cbor': 'cbor',
+}
+
+
+def accepted_format(accept):
+    """ Choose response format by HTTP Accept header
+    :param accept: Accept header value, e.g. 'application/cbor, */*;q=0.8'
+    :return: the first supported format listed in the header, None if there
+            is no such format. Quality values are not taken into account
+    """
+    for media_range in accept.split(","):
+        fmt = _media_types.get(media_range.split(";", 1)[0].strip().lower())
+        if fmt in response_formats:
+            return fmt
+    return None
+
+
+# SCPI decimal numeric response, groups are fraction and exponent
+# SCPI NR1/NR2/NR3 number. Leading zeros mean it is rather an identifier,
+# e.g. serial number 00123, so it is kept as is
+_number = re.compile(
+    r"[+-]?(?:(?:0|[1-9]\d*)(\.\d*)?|(\.\d+))([eE][+-]?\d+)?$")
+# integers representable in binary formats (MessagePack uint64/int64)
+_int_range = (-2 ** 63, 2 ** 64 - 1)
+
+
+def native_numbers(result):
+    """ Convert numeric strings in SCPI result to numbers, e.g. for binary
+    response formats which encode numbers natively
+    :param result: module.scpi() result: string, list of strings or
+            dictionary returned by BroadcastModule.scpi(slot_map=True)
+    :return: result with numeric strings replaced by int or float. Numbers
+            which can't be represented exactly, e.g. too big integers, are
+            kept as strings
+    """
+    if isinstance(result, basestring):
+        match = _number.match(result.strip())
+        if match is None:
+            return result
+        if not any(match.groups()):
+            number = int(result)
+            if not _int_range[0] <= number <= _int_range[1]:
+                return result
+            return number
+        number = float(result)
+        if math.isinf(number):
+            return result
+        return number
+    if isinstance(result, list):
+        return [native_numbers(item) for item in result]
+    if isinstance(result, dict):
+        return dict((key, native_numbers(value))
+                    for key, value in result.items())
+    return result
+
+
+def get_encoder(fmt, debug=False, callback=''):
+    """ Get encoder of responses to specified format
+    :param fmt: 'plain', 'json' or, if corresponding library is installed,
+                'msgpack' or 'cbor'
+           debug: boolean, human readable output
+           callback: JSONP callback name, only used for json format
+    :return: object with content_type attribute and encode(chunk) method
+    """
+    try:
+        encoder = _encoders[(fmt, bool(debug))]
+    except KeyError:
+        raise ValueError("fmt is supposed to be one of: " +
+                         ", ".join(sorted(response_formats)))
+    if callback and fmt == 'json':
+        encoder = JSONPEncoder(encoder, callback)
+    return encoder
 
-    elif fmt == 'json':
-        ctype = 'application/json'
-        chunk = json.dumps(chunk, sort_keys=debug, indent=debug*4 or None,
-                           separators=(', ', ': '))
-    else:
-        raise ValueError("fmt is supposed to be xml, plain or json")
 
-    return chunk, ctype
+class RawEncoder(object):
+    """ Encoder of responses which are formatted by handler itself """
+    native_numbers = False
+
+    def __init__(self, content_type):
+        self.content_type = content_type
+
+    def encode(self, chunk):
+        return chunk
+
+
+def format_conversion(chunk, fmt, debug=False):
+    encoder = get_encoder(fmt, debug)
+    return encoder.encode(chunk), encoder.content_type
+
+
+# Generation of slowly changing platform state: list of modules, their
+# configurations, widgets. It is incremented on every change, so responses
+# depending only on this state can be cached until generation changes
+generation = 0
+
+
+def bump_generation():
+    """ Invalidate responses cached for the current generation """
+    global generation
+    generation += 1
+
+
+class GenerationCache(object):
+    """ Cache of values depending only on platform state generation, it is
+    emptied when generation changes """
+
+    def __init__(self):
+        self._values = {}
+        self._generation = None
+
+    def get(self, key, build):
+        """ Get cached value, building it if necessary
+        :param key: hashable
+               build: function returning value. Value is not cached if
+                generation was changed while building it, e.g. because build
+                loaded configuration
+        :return: value
+        """
+        if self._generation != generation:
+            self._values.clear()
+            self._generation = generation
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        value = build()
+        if self._generation == generation:
+            self._values[key] = value
+        return value
+
+
+# compiled regular expressions for canonical command headers, see
+# scpi_equivalent(). Configuration is limited, so cache is not purged
+_header_patterns = {}
+
+
+def _header_pattern(canonical):
+    """ Compile canonical SCPI command header into regular expression
+    Every mnemonic accepts either short (uppercase) or long form, nodes in
+    square brackets are optional, e.g. [SOURce]:FREQuency matches FREQ,
+    SOUR:FREQ and source:frequency
+    """
+    # leading optional node, e.g. [SOURce]:FREQuency, takes the separator
+    # with it, otherwise FREQ would not match
+    canonical = re.sub(r'\[([^:\]][^\]]*)\]:', r'[\1:]', canonical)
+    pattern = ''
+    for token in re.findall(r'\[|\]|:|\?|[^\[\]:?]+', canonical):
+        if token == '[':
+            pattern += '(?:'
+        elif token == ']':
+            pattern += ')?'
+        elif token in (':', '?'):
+            pattern += re.escape(token)
+        else:
+            # short form is everything up to the first lowercase letter
+            short = re.match(r'[^a-z]*', token).group()
+            pattern += re.escape(short.upper())
+            if len(short) < len(token):
+                pattern += '(?:{0})?'.format(re.escape(token[len(short):]))
+    return re.compile(pattern + '$', re.IGNORECASE)
 
 
 def scpi_equivalent(command, canonical):
-    # TODO: add docstring, documentation, unittest
-    command = command.strip().split(" ", 1)[0]
-    canonical = canonical.strip().split(" ", 1)[0]
+    """ Check if SCPI command matches canonical form of the command
+    Parameters are ignored, only headers are compared.
 
-    # TODO: actually implement this method
-    # TODO: add support for default command
-    while True:
-        if command == canonical:
-            return True
-        break
+    :param command: scpi command as it was sent by user, e.g. CONF:OUT1 AND
+    :param canonical: command as it is listed in module configuration,
+            e.g. CONFigure:OUT1 (OR|AND|IN1|IN2)
+    :return: boolean, True if command headers are equivalent
+    """
+    command = command.strip().split(" ", 1)[0].lstrip(":")
+    canonical = canonical.strip().split(" ", 1)[0].lstrip(":")
+
+    if canonical not in _header_patterns:
+        _header_patterns[canonical] = _header_pattern(canonical)
+
+    return _header_patterns[canonical].match(command) is not None
+
+
+def split_compound_command(raw_str):
+    """ Split compound SCPI message into separate commands
+    SCPI allows to send several commands in one message, separated by
+    semicolon, e.g. CONF:OUT1?;CONF:OUT2?
+
+    :param raw_str: raw scpi message
+    :return: list of commands, empty commands are omitted
+    """
+    return [cmd.strip() for cmd in raw_str.split(";") if cmd.strip()]
+
+
+def is_query(command):
+    """ Check if SCPI command is a query, i.e. its header ends with '?'
+    :param command: single (not compound) scpi command, e.g. CONF:OUT1?
+    :return: boolean
+    """
+    return command.strip().split(" ", 1)[0].endswith("?")
 
-    return False
+
+# IEEE 488.2 arbitrary block header: '#', number of length digits and
+# length itself. #0 starts indefinite length block, terminated by newline
+_block_header = re.compile(r"\s*#([0-9])")
+
+
+def parse_block(data, start=0, eom=False, scan=0):
+    """ Locate IEEE 488.2 arbitrary block, e.g. #15HELLO or #0HELLO\\n
+    :param data: bytes or bytearray
+           start: offset of the message in data
+           eom: boolean, data ends with end of message. Otherwise data might
+                be incomplete, and indefinite length block ends with newline
+           scan: offset to continue search of indefinite length block end
+                from, i.e. data before it is known to have no newline
+    :return: None if message is not a binary block (or block header is not
+            complete yet), or tuple (payload_start, payload_end, end).
+            payload_end is None if it is not known yet, end (offset after the
+            block and its terminator) is None if block is incomplete
+    """
+    match = _block_header.match(data, start)
+    if match is None:
+        return None
+    header_end = match.end() + int(match.group(1))
+
+    if header_end == match.end():  # indefinite length block
+        payload_end = data.find("\n", max(header_end, scan))
+        if payload_end >= 0:
+            return header_end, payload_end, payload_end + 1
+        if eom:
+            return header_end, len(data), len(data)
+        return header_end, None, None
+
+    # text might start with #<digit> as well, so only complete header of
+    # digits means block
+    length = bytes(data[match.end():header_end])
+    if len(data) < header_end or not length.isdigit():
+        return None
+    payload_end = header_end + int(length)
+    if len(data) < payload_end:
+        return header_end, payload_end, None
+    # skip message terminator, if it is already received
+    end = payload_end
+    while data[end:end + 1] in ("\r", "\n") and end < len(data):
+        end += 1
+    return header_end, payload_end, end
+
+
+def npy_header(dtype, size):
+    """ Header of NumPy .npy file (format version 1.0) with 1-D array
+    It allows to return binary data as typed array without numpy dependency
+    :param dtype: array-protocol type string, e.g. '<f4', or list of
+                (field name, type string) for structured array
+           size: number of array items
+    :return: bytes to write before array data
+    """
+    descr = repr(str(dtype)) if isinstance(dtype, basestring) else repr(dtype)
+    header = "{{'descr': {0}, 'fortran_order': False, 'shape': ({1},), }}" \
+             "".format(descr, size)
+    # magic string, version and header length take 10 bytes, total header
+    # length (including terminating newline) should be divisible by 16
+    header += " " * (15 - (10 + len(header)) % 16) + "\n"
+    return "\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header
 
 
 def parse_scpi_command(raw_str):
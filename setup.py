@@ -62,5 +62,12 @@ setup(
         'keyring',
         'futures',  # Python 2 only
     ],
+    extras_require={
+        # faster JSON encoding of API responses
+        'speedups': ['simplejson'],
+        # binary response formats, format=msgpack or format=cbor
+        'msgpack': ['msgpack'],
+        'cbor': ['cbor2'],
+    },
     # TODO: add unit tests
 )